@@ -1,6 +1,7 @@
 from .core import gray_code
 from .core import signed_sub
 from .core import checked_sub
+from .core import checked_add
 from .core import difference
 from .core import negate
 from .core import count_ones
@@ -23,14 +24,50 @@ from .counters import rtl_range
 
 from .shifters import lfsr
 
+from .verification import EquivalenceResult
 from .verification import equivalent_comb_via_sim
+from .verification import ProofResult
+from .verification import equivalent_comb_via_sat
+from .verification import equivalent_seq_via_bmc
+from .verification import LockstepResult
+from .verification import equivalent_seq_via_simulation
 from .verification import equivalent_seq_via_cosa
 
+from .bitsliced import BitslicedSimulation
+
+from .floating_point import FPFormat
 from .floating_point import fp_add
+from .floating_point import fp_add_model
+from .floating_point import fp_add_dual_path
+from .floating_point import fp_add_packed
+from .floating_point import fp_mul
+from .floating_point import fp_fma
+from .floating_point import fp_long_accumulator
+from .floating_point import fp_convert
+from .floating_point import int_to_fp
+from .floating_point import fp_to_int
+from .floating_point import fp_to_sortable
+from .floating_point import sortable_to_fp
 from .floating_point import float_to_fp
 from .floating_point import fp_to_float
 from .floating_point import float_in_range
 
+from .fixed_point import QFormat
+from .fixed_point import fixed_add
+from .fixed_point import fixed_sub
+from .fixed_point import fixed_mul
+from .fixed_point import fixed_convert
+from .fixed_point import float_to_fixed
+from .fixed_point import fixed_to_float
+
+from .sorters import sort
+from .sorters import sorting_network
 from .sorters import bitonic_sort
+from .sorters import argsort
+from .sorters import verify_sorting_network
+from .sorters import top_k
+from .sorters import median
+from .sorters import pipelined_sort
+from .sorters import stream_sort
 
 from .meta import *
@@ -50,6 +50,23 @@ def checked_sub(a, b, bitwidth):
     return CheckedResult(res, cond1 | cond2)
 
 
+def checked_add(a, b, bitwidth):
+    """ Signed addition truncated to bitwidth, along with whether it overflowed.
+
+    :param a: a WireVector to serve as first input to addition
+    :param b: a WireVector to serve as second input to addition
+    :param bitwidth: the bitwidth of the result
+    :return: a CheckedResult of the truncated sum and a 1-bit overflow flag
+    """
+    res = pyrtl.signed_add(a, b).truncate(bitwidth)
+    # Only operands of the same sign can overflow, and then the result has the other
+    # sign; looking at the sign bits avoids the comparators checked_sub() builds.
+    a, b = pyrtl.as_wires(a), pyrtl.as_wires(b)
+    cond1 = ~a[-1] & ~b[-1] & res[-1]
+    cond2 = a[-1] & b[-1] & ~res[-1]
+    return CheckedResult(res, cond1 | cond2)
+
+
 def difference(x, y):
     """ Returns max(x, y) - min(x, y) [taking signedness into account] """
     # Doing this verbosely because I only want one call to signed_sub.
@@ -0,0 +1,304 @@
+import collections
+import re
+import pyrtl
+import pyrtl.rtllib.adders
+import pyrtl.rtllib.multipliers
+
+from .core import CheckedResult, checked_add, checked_sub
+
+
+class QFormat(collections.namedtuple('QFormat', ['integer_bits', 'fraction_bits', 'signed'])):
+    """ A binary fixed point format, Qm.n.
+
+    :param integer_bits: m, the number of integer bits, including the sign bit
+        when signed
+    :param fraction_bits: n, the number of fraction bits
+    :param signed: whether the number is two's complement (default True)
+
+    A Qm.n number is stored in m + n bits, and its value is that of the integer
+    held in those bits divided by 2 ** n. Anywhere a `fmt` is expected, either
+    one of these or its name can be given: 'Q1.15' is signed with 16 bits, and
+    'UQ8.8' is unsigned with 16 bits.
+
+    Example::
+
+        q = QFormat(4, 12)
+        float_to_fixed(-1.25, q)
+    """
+    __slots__ = ()
+
+    def __new__(cls, integer_bits, fraction_bits, signed=True):
+        if integer_bits < (1 if signed else 0) or fraction_bits < 0 \
+                or integer_bits + fraction_bits < 1:
+            raise ValueError("QFormat needs a sign bit when signed, and at least 1 bit")
+        return super(QFormat, cls).__new__(cls, integer_bits, fraction_bits, signed)
+
+    def __str__(self):
+        return '%sQ%d.%d' % ('' if self.signed else 'U', self.integer_bits, self.fraction_bits)
+
+    @property
+    def bitwidth(self):
+        return self.integer_bits + self.fraction_bits
+
+    @property
+    def min_int(self):
+        """ The smallest raw integer the format can hold """
+        return -2 ** (self.bitwidth - 1) if self.signed else 0
+
+    @property
+    def max_int(self):
+        """ The largest raw integer the format can hold """
+        return 2 ** (self.bitwidth - 1 if self.signed else self.bitwidth) - 1
+
+    @property
+    def min_value(self):
+        return self.min_int / 2 ** self.fraction_bits
+
+    @property
+    def max_value(self):
+        return self.max_int / 2 ** self.fraction_bits
+
+
+def _q_format(fmt):
+    if isinstance(fmt, QFormat):
+        return fmt
+    m = re.match(r'(U?)Q(\d+)\.(\d+)$', fmt) if isinstance(fmt, str) else None
+    if m is None:
+        raise ValueError("Format must be a QFormat or a name like 'Q1.15' or 'UQ8.8'")
+    return QFormat(int(m.group(2)), int(m.group(3)), signed=not m.group(1))
+
+
+_Roundings = ('truncate', 'nearest', 'convergent')
+
+
+def _check_rounding(rounding):
+    if rounding not in _Roundings:
+        raise ValueError("Rounding must be one of %s"
+                         % ", ".join("'%s'" % name for name in _Roundings))
+
+
+def _check_operand(w, fmt, name):
+    if len(w) != fmt.bitwidth:
+        raise pyrtl.PyrtlError("%s operands must be %d bits for %s" % (name, fmt.bitwidth, fmt))
+
+
+def _extend(w, bitwidth, signed):
+    return w.sign_extended(bitwidth) if signed else w.zero_extended(bitwidth)
+
+
+def _fixed_fit(value, signed, fmt, saturate):
+    """ Fit an integer (already scaled for fmt) into fmt's bitwidth, saturating on overflow.
+
+    :param value: the integer, as a WireVector
+    :param signed: whether value is two's complement
+    :return: CheckedResult of the fitted value and whether it overflowed
+    """
+    bw = fmt.bitwidth
+    value = _extend(value, max(len(value), bw) + 1, signed)
+    negative = value[-1]
+    if fmt.signed:
+        upper = value[bw - 1:]
+        overflow = (upper != 0) & (upper != 2 ** len(upper) - 1)
+        sat = pyrtl.select(negative, pyrtl.Const(fmt.min_int, bw, signed=True),
+                           pyrtl.Const(fmt.max_int, bw))
+    else:
+        overflow = value[bw:] != 0
+        sat = pyrtl.select(negative, pyrtl.Const(0, bw), pyrtl.Const(fmt.max_int, bw))
+    result = pyrtl.select(overflow, sat, value[:bw]) if saturate else value[:bw]
+    return CheckedResult(result, overflow)
+
+
+def _fixed_requantize(value, fraction_bits, signed, fmt, rounding, saturate):
+    """ Round away (or append) fraction bits so value has fmt's fraction bits,
+    then fit it into fmt.
+    """
+    drop = fraction_bits - fmt.fraction_bits
+    if drop < 0:
+        value = pyrtl.concat(value, pyrtl.Const(0, -drop))
+    elif drop > 0:
+        # Room for the carry out of the rounding increment, and for at least one
+        # bit to be left over
+        value = _extend(value, max(len(value), drop) + 2, signed)
+        if rounding == 'nearest':
+            value = (value + 2 ** (drop - 1)).truncate(len(value))
+        elif rounding == 'convergent':
+            increment = pyrtl.Const(2 ** (drop - 1) - 1, drop) + value[drop]
+            value = (value + increment).truncate(len(value))
+        value = value[drop:]
+    return _fixed_fit(value, signed, fmt, saturate)
+
+
+def _signed_multiply(a, b):
+    """ Two's complement multiply (Baugh-Wooley) reduced with a Wallace tree.
+
+    :param a: signed multiplicand
+    :param b: signed multiplier, same bitwidth as a
+    :return: the 2n-bit product
+
+    Instead of sign extending both operands to 2n bits, the partial product bits
+    with exactly one sign bit in them are inverted, and a 1 is added in columns
+    n and 2n - 1.
+    """
+    n = len(a)
+    width = 2 * n
+    columns = [[] for _ in range(width)]
+    for i in range(n):
+        for j in range(n):
+            bit = a[i] & b[j]
+            columns[i + j].append(~bit if (i == n - 1) != (j == n - 1) else bit)
+    columns[n].append(pyrtl.Const(1, 1))
+    columns[width - 1].append(pyrtl.Const(1, 1))
+    return pyrtl.rtllib.adders.wallace_reducer(columns, width)
+
+
+def fixed_add(a, b, fmt, saturate=True):
+    """ Add two fixed point numbers of the same format.
+
+    :param a: first operand, a WireVector of fmt.bitwidth bits
+    :param b: second operand, a WireVector of fmt.bitwidth bits
+    :param fmt: a QFormat, or the name of one
+    :param saturate: clamp to the largest (or smallest) value on overflow
+        instead of wrapping around (default True)
+    :return: a CheckedResult of the sum, in fmt, and a 1-bit overflow flag
+    """
+    fmt = _q_format(fmt)
+    _check_operand(a, fmt, 'fixed_add')
+    _check_operand(b, fmt, 'fixed_add')
+    if fmt.signed:
+        res, overflow = checked_add(a, b, fmt.bitwidth)
+        # Only same signed operands overflow, so a's sign gives the direction
+        sat = pyrtl.select(a[-1], pyrtl.Const(fmt.min_int, fmt.bitwidth, signed=True),
+                           pyrtl.Const(fmt.max_int, fmt.bitwidth))
+    else:
+        total = a + b
+        res, overflow = total[:fmt.bitwidth], total[fmt.bitwidth]
+        sat = pyrtl.Const(fmt.max_int, fmt.bitwidth)
+    return CheckedResult(pyrtl.select(overflow, sat, res) if saturate else res, overflow)
+
+
+def fixed_sub(a, b, fmt, saturate=True):
+    """ Subtract two fixed point numbers of the same format.
+
+    :param a: first operand, a WireVector of fmt.bitwidth bits
+    :param b: second operand, a WireVector of fmt.bitwidth bits
+    :param fmt: a QFormat, or the name of one
+    :param saturate: clamp to the largest (or smallest) value on overflow
+        instead of wrapping around (default True)
+    :return: a CheckedResult of a - b, in fmt, and a 1-bit overflow flag
+    """
+    fmt = _q_format(fmt)
+    _check_operand(a, fmt, 'fixed_sub')
+    _check_operand(b, fmt, 'fixed_sub')
+    if fmt.signed:
+        res, overflow = checked_sub(a, b, fmt.bitwidth)
+        # Only operands of different signs overflow, so a's sign gives the direction
+        sat = pyrtl.select(a[-1], pyrtl.Const(fmt.min_int, fmt.bitwidth, signed=True),
+                           pyrtl.Const(fmt.max_int, fmt.bitwidth))
+    else:
+        res, overflow = (a - b)[:fmt.bitwidth], a < b
+        sat = pyrtl.Const(0, fmt.bitwidth)
+    return CheckedResult(pyrtl.select(overflow, sat, res) if saturate else res, overflow)
+
+
+def fixed_mul(a, b, fmt, rounding='nearest', saturate=True):
+    """ Multiply two fixed point numbers of the same format.
+
+    :param a: first operand, a WireVector of fmt.bitwidth bits
+    :param b: second operand, a WireVector of fmt.bitwidth bits
+    :param fmt: a QFormat, or the name of one
+    :param rounding: how the low fraction bits of the product are removed:
+        'truncate' (toward negative infinity), 'nearest' (ties toward positive
+        infinity, the usual add half and truncate) or 'convergent' (ties to even)
+    :param saturate: clamp to the largest (or smallest) value on overflow
+        instead of wrapping around (default True)
+    :return: a CheckedResult of the product, in fmt, and a 1-bit overflow flag
+    """
+    fmt = _q_format(fmt)
+    _check_rounding(rounding)
+    _check_operand(a, fmt, 'fixed_mul')
+    _check_operand(b, fmt, 'fixed_mul')
+    if fmt.signed:
+        product = _signed_multiply(a, b)
+    else:
+        product = pyrtl.rtllib.multipliers.tree_multiplier(a, b)
+    return _fixed_requantize(product, 2 * fmt.fraction_bits, fmt.signed, fmt, rounding, saturate)
+
+
+def fixed_convert(w, from_fmt, to_fmt, rounding='nearest', saturate=True):
+    """ Convert a fixed point number to another format.
+
+    :param w: WireVector holding a number in from_fmt
+    :param from_fmt: a QFormat, or the name of one
+    :param to_fmt: a QFormat, or the name of one
+    :param rounding: 'truncate', 'nearest' or 'convergent' (see fixed_mul())
+    :param saturate: clamp to the largest (or smallest) value of to_fmt when the
+        number is out of its range, instead of wrapping around (default True)
+    :return: a CheckedResult of the number in to_fmt and a 1-bit overflow flag
+    """
+    from_fmt, to_fmt = _q_format(from_fmt), _q_format(to_fmt)
+    _check_rounding(rounding)
+    _check_operand(w, from_fmt, 'fixed_convert')
+    return _fixed_requantize(w, from_fmt.fraction_bits, from_fmt.signed, to_fmt,
+                             rounding, saturate)
+
+
+def float_to_fixed(x, fmt, rounding='nearest', saturate=True):
+    """ Convert Python floats into the bitpatterns of fixed point numbers, vectorized with NumPy.
+
+    :param x: a float, a sequence of them, or a NumPy array
+    :param fmt: a QFormat, or the name of one
+    :param rounding: 'truncate', 'nearest' or 'convergent', rounding the same way
+        fixed_mul() does (default 'nearest')
+    :param saturate: clamp out of range values to the format's range (default True),
+        rather than raising a ValueError
+    :return: an int if x is a scalar, otherwise a NumPy array of bitpatterns
+
+    Formats up to 53 bits (where every value is exact in a double) are converted
+    on int64 arrays, and wider ones on arrays of Python ints. Requires NumPy.
+    """
+    import numpy as np
+
+    fmt = _q_format(fmt)
+    _check_rounding(rounding)
+    bw = fmt.bitwidth
+    with np.errstate(over='ignore'):
+        v = np.ldexp(np.asarray(x, dtype=np.float64), fmt.fraction_bits)
+    if np.isnan(v).any():
+        raise ValueError("Cannot convert NaN to fixed point")
+
+    if rounding == 'convergent':
+        r = np.rint(v)
+    else:
+        r = np.floor(v)
+        if rounding == 'nearest':
+            with np.errstate(invalid='ignore'):
+                r = r + ((v - r) >= 0.5)
+    # Clamping to +-2 ** bw first keeps infinities out and is still out of range
+    r = np.clip(r, -2.0 ** bw, 2.0 ** bw)
+    r = r.astype(np.int64) if bw <= 53 else np.vectorize(int, otypes=[object])(r)
+
+    if not saturate and ((r < fmt.min_int) | (r > fmt.max_int)).any():
+        raise ValueError("Value out of range for %s" % (fmt,))
+    bits = np.clip(r, fmt.min_int, fmt.max_int) & (2 ** bw - 1)
+    return int(bits) if np.ndim(bits) == 0 else bits
+
+
+def fixed_to_float(bits, fmt):
+    """ Interpret bitpatterns of fixed point numbers as Python floats, vectorized with NumPy.
+
+    :param bits: a bitpattern (int), a sequence of them, or a NumPy array
+    :param fmt: a QFormat, or the name of one
+    :return: a float if bits is a scalar, otherwise a NumPy array of float64
+
+    Values with more than 53 significant bits are rounded to the nearest double.
+    Requires NumPy.
+    """
+    import numpy as np
+
+    fmt = _q_format(fmt)
+    bw = fmt.bitwidth
+    b = np.asarray(bits, dtype=np.int64 if bw <= 62 else object) & (2 ** bw - 1)
+    if fmt.signed:
+        b = np.where(b >= 2 ** (bw - 1), b - 2 ** bw, b)
+    v = np.ldexp(np.asarray(b, dtype=np.float64), -fmt.fraction_bits)
+    return float(v) if v.ndim == 0 else v
@@ -1,48 +1,74 @@
+import collections
+from fractions import Fraction
 import pyrtl
+import pyrtl.rtllib.adders
 import math
 
 from .core import signed_sub, negate, count_zeroes_from_end
 
 # TODO subnormal numbers?
-# TODO fix and test for the fp_to_float/float_to_fp with negative numbers
 
-_Exponent_bits = {
-    'half': 5,
-    'single': 8,
-    'double': 11,
-    'quad': 15,
-}
 
-# These are the explicitly stored bits, since
-# really the #bits significand = 1 + #bits fraction.
-_Fraction_bits = {
-    'half': 10,
-    'single': 23,
-    'double': 52,
-    'quad': 112,
-}
+class FPFormat(collections.namedtuple('FPFormat', ['exponent_bits', 'fraction_bits', 'bias'])):
+    """ An IEEE 754 style binary floating point format.
 
-_Bias = {
-    'half': 15,  # 2 ** (_Exponent_bits['half'] - 1) - 1
-    'single': 127,
-    'double': 1023,
-    'quad': 16383,
-}
+    :param exponent_bits: number of exponent bits
+    :param fraction_bits: number of explicitly stored fraction bits; the significand
+        is one bit wider because of the hidden bit
+    :param bias: exponent bias (default: 2 ** (exponent_bits - 1) - 1)
+
+    Every format has a sign bit, and reserves the all zeroes exponent for zero
+    (and subnormals) and the all ones exponent for infinity and NaN. Anywhere a
+    `precision` is expected, either one of these or the name of a predefined
+    format can be given.
+
+    Example::
+
+        e6m9 = FPFormat(6, 9)
+        float_to_fp(1.5, precision=e6m9)
+    """
+    __slots__ = ()
+
+    def __new__(cls, exponent_bits, fraction_bits, bias=None):
+        if exponent_bits < 2 or fraction_bits < 1:
+            raise ValueError("FPFormat needs at least 2 exponent bits and 1 fraction bit")
+        if bias is None:
+            bias = 2 ** (exponent_bits - 1) - 1
+        return super(FPFormat, cls).__new__(cls, exponent_bits, fraction_bits, bias)
+
+    @property
+    def bitwidth(self):
+        return 1 + self.exponent_bits + self.fraction_bits
 
-_Bitwidth = {
-    'half': 16,  # 1 + _Exponent_bits['half'] + _Fraction_bits['half']
-    'single': 32,
-    'double': 64,
-    'quad': 128,
+
+# Note that 'fp8_e4m3' keeps the IEEE style infinity and NaN encodings here, so its
+# largest value is 240 rather than the 448 of the OCP variant without infinities.
+_Formats = {
+    'half': FPFormat(5, 10),
+    'single': FPFormat(8, 23),
+    'double': FPFormat(11, 52),
+    'quad': FPFormat(15, 112),
+    'bfloat16': FPFormat(8, 7),
+    'fp8_e4m3': FPFormat(4, 3),
+    'fp8_e5m2': FPFormat(5, 2),
 }
 
 
+def _fp_format(precision):
+    if isinstance(precision, FPFormat):
+        return precision
+    try:
+        return _Formats[precision]
+    except (KeyError, TypeError):
+        raise ValueError("Precision must be an FPFormat or one of %s"
+                         % ", ".join("'%s'" % name for name in _Formats))
+
+
 def float_in_range(x, precision):
-    if precision not in ('half', 'single', 'double', 'quad'):
-        raise ValueError("Precision must be one of 'half', 'single', 'double', or 'quad'")
-    smallest = 2 ** (1 - _Bias[precision])
-    largest = (2 ** (2 ** _Exponent_bits[precision] - _Bias[precision] - 2)) *\
-              (2 - (1 / (2 ** _Fraction_bits[precision])))
+    fmt = _fp_format(precision)
+    smallest = 2 ** (1 - fmt.bias)
+    largest = (2 ** (2 ** fmt.exponent_bits - fmt.bias - 2)) *\
+              (2 - (1 / (2 ** fmt.fraction_bits)))
     return abs(x) >= smallest and abs(x) <= largest
 
 
@@ -54,112 +80,93 @@ def float_to_fp(x, precision='single'):
     """ Convert the Python float into an integer,
         whose bitpattern represents the floating point number.
 
-    :param x:
-    :param precision:
-    :return:
+    :param x: the float to convert
+    :param precision: an FPFormat, or the name of one (default 'single')
+    :return: the bitpattern, rounding the significand to nearest even if x has
+        more significant bits than the format
     """
+    fmt = _fp_format(precision)
+    eb, fb = fmt.exponent_bits, fmt.fraction_bits
 
     # Zero
     if x == 0:
         return 0
 
-    # Inf
-    if math.isinf(x):
-        s = '0' if x > 0 else '1'
-        return int(s + '1' * _Exponent_bits[precision] + '0' * _Fraction_bits[precision], 2)
-
     # NaN
     if math.isnan(x):
-        return int('0' + '1' * _Exponent_bits[precision] + '1' * _Fraction_bits[precision], 2)
+        return int('0' + '1' * eb + '1' * fb, 2)
 
-    if not float_in_range(x, precision):
-        raise ValueError("Value out of range for precision")
+    sign = 1 if x < 0 else 0
 
-    # Get exponent and upper fraction
-    l = abs(int(x))  # TODO check abs()
-    f_upper = bin(l)[3:]  # remove 0b1 (includes leading 1 implied in fp)
-    e = bin(len(f_upper) + _Bias[precision])[2:2 + _Exponent_bits[precision]]
+    # Inf
+    if math.isinf(x):
+        return (sign << (eb + fb)) | ((2 ** eb - 1) << fb)
 
-    # Get lower fraction
-    r = abs(x) - l  # TODO check abs()
-    fraction_bits = len(f_upper)
-    f_lower = ''
-    while r != 0.0 and fraction_bits <= _Fraction_bits[precision]:
-        r *= 2
-        fraction_bits += 1
-        f_lower = f_lower + str(int(r))
-        r -= int(r)
+    if not float_in_range(x, fmt):
+        raise ValueError("Value out of range for precision")
 
-    # Get sign and join
-    sign = '1' if x < 0 else '0'
-    res = zfill_right(sign + e + f_upper + f_lower, _Bitwidth[precision])
-    return int(res, 2)
+    # abs(x) == m * 2 ** e, with 0.5 <= m < 1
+    m, e = math.frexp(abs(x))
+    significand = round(Fraction(m) * 2 ** (fb + 1))
+    if significand == 2 ** (fb + 1):
+        significand, e = significand // 2, e + 1
+    exponent = e - 1 + fmt.bias
+    return (sign << (eb + fb)) | (exponent << fb) | (significand - 2 ** fb)
 
 
 def fp_to_float(fp, precision='single'):
     """ Interpret the bitpattern of fp (an integer) as a
         floating point number, and return a Python float
 
-    :param fp:
-    :param precision:
-    :return:
+    :param fp: the bitpattern
+    :param precision: an FPFormat, or the name of one (default 'single')
+    :return: the float it represents
     """
 
-    if precision not in ('half', 'single', 'double', 'quad'):
-        raise ValueError("Precision must be one of 'half', 'single', 'double', or 'quad")
+    fmt = _fp_format(precision)
     if not isinstance(fp, int):
         raise TypeError("fp must be an integer")
 
-    fp = bin(fp)[2:].zfill(_Bitwidth[precision])
+    fp = bin(fp)[2:].zfill(fmt.bitwidth)
     s = fp[0]
-    e = fp[1:1 + _Exponent_bits[precision]]
-    f = fp[1 + _Exponent_bits[precision]:]
+    e = fp[1:1 + fmt.exponent_bits]
+    f = fp[1 + fmt.exponent_bits:]
 
-    if e == '0' * _Exponent_bits[precision]:
-        if f == '0' * _Fraction_bits[precision]:
+    if e == '0' * fmt.exponent_bits:
+        if f == '0' * fmt.fraction_bits:
             return 0.0
         else:
             raise ValueError("Subnormal number not supported")
-    elif e == '1' * _Exponent_bits[precision]:
-        if f == '0' * _Fraction_bits[precision]:
+    elif e == '1' * fmt.exponent_bits:
+        if f == '0' * fmt.fraction_bits:
             return math.inf if s == '0' else -math.inf
         else:
             # Or float('nan') (Using math.nan permits object comparision, i.e. x is math.nan)
             return math.nan
 
-    ev = 2 ** (int(e, 2) - _Bias[precision])
-    fv = 1 + (int(f, 2) / 2 ** _Fraction_bits[precision])
+    ev = 2 ** (int(e, 2) - fmt.bias)
+    fv = 1 + (int(f, 2) / 2 ** fmt.fraction_bits)
     v = ev * fv
     return v if s == '0' else -v
 
 
-def _fp_get_parts_wv(w, precision):
-    if precision == 'half':
-        return pyrtl.chop(w, 1, _Exponent_bits['half'], _Fraction_bits['half'])
-    elif precision == 'single':
-        return pyrtl.chop(w, 1, _Exponent_bits['single'], _Fraction_bits['single'])
-    elif precision == 'double':
-        return pyrtl.chop(w, 1, _Exponent_bits['double'], _Fraction_bits['double'])
-    elif precision == 'quad':
-        return pyrtl.chop(w, 1, _Exponent_bits['quad'], _Fraction_bits['quad'])
-    else:
-        raise ValueError("Precision must be one of 'half', 'single', 'double', or 'quad'")
+def _fp_get_parts_wv(w, fmt):
+    return pyrtl.chop(w, 1, fmt.exponent_bits, fmt.fraction_bits)
 
 
 def fp_add(x, y, precision='single'):
     """
     :param Wire x: a floating point number
     :param Wire y: a floating point number
-    :param string precision: one of 'half', 'single', (default), 'double', or 'quad
-        meaning 16, 32, or 64 bits respectively
+    :param precision: an FPFormat, or one of 'half', 'single' (default), 'double', 'quad',
+        'bfloat16', 'fp8_e4m3', or 'fp8_e5m2'
     :return Wire: the result of floating point addition
     """
-    if precision not in ('half', 'single', 'double', 'quad'):
-        raise ValueError("Precision must be one of 'half', 'single', 'double', or 'quad")
+    fmt = _fp_format(precision)
 
     # Extract the parts
-    sx, ex, fx = _fp_get_parts_wv(x, precision)
-    sy, ey, fy = _fp_get_parts_wv(y, precision)
+    sx, ex, fx = _fp_get_parts_wv(x, fmt)
+    sy, ey, fy = _fp_get_parts_wv(y, fmt)
 
     # Exponent difference
     x_gt_y = pyrtl.signed_gt(ex, ey)
@@ -191,12 +198,849 @@ def fp_add(x, y, precision='single'):
     # Round the sum (TODO, right now just truncating)
     sign = res[-1]
     res = res[:-1]
-    res = res.truncate(_Fraction_bits[precision])
+    res = res.truncate(fmt.fraction_bits)
 
     # TODO repeat normalization and round until done
     # TODO deal with NaN/Inf/underflow/overflow
 
     exponent = signed_sub(pyrtl.select(x_gt_y, ey, ex),
-                          bits_for_normalize).truncate(_Exponent_bits[precision])
+                          bits_for_normalize).truncate(fmt.exponent_bits)
     final = pyrtl.concat(sign, exponent, res)
     return final
+
+
+def fp_add_model(x, y, precision='single'):
+    """ Bit-accurate software model of fp_add(), vectorized with NumPy.
+
+    :param x: bitpatterns of the first operands (an int, a sequence, or a NumPy array)
+    :param y: bitpatterns of the second operands, same shape as x
+    :param precision: an FPFormat, or the name of one (default 'single')
+    :return: NumPy array of the bitpatterns fp_add() produces for each pair
+
+    This is a golden model of exactly what fp_add() builds, not of IEEE addition,
+    so the netlist can be checked against millions of operand pairs per second. It
+    mirrors the hardware step by step: the exponents are compared as signed numbers,
+    *both* significands are shifted right by the exponent difference and *both* are
+    negated (the conditional blocks in fp_add() rebind Python names rather than
+    conditionally assigning wires), the sum is shifted right by its leading zero
+    count, and the fraction is truncated.
+
+    Formats whose intermediate sum fits in 64 bits are computed on uint64 arrays;
+    wider ones (e.g. 'quad') fall back to arrays of Python ints. Requires NumPy.
+    """
+    import numpy as np
+
+    fmt = _fp_format(precision)
+    eb, fb = fmt.exponent_bits, fmt.fraction_bits
+    p = fb + 1
+    if p + 2 <= 64 and fmt.bitwidth <= 64:
+        dtype, c = np.uint64, np.uint64
+
+        def bit_length(a):
+            n = np.zeros(a.shape, dtype=np.uint64)
+            for s in (32, 16, 8, 4, 2, 1):
+                big = (a >> c(s)) != 0
+                a = np.where(big, a >> c(s), a)
+                n += big.astype(np.uint64) * c(s)
+            return n + (a != 0).astype(np.uint64)
+    else:
+        dtype, c = object, int
+        bit_length = np.frompyfunc(int.bit_length, 1, 1)
+
+    x, y = np.asarray(x, dtype=dtype), np.asarray(y, dtype=dtype)
+
+    # Exponents compared and subtracted as eb-bit signed numbers
+    ex, ey = (x >> c(fb)) & c(2 ** eb - 1), (y >> c(fb)) & c(2 ** eb - 1)
+    ex_neg, ey_neg = ex >= c(2 ** (eb - 1)), ey >= c(2 ** (eb - 1))
+    x_gt_y = np.where(ex_neg == ey_neg, ex > ey, ey_neg)
+    sh_amt = np.where(x_gt_y, ex + c(2 ** eb) - ey, ey + c(2 ** eb) - ex) & c(2 ** eb - 1)
+
+    def shifted_negated_significand(v):
+        sig = (v & c(2 ** fb - 1)) | c(2 ** fb)
+        sig = sig >> np.minimum(sh_amt, c(p))
+        # negate() sign extends its argument by one bit before negating it
+        sig = np.where(sig >= c(2 ** (p - 1)), sig | c(2 ** p), sig)
+        return (c(2 ** (p + 1)) - sig) & c(2 ** (p + 1) - 1)
+
+    res = shifted_negated_significand(x) + shifted_negated_significand(y)
+    bits_for_normalize = c(p + 2) - bit_length(res).astype(dtype)
+    res = res >> bits_for_normalize
+    sign = (res >> c(p + 1)) & c(1)
+    fraction = res & c(2 ** fb - 1)
+    low = np.where(x_gt_y, ey, ex)
+    exponent = (low + c(2 ** eb) * c(p + 2) - bits_for_normalize) & c(2 ** eb - 1)
+    return (sign << c(eb + fb)) | (exponent << c(fb)) | fraction
+
+
+# All the hardware below flushes subnormal inputs and results to zero and
+# rounds to nearest, ties to even.
+
+_FPParts = collections.namedtuple(
+    '_FPParts', ['sign', 'exponent', 'significand', 'is_zero', 'is_inf', 'is_nan'])
+
+
+def _fp_unpack(w, fmt):
+    """ Split a floating point wire into its parts, with the hidden bit made explicit
+    in the significand, and classify it (subnormals count as zero).
+    """
+    s, e, f = _fp_get_parts_wv(w, fmt)
+    e_zero = e == 0
+    e_ones = e == 2 ** fmt.exponent_bits - 1
+    f_zero = f == 0
+    significand = pyrtl.concat(~e_zero, f)
+    return _FPParts(s, e, significand, e_zero, e_ones & f_zero, e_ones & ~f_zero)
+
+
+def _exp_bitwidth(fmt):
+    """ Width of the two's complement intermediate exponents; enough to hold the sum
+    of two biased exponents plus or minus a few significand widths without wrapping.
+    """
+    p = fmt.fraction_bits + 1
+    return (2 ** (fmt.exponent_bits + 1) + abs(fmt.bias) + 4 * p + 8).bit_length() + 1
+
+
+def _fp_inf(sign, fmt):
+    return pyrtl.concat(sign, pyrtl.Const(2 ** fmt.exponent_bits - 1, fmt.exponent_bits),
+                        pyrtl.Const(0, fmt.fraction_bits))
+
+
+def _fp_nan(fmt):
+    # Same bit pattern float_to_fp() produces for NaN
+    return pyrtl.Const(float_to_fp(math.nan, fmt), fmt.bitwidth)
+
+
+def _fp_round_and_pack(sign, exponent, significand, fmt):
+    """ Round a normalized significand to nearest even and pack it with sign and exponent.
+
+    :param sign: 1-bit sign of the result
+    :param exponent: biased exponent of the result, in two's complement
+        (_exp_bitwidth(fmt) bits)
+    :param significand: normalized significand (msb is the hidden bit) followed by any
+        number of extra bits below the fraction; the lowest of these should already have
+        the sticky bits ORed into it
+    :return: the packed result, overflowing to infinity and flushing underflow to zero
+    """
+    fb = fmt.fraction_bits
+    ew = _exp_bitwidth(fmt)
+    extra = len(significand) - (fb + 1)
+
+    if extra == 0:
+        rounded = significand.zero_extended(fb + 2)
+    else:
+        kept = significand[extra:]
+        guard = significand[extra - 1]
+        sticky = pyrtl.rtl_any(*significand[:extra - 1]) if extra > 1 else pyrtl.Const(0)
+        rounded = kept + (guard & (sticky | kept[0]))
+    # Rounding up 1.11..1 carries out into 10.00..0, whose fraction bits are still zero
+    carry = rounded[-1]
+    exponent = (exponent + carry)[:ew]
+    return _fp_pack(sign, exponent, rounded[:fb], fmt)
+
+
+def _fp_pack(sign, exponent, fraction, fmt):
+    """ Pack an already rounded result, overflowing to infinity and flushing
+    underflow to zero; exponent is as for _fp_round_and_pack().
+    """
+    eb, fb = fmt.exponent_bits, fmt.fraction_bits
+    ew = _exp_bitwidth(fmt)
+    underflow = pyrtl.signed_le(exponent, pyrtl.Const(0, ew))
+    overflow = pyrtl.signed_ge(exponent, pyrtl.Const(2 ** eb - 1, ew))
+    normal = pyrtl.concat(sign, exponent[:eb], fraction)
+    zero = pyrtl.concat(sign, pyrtl.Const(0, eb + fb))
+    return pyrtl.select(underflow, zero, pyrtl.select(overflow, _fp_inf(sign, fmt), normal))
+
+
+def _fp_clamp_exponent(exponent, fmt):
+    """ Saturate a biased two's complement exponent of any width into
+    _exp_bitwidth(fmt) bits, keeping everything that overflows or underflows
+    the format (even after rounding) out of range.
+    """
+    ew = _exp_bitwidth(fmt)
+    if len(exponent) <= ew:
+        return exponent.sign_extended(ew)
+    top = pyrtl.Const(2 ** fmt.exponent_bits, len(exponent))
+    return pyrtl.select(pyrtl.signed_lt(exponent, pyrtl.Const(-1, len(exponent), signed=True)),
+                        pyrtl.Const(-1, ew, signed=True),
+                        pyrtl.select(pyrtl.signed_gt(exponent, top),
+                                     pyrtl.Const(2 ** fmt.exponent_bits, ew), exponent[:ew]))
+
+
+def _lza(a, b):
+    """ Leading zero anticipation for |a - b| (both unsigned, same width).
+
+    Predicts the number of leading zeros of the difference directly from the operands,
+    so it can run in parallel with the subtraction. The prediction is either exact or
+    one less than the true count.
+    """
+    n = len(a)
+    a = a.zero_extended(n + 1)
+    b = ~b.zero_extended(n + 1)
+    t = a ^ b
+    g = a & b
+    z = ~a & ~b
+    # Everything below the lsb behaves as neither generate nor zero
+    g_prev = pyrtl.concat(g[:n - 1], pyrtl.Const(0)) if n > 1 else pyrtl.Const(0)
+    z_prev = pyrtl.concat(z[:n - 1], pyrtl.Const(0)) if n > 1 else pyrtl.Const(0)
+    t_next = t[1:]
+    g, z = g[:n], z[:n]
+    f = (t_next & ((g & ~z_prev) | (z & ~g_prev))) | \
+        (~t_next & ((z & ~z_prev) | (g & ~g_prev)))
+    return count_zeroes_from_end(f)
+
+
+def fp_add_dual_path(x, y, precision='single'):
+    """ Low-latency floating point adder with separate near and far paths.
+
+    :param Wire x: a floating point number
+    :param Wire y: a floating point number
+    :param precision: an FPFormat, or the name of one (default 'single')
+    :return Wire: x + y, rounded to nearest even
+
+    The near path handles effective subtraction with exponents at most one apart,
+    where massive cancellation can happen: the leading zeros of the difference are
+    anticipated from the operands in parallel with the subtraction, and a one bit
+    correction shift fixes the (at most one) misprediction. The far path handles
+    everything else, where the result needs at most a one bit normalization shift,
+    so it has no leading zero counter at all. Both paths run in parallel and the
+    exponent difference picks between them.
+
+    Unlike fp_add, this handles zeros, infinities, and NaN; subnormal inputs are
+    treated as zero and results that would be subnormal are flushed to zero.
+    """
+    fmt = _fp_format(precision)
+
+    p = fmt.fraction_bits + 1
+    ew = _exp_bitwidth(fmt)
+    x_w, y_w = x, y
+    x, y = _fp_unpack(x, fmt), _fp_unpack(y, fmt)
+    eff_sub = x.sign ^ y.sign
+
+    # Exponent difference, both ways around, in parallel
+    ex, ey = x.exponent.zero_extended(ew), y.exponent.zero_extended(ew)
+    d_xy = (ex - ey)[:ew]
+    d_yx = (ey - ex)[:ew]
+    x_big = ~d_xy[-1]  # ex >= ey
+    d = pyrtl.select(x_big, d_xy, d_yx)
+    e_big = pyrtl.select(x_big, ex, ey)
+    use_near = eff_sub & (d <= 1)
+
+    # Near path: exponent difference is 0 or 1, so alignment is a one bit shift and
+    # only a single guard bit is ever needed.
+    a = pyrtl.concat(x.significand, pyrtl.Const(0))
+    b = pyrtl.concat(y.significand, pyrtl.Const(0))
+    d_one = d[0]
+    a = pyrtl.select(d_one & ~x_big, a[1:].zero_extended(p + 1), a)
+    b = pyrtl.select(d_one & x_big, b[1:].zero_extended(p + 1), b)
+    lz = _lza(a, b)
+    a_minus_b = (a - b)[:p + 2]
+    a_lt_b = a_minus_b[-1]
+    near_diff = pyrtl.select(a_lt_b, (b - a)[:p + 1], a_minus_b[:p + 1])
+    near_sign = pyrtl.select(a_lt_b, y.sign, x.sign)
+    near_sig = pyrtl.shift_left_logical(near_diff, lz)
+    fix = ~near_sig[-1]
+    near_sig = pyrtl.select(fix, pyrtl.concat(near_sig[:-1], pyrtl.Const(0)), near_sig)
+    near_exp = (e_big - lz - fix)[:ew]
+    near_zero = near_diff == 0
+
+    # Far path: swap by exponent, align the smaller significand with guard, round and
+    # sticky bits, then add or subtract; at most a one bit shift normalizes the result.
+    big_sig = pyrtl.select(x_big, x.significand, y.significand)
+    small_sig = pyrtl.select(x_big, y.significand, x.significand)
+    shift = pyrtl.select(d > p + 3, pyrtl.Const(p + 3), d)
+    shifted = pyrtl.shift_right_logical(pyrtl.concat(small_sig, pyrtl.Const(0, p + 3)), shift)
+    small_ext = pyrtl.concat(shifted[p + 1:], pyrtl.rtl_any(*shifted[:p + 1]))
+    big_ext = pyrtl.concat(big_sig, pyrtl.Const(0, 3))
+
+    total = big_ext + small_ext
+    carry = total[p + 3]
+    far_add = pyrtl.select(carry,
+                           pyrtl.concat(total[2:p + 4], total[1] | total[0]),
+                           total[:p + 3])
+    diff = (big_ext - small_ext)[:p + 3]
+    borrow = ~diff[-1]
+    far_sub = pyrtl.select(borrow, pyrtl.concat(diff[:-1], pyrtl.Const(0)), diff)
+    far_sig = pyrtl.select(eff_sub, far_sub, far_add)
+    far_exp = (e_big + (~eff_sub & carry) - (eff_sub & borrow))[:ew]
+    far_sign = pyrtl.select(x_big, x.sign, y.sign)
+
+    sign = pyrtl.select(use_near, near_sign, far_sign)
+    exponent = pyrtl.select(use_near, near_exp, far_exp)
+    # The near path's single extra bit lands in the guard position
+    significand = pyrtl.select(use_near, pyrtl.concat(near_sig, pyrtl.Const(0, 2)), far_sig)
+    res = _fp_round_and_pack(sign, exponent, significand, fmt)
+
+    # Exact cancellation gives +0 when rounding to nearest
+    res = pyrtl.select(use_near & near_zero, pyrtl.Const(0, fmt.bitwidth), res)
+    both_zero = pyrtl.concat(x.sign & y.sign, pyrtl.Const(0, fmt.bitwidth - 1))
+    res = pyrtl.select(y.is_zero, pyrtl.select(x.is_zero, both_zero, x_w), res)
+    res = pyrtl.select(x.is_zero & ~y.is_zero, y_w, res)
+    res = pyrtl.select(y.is_inf, y_w, res)
+    res = pyrtl.select(x.is_inf, x_w, res)
+    invalid = x.is_nan | y.is_nan | (x.is_inf & y.is_inf & eff_sub)
+    return pyrtl.select(invalid, _fp_nan(fmt), res)
+
+
+def _booth_multiply(a, b):
+    """ Unsigned multiply using radix-4 Booth recoding and a Wallace tree.
+
+    :param a: unsigned multiplicand
+    :param b: unsigned multiplier, same bitwidth as a
+    :return: the 2n-bit product
+
+    Recoding b into digits in {-2, -1, 0, 1, 2} halves the number of partial products;
+    their sign extension is replaced by inverting each sign bit and adding a single
+    correction constant, so every partial product is just bits dropped into the
+    columns of the compressor tree.
+    """
+    n = len(a)
+    width = 2 * n
+    columns = [[] for _ in range(width)]
+
+    def add_bit(bit, col):
+        if col < width:
+            columns[col].append(bit)
+
+    b = pyrtl.concat(b.zero_extended(n + 2), pyrtl.Const(0))
+    a2 = pyrtl.concat(a, pyrtl.Const(0))
+    a1 = a.zero_extended(n + 1)
+    correction = 0
+    for i in range(n // 2 + 1):
+        prev, cur, nxt = b[2 * i], b[2 * i + 1], b[2 * i + 2]
+        one = cur ^ prev
+        two = (nxt & ~cur & ~prev) | (~nxt & cur & prev)
+        neg = nxt
+        magnitude = pyrtl.select(two, a2, pyrtl.select(one, a1, pyrtl.Const(0, n + 1)))
+        pp = magnitude ^ neg.sign_extended(n + 1)
+        for j in range(n + 1):
+            add_bit(pp[j], 2 * i + j)
+        # Sign bit of the n+2 bit two's complement partial product, inverted
+        add_bit(~neg, 2 * i + n + 1)
+        add_bit(neg, 2 * i)
+        correction -= 2 ** (2 * i + n + 1)
+
+    correction %= 2 ** width
+    for col in range(width):
+        if (correction >> col) & 1:
+            add_bit(pyrtl.Const(1, 1), col)
+    return pyrtl.rtllib.adders.wallace_reducer(columns, width)
+
+
+def fp_mul(x, y, precision='single', pipelined=False):
+    """
+    :param Wire x: a floating point number
+    :param Wire y: a floating point number
+    :param precision: an FPFormat, or the name of one (default 'single')
+    :param bool pipelined: if True, register the significand product and the result,
+        so the multiplier takes a new pair of operands every cycle and produces the
+        product two cycles later
+    :return Wire: x * y, rounded to nearest even
+
+    The significands are multiplied with a radix-4 Booth recoded Wallace tree while
+    the exponents are added (removing one bias) in parallel. Since both significands
+    are in [1, 2), the product needs at most a one bit normalization shift.
+    Subnormal inputs are treated as zero and subnormal results are flushed to zero.
+    """
+    fmt = _fp_format(precision)
+
+    p = fmt.fraction_bits + 1
+    ew = _exp_bitwidth(fmt)
+    x, y = _fp_unpack(x, fmt), _fp_unpack(y, fmt)
+
+    sign = x.sign ^ y.sign
+    exponent = (x.exponent.zero_extended(ew) + y.exponent.zero_extended(ew)
+                - fmt.bias)[:ew]
+    product = _booth_multiply(x.significand, y.significand)
+    is_nan = x.is_nan | y.is_nan | (x.is_inf & y.is_zero) | (x.is_zero & y.is_inf)
+    is_inf = x.is_inf | y.is_inf
+    is_zero = x.is_zero | y.is_zero
+
+    if pipelined:
+        stage = []
+        for w in (sign, exponent, product, is_nan, is_inf, is_zero):
+            r = pyrtl.Register(len(w))
+            r.next <<= w
+            stage.append(r)
+        sign, exponent, product, is_nan, is_inf, is_zero = stage
+
+    # Product of two values in [1, 2) is in [1, 4)
+    carry = product[2 * p - 1]
+    significand = pyrtl.select(carry, product, pyrtl.concat(product[:-1], pyrtl.Const(0)))
+    exponent = (exponent + carry)[:ew]
+    res = _fp_round_and_pack(sign, exponent, significand, fmt)
+
+    zero = pyrtl.concat(sign, pyrtl.Const(0, fmt.bitwidth - 1))
+    res = pyrtl.select(is_zero, zero, res)
+    res = pyrtl.select(is_inf, _fp_inf(sign, fmt), res)
+    res = pyrtl.select(is_nan, _fp_nan(fmt), res)
+
+    if pipelined:
+        out = pyrtl.Register(len(res))
+        out.next <<= res
+        res = out
+    return res
+
+
+def fp_fma(a, b, c, precision='single'):
+    """ Fused multiply-add.
+
+    :param Wire a: a floating point number
+    :param Wire b: a floating point number
+    :param Wire c: a floating point number
+    :param precision: an FPFormat, or the name of one (default 'single')
+    :return Wire: a * b + c, with a single rounding to nearest even
+
+    The full 2p-bit product is kept. The addend starts p+3 bits above the product
+    and is shifted right by an amount that depends only on the exponents, so the
+    alignment happens in parallel with the multiplication. The leading zeros of the
+    sum are anticipated from the addends, and the result is normalized and rounded
+    once. Subnormal inputs are treated as zero and subnormal results are flushed.
+    """
+    fmt = _fp_format(precision)
+
+    p = fmt.fraction_bits + 1
+    ew = _exp_bitwidth(fmt)
+    # Width of the sum: carry, addend, product, and two bits below the product, so the
+    # sticky bit never ends up as the guard bit (which it can for p = 2 with only one)
+    n = 3 * p + 5
+    c_w = c
+    a, b, c = _fp_unpack(a, fmt), _fp_unpack(b, fmt), _fp_unpack(c, fmt)
+
+    product = _booth_multiply(a.significand, b.significand)
+    product_sign = a.sign ^ b.sign
+    eff_sub = product_sign ^ c.sign
+
+    # Alignment, in parallel with the multiplication
+    ep = (a.exponent.zero_extended(ew) + b.exponent.zero_extended(ew) - fmt.bias)[:ew]
+    ec = c.exponent.zero_extended(ew)
+    shift = (ep - ec + (p + 3))[:ew]
+    # If the addend is so large the product is entirely below its guard bits, leave the
+    # addend where it is and take the exponent from it instead; the product then only
+    # matters as a sticky value, which it still is.
+    addend_dominates = shift[-1]
+    shift = pyrtl.select(addend_dominates, pyrtl.Const(0, ew),
+                         pyrtl.select(pyrtl.signed_gt(shift, pyrtl.Const(3 * p + 3, ew)),
+                                      pyrtl.Const(3 * p + 3, ew), shift))
+    # Subnormal addends count as zero, so their fraction mustn't reach the sum
+    addend_significand = pyrtl.select(c.is_zero, pyrtl.Const(0, p), c.significand)
+    shifted = pyrtl.shift_right_logical(
+        pyrtl.concat(addend_significand, pyrtl.Const(0, 3 * p + 3)), shift)
+    addend = pyrtl.concat(shifted[p:], pyrtl.rtl_any(*shifted[:p])).zero_extended(n)
+    product = pyrtl.concat(product, pyrtl.Const(0, 2)).zero_extended(n)
+    # Biased exponent of bit 0 of the sum
+    e0 = pyrtl.select(addend_dominates, (ec - (3 * p + 3))[:ew], (ep - 2 * p)[:ew])
+
+    # Add or subtract; the leading zero count is predicted from the operands (at most
+    # one too small), and a one bit correction shift follows the normalization.
+    total = (product + addend)[:n]
+    diff = (product - addend)[:n + 1]
+    neg = diff[-1]
+    diff = pyrtl.select(neg, (addend - product)[:n], diff[:n])
+    magnitude = pyrtl.select(eff_sub, diff, total)
+    sign = pyrtl.select(eff_sub & neg, c.sign, product_sign)
+    lz = pyrtl.select(eff_sub, _lza(product, addend),
+                      count_zeroes_from_end(product | addend) - 1)
+    significand = pyrtl.shift_left_logical(magnitude, lz)
+    fix = ~significand[-1]
+    significand = pyrtl.select(fix, pyrtl.concat(significand[:-1], pyrtl.Const(0)), significand)
+    exponent = (e0 + (n - 1) - lz - fix)[:ew]
+    res = _fp_round_and_pack(sign, exponent, significand, fmt)
+
+    # Special cases
+    product_zero = a.is_zero | b.is_zero
+    product_inf = a.is_inf | b.is_inf
+    res = pyrtl.select(magnitude == 0, pyrtl.Const(0, fmt.bitwidth), res)
+    res = pyrtl.select(product_zero, pyrtl.select(c.is_zero, pyrtl.concat(
+        product_sign & c.sign, pyrtl.Const(0, fmt.bitwidth - 1)), c_w), res)
+    res = pyrtl.select(c.is_inf, c_w, res)
+    res = pyrtl.select(product_inf, _fp_inf(product_sign, fmt), res)
+    invalid = a.is_nan | b.is_nan | c.is_nan | (product_inf & product_zero) | \
+        (product_inf & c.is_inf & eff_sub)
+    return pyrtl.select(invalid, _fp_nan(fmt), res)
+
+
+def fp_convert(w, from_precision, to_precision):
+    """ Convert a floating point number between formats.
+
+    :param Wire w: a floating point number in from_precision
+    :param from_precision: an FPFormat, or the name of one
+    :param to_precision: an FPFormat, or the name of one
+    :return Wire: w in to_precision, rounded to nearest even if to_precision has fewer
+        fraction bits, overflowing to infinity and flushing underflow to zero
+
+    Useful for keeping values in a narrow format in memory and widening them only
+    for the arithmetic, e.g. fp_convert(mem[addr], 'bfloat16', 'single').
+    """
+    src, dst = _fp_format(from_precision), _fp_format(to_precision)
+    x = _fp_unpack(w, src)
+
+    ew = max(_exp_bitwidth(src), _exp_bitwidth(dst)) + 1
+    exponent = (x.exponent.zero_extended(ew) - src.bias + dst.bias)[:ew]
+    exponent = _fp_clamp_exponent(exponent, dst)
+    significand = x.significand
+    if dst.fraction_bits > src.fraction_bits:
+        significand = pyrtl.concat(significand,
+                                   pyrtl.Const(0, dst.fraction_bits - src.fraction_bits))
+    res = _fp_round_and_pack(x.sign, exponent, significand, dst)
+
+    res = pyrtl.select(x.is_zero, pyrtl.concat(x.sign, pyrtl.Const(0, dst.bitwidth - 1)), res)
+    res = pyrtl.select(x.is_inf, _fp_inf(x.sign, dst), res)
+    return pyrtl.select(x.is_nan, _fp_nan(dst), res)
+
+
+def int_to_fp(w, precision='single', signed=False):
+    """ Convert an integer to floating point.
+
+    :param Wire w: the integer
+    :param precision: an FPFormat, or the name of one (default 'single')
+    :param bool signed: if True, w is treated as two's complement
+    :return Wire: w as a floating point number, rounded to nearest even
+    """
+    fmt = _fp_format(precision)
+    w = pyrtl.as_wires(w)
+    n = len(w)
+
+    if signed:
+        sign = w[-1]
+        magnitude = pyrtl.select(sign, (~w + 1)[:n], w)
+    else:
+        sign = pyrtl.Const(0)
+        magnitude = w
+    lz = count_zeroes_from_end(magnitude)
+    significand = pyrtl.shift_left_logical(magnitude, lz)
+    if n < fmt.fraction_bits + 1:
+        significand = pyrtl.concat(significand, pyrtl.Const(0, fmt.fraction_bits + 1 - n))
+
+    ew = max(_exp_bitwidth(fmt), (fmt.bias + n).bit_length() + 1)
+    exponent = (pyrtl.Const(fmt.bias + n - 1, ew) - lz)[:ew]
+    res = _fp_round_and_pack(sign, _fp_clamp_exponent(exponent, fmt), significand, fmt)
+    return pyrtl.select(magnitude == 0, pyrtl.Const(0, fmt.bitwidth), res)
+
+
+def fp_to_int(w, bitwidth, precision='single', signed=False):
+    """ Convert floating point to an integer.
+
+    :param Wire w: a floating point number
+    :param int bitwidth: bitwidth of the resulting integer
+    :param precision: an FPFormat, or the name of one (default 'single')
+    :param bool signed: if True, the result is two's complement
+    :return Wire: w rounded to the nearest integer (ties to even), saturating at
+        the largest and smallest representable integers; NaN becomes 0
+    """
+    fmt = _fp_format(precision)
+    p = fmt.fraction_bits + 1
+    ew = max(_exp_bitwidth(fmt), bitwidth.bit_length() + 2)
+    x = _fp_unpack(w, fmt)
+
+    # With the significand shifted left by (unbiased exponent + 1), the binary point
+    # sits right above its original p bits.
+    k1 = (x.exponent.zero_extended(ew) - (fmt.bias - 1))[:ew]
+    too_small = pyrtl.signed_lt(k1, pyrtl.Const(0, ew))
+    too_big = pyrtl.signed_gt(k1, pyrtl.Const(bitwidth, ew))
+    shift = pyrtl.select(too_small | too_big, pyrtl.Const(0, ew), k1)
+    shifted = pyrtl.shift_left_logical(x.significand.zero_extended(bitwidth + p), shift)
+    whole = shifted[p:]
+    guard = shifted[p - 1]
+    sticky = pyrtl.rtl_any(*shifted[:p - 1]) if p > 1 else pyrtl.Const(0)
+    magnitude = whole + (guard & (sticky | whole[0]))
+    magnitude = pyrtl.select(too_small | x.is_zero, pyrtl.Const(0, bitwidth + 1), magnitude)
+
+    if signed:
+        limit = pyrtl.select(x.sign, pyrtl.Const(2 ** (bitwidth - 1)),
+                             pyrtl.Const(2 ** (bitwidth - 1) - 1))
+    else:
+        limit = pyrtl.select(x.sign, pyrtl.Const(0), pyrtl.Const(2 ** bitwidth - 1))
+    overflow = too_big | x.is_inf | (magnitude > limit)
+    magnitude = pyrtl.select(overflow, limit, magnitude)[:bitwidth]
+    res = pyrtl.select(x.sign, (~magnitude + 1)[:bitwidth], magnitude) if signed else magnitude
+    return pyrtl.select(x.is_nan, pyrtl.Const(0, bitwidth), res)
+
+
+def fp_to_sortable(w):
+    """ Map a floating point bitpattern to an integer with the same ordering.
+
+    :param Wire w: a floating point number, in any format
+    :return Wire: an integer of the same bitwidth that compares (unsigned) the way
+        w does: -NaN < -inf < negatives < -0 < +0 < positives < +inf < +NaN
+
+    Positive numbers get their sign bit flipped, and negative ones have every bit
+    inverted, which is cheaper than a single floating point comparator; sort the
+    results with plain unsigned comparators and undo it with sortable_to_fp().
+    """
+    w = pyrtl.as_wires(w)
+    return w ^ pyrtl.concat(pyrtl.Const(1), w[-1].sign_extended(len(w) - 1))
+
+
+def sortable_to_fp(w):
+    """ Inverse of fp_to_sortable().
+
+    :param Wire w: an integer produced by fp_to_sortable()
+    :return Wire: the original floating point bitpattern
+    """
+    w = pyrtl.as_wires(w)
+    return w ^ pyrtl.concat(pyrtl.Const(1), (~w[-1]).sign_extended(len(w) - 1))
+
+
+# Lane layouts of fp_add_packed's 64-bit operands, indexed by its mode wire: the
+# format of the lanes and the (low, high) bit range of each, lowest lane first.
+_Packed_lanes = (
+    ('double', ((0, 64),)),
+    ('single', ((0, 32), (32, 64))),
+    ('half', ((0, 16), (16, 32), (32, 48), (48, 64))),
+)
+_Packed_width = 64
+_Packed_chunk = 16  # every lane boundary is a multiple of this
+
+
+def _lane_of(i, mode):
+    for lo, hi in _Packed_lanes[mode][1]:
+        if lo <= i < hi:
+            return lo, hi
+
+
+def _by_mode(mode, values):
+    """ Pick one of the per-mode values, skipping the mux when they're all the same """
+    if all(v is values[0] for v in values):
+        return values[0]
+    return pyrtl.mux(mode, *values, default=values[0])
+
+
+def _lane_bits(mode, per_lane):
+    """ Spread per-lane 1-bit values across every bit of their lane.
+
+    :param per_lane: for each mode, a list with a 1-bit wire for each lane
+    :return: a wire with each bit set to the value belonging to its lane in the current mode
+    """
+    return _by_mode(mode, [
+        pyrtl.concat_list([f.sign_extended(hi - lo) for f, (lo, hi) in zip(flags, lanes)])
+        for flags, (_, lanes) in zip(per_lane, _Packed_lanes)])
+
+
+def _segmented_shift(v, mode, amounts, right):
+    """ Barrel shift every lane of v by its own amount, without bits crossing lanes.
+
+    :param amounts: for each mode, a list with the shift amount of each lane
+    :param right: if True shift right, ORing everything shifted out of a lane into
+        its lowest (sticky) bit; otherwise shift left, shifting in zeroes
+    """
+    amount_bits = max(len(a) for per_mode in amounts for a in per_mode)
+    amounts = [[a.zero_extended(amount_bits) for a in per_mode] for per_mode in amounts]
+    for k in range(amount_bits):
+        s = 2 ** k
+        ctrl = _lane_bits(mode, [[a[k] for a in per_mode] for per_mode in amounts])
+        sources = {}
+        bits = []
+        for i in range(len(v)):
+            keys = []
+            for m in range(len(_Packed_lanes)):
+                lo, hi = _lane_of(i, m)
+                src = i + s if right else i - s
+                sticky = (lo, min(lo + s, hi)) if right and i == lo else None
+                keys.append((src if lo <= src < hi else None, sticky))
+            for key in keys:
+                if key not in sources:
+                    src, sticky = key
+                    w = v[src] if src is not None else pyrtl.Const(0)
+                    if sticky is not None:
+                        w = w | pyrtl.rtl_any(*v[sticky[0]:sticky[1]])
+                    sources[key] = w
+            bits.append(pyrtl.select(ctrl[i], _by_mode(mode, [sources[k] for k in keys]), v[i]))
+        v = pyrtl.concat_list(bits)
+    return v
+
+
+def _segmented_add(a, b, mode, carry_in):
+    """ Add every lane of a and b separately, killing carries at lane boundaries.
+
+    :param carry_in: for each mode, a list with the carry into each lane
+    :return: the lane-wise sum, and the carry out of every chunk (the carry out of a
+        lane is that of its top chunk)
+    """
+    lane_cin = [dict((lo, cin) for cin, (lo, hi) in zip(cins, lanes))
+                for cins, (_, lanes) in zip(carry_in, _Packed_lanes)]
+    carry = None
+    sums, carries = [], []
+    for lo in range(0, len(a), _Packed_chunk):
+        hi = lo + _Packed_chunk
+        cin = _by_mode(mode, [cins.get(lo, carry) for cins in lane_cin])
+        total = a[lo:hi] + b[lo:hi] + cin
+        sums.append(total[:_Packed_chunk])
+        carry = total[_Packed_chunk]
+        carries.append(carry)
+    return pyrtl.concat_list(sums), carries
+
+
+def fp_add_packed(x, y, mode):
+    """ Packed (SIMD) floating point adder sharing one datapath between lanes.
+
+    :param Wire x: 64 bits holding one double, two single, or four half precision numbers
+    :param Wire y: 64 bits, packed the same way as x
+    :param Wire mode: 0 for one double lane, 1 for two single lanes, 2 for four half lanes
+        (lane 0 in the least significant bits); it can change every cycle
+    :return Wire: the lane-wise sums, packed the same way, each rounded to nearest even
+
+    The wide significand datapath (magnitude compare, alignment shifter, adder, leading
+    zero counter, normalization shifter, and rounding incrementer) is built once and
+    segmented at lane boundaries: carries are killed and shifts stop at the edges of
+    the lanes of the current mode. Only the narrow sign and exponent logic, and the
+    routing of fields in and out, exists per lane. Each lane behaves like
+    fp_add_dual_path() in its format, including zeros, infinities, and NaN.
+    """
+    x, y, mode = pyrtl.as_wires(x), pyrtl.as_wires(y), pyrtl.as_wires(mode)
+    if len(x) != _Packed_width or len(y) != _Packed_width:
+        raise pyrtl.PyrtlError("fp_add_packed operands must be %d bits" % _Packed_width)
+    n = _Packed_width
+
+    # Each lane of the significand datapath holds, from its low end: sticky, round and
+    # guard bits, the significand, and room for the carry out.
+    lanes = []
+    for m, (precision, bounds) in enumerate(_Packed_lanes):
+        fmt = _fp_format(precision)
+        for lo, hi in bounds:
+            lanes.append(dict(mode=m, fmt=fmt, lo=lo, hi=hi, p=fmt.fraction_bits + 1,
+                              x=_fp_unpack(x[lo:hi], fmt), y=_fp_unpack(y[lo:hi], fmt),
+                              x_w=x[lo:hi], y_w=y[lo:hi]))
+
+    def per_mode(f):
+        return [[f(lane) for lane in lanes if lane['mode'] == m]
+                for m in range(len(_Packed_lanes))]
+
+    def placed(lane, significand):
+        return pyrtl.concat(significand, pyrtl.Const(0, 3)).zero_extended(lane['hi'] - lane['lo'])
+
+    def gather(f):
+        return _by_mode(mode, [pyrtl.concat_list(fs) for fs in per_mode(f)])
+
+    # Magnitude compare of each lane (sign bits cleared), to put the larger operand first
+    mask = gather(lambda lane: pyrtl.Const(2 ** (lane['hi'] - lane['lo'] - 1) - 1,
+                                           lane['hi'] - lane['lo']))
+    _, carries = _segmented_add(x & mask, ~(y & mask), mode, per_mode(lambda lane: 1))
+    for lane in lanes:
+        lane['x_big'] = carries[lane['hi'] // _Packed_chunk - 1]
+
+    for lane in lanes:
+        fmt, p, lx, ly, x_big = lane['fmt'], lane['p'], lane['x'], lane['y'], lane['x_big']
+        ew = _exp_bitwidth(fmt)
+        lane['eff_sub'] = lx.sign ^ ly.sign
+        lane['sign'] = pyrtl.select(x_big, lx.sign, ly.sign)
+        e_big = pyrtl.select(x_big, lx.exponent, ly.exponent).zero_extended(ew)
+        e_small = pyrtl.select(x_big, ly.exponent, lx.exponent).zero_extended(ew)
+        d = (e_big - e_small)[:ew]
+        lane['e_big'] = e_big
+        lane['align'] = pyrtl.select(d > p + 3, pyrtl.Const(p + 3), d)[:(p + 3).bit_length()]
+
+    big_mask = _lane_bits(mode, per_mode(lambda lane: lane['x_big']))
+    sig_x = gather(lambda lane: placed(lane, lane['x'].significand))
+    sig_y = gather(lambda lane: placed(lane, lane['y'].significand))
+    big = (sig_x & big_mask) | (sig_y & ~big_mask)
+    small = (sig_y & big_mask) | (sig_x & ~big_mask)
+
+    # Align, then add or subtract (big - small is never negative)
+    small = _segmented_shift(small, mode, per_mode(lambda lane: lane['align']), right=True)
+    sub_mask = _lane_bits(mode, per_mode(lambda lane: lane['eff_sub']))
+    total, _ = _segmented_add(big, small ^ sub_mask, mode,
+                              per_mode(lambda lane: lane['eff_sub']))
+
+    # Normalize so the leading one lands where the carry out would be
+    chunk_lz = [count_zeroes_from_end(total[lo:lo + _Packed_chunk])
+                for lo in range(0, n, _Packed_chunk)]
+    for lane in lanes:
+        lz = None
+        for c in range(lane['lo'] // _Packed_chunk, lane['hi'] // _Packed_chunk):
+            # Combine the chunk counts, from the lowest chunk of the lane up
+            lz = chunk_lz[c] if lz is None else \
+                pyrtl.select(chunk_lz[c] == _Packed_chunk, chunk_lz[c] + lz, chunk_lz[c])
+        offset = lane['hi'] - lane['lo'] - 4 - lane['p']  # unused bits above the carry
+        lane['zero'] = lz == lane['hi'] - lane['lo']
+        lane['norm'] = (lz - offset)[:(lane['hi'] - lane['lo'] - 1).bit_length()]
+    total = _segmented_shift(total, mode, per_mode(lambda lane: lane['norm']), right=False)
+
+    # Round to nearest even; the guard bit is now just below the significand's lsb
+    for lane in lanes:
+        lo = lane['lo']
+        guard, lsb = total[lo + 3], total[lo + 4]
+        lane['round'] = guard & (lsb | pyrtl.rtl_any(*total[lo:lo + 3]))
+    increment = gather(lambda lane: pyrtl.concat(lane['round'], pyrtl.Const(0, 4))
+                       .zero_extended(lane['hi'] - lane['lo']))
+    total, _ = _segmented_add(total, increment, mode, per_mode(lambda lane: 0))
+
+    for lane in lanes:
+        fmt, lo, p, lx, ly = lane['fmt'], lane['lo'], lane['p'], lane['x'], lane['y']
+        ew = _exp_bitwidth(fmt)
+        carry = total[lo + 4 + p]
+        exponent = (lane['e_big'] + 1 + carry - lane['norm'])[:ew]
+        res = _fp_pack(lane['sign'], exponent, total[lo + 4:lo + 3 + p], fmt)
+
+        res = pyrtl.select(lane['zero'], pyrtl.Const(0, fmt.bitwidth), res)
+        both_zero = pyrtl.concat(lx.sign & ly.sign, pyrtl.Const(0, fmt.bitwidth - 1))
+        res = pyrtl.select(ly.is_zero, pyrtl.select(lx.is_zero, both_zero, lane['x_w']), res)
+        res = pyrtl.select(lx.is_zero & ~ly.is_zero, lane['y_w'], res)
+        res = pyrtl.select(ly.is_inf, lane['y_w'], res)
+        res = pyrtl.select(lx.is_inf, lane['x_w'], res)
+        invalid = lx.is_nan | ly.is_nan | (lx.is_inf & ly.is_inf & lane['eff_sub'])
+        lane['res'] = pyrtl.select(invalid, _fp_nan(fmt), res)
+
+    return gather(lambda lane: lane['res'])
+
+
+def fp_long_accumulator(x, valid, clear, precision='single', carry_bits=32):
+    """ Exact floating point accumulator (a Kulisch, or long, accumulator).
+
+    :param Wire x: a floating point number to add to the sum
+    :param Wire valid: when high, x is added to the sum this cycle
+    :param Wire clear: when high, the sum restarts from zero this cycle (x is still
+        added if valid is also high)
+    :param precision: an FPFormat, or the name of one (default 'single')
+    :param int carry_bits: extra integer bits above the largest finite value, so at
+        least 2 ** carry_bits maximal values can be added before the register overflows
+    :return Tuple[Wire, Wire]: the sum of everything accumulated before this cycle,
+        rounded to nearest even, and the fixed-point accumulator register itself
+
+    Each input is shifted into place in a two's complement register wide enough to
+    hold every finite value of the format exactly, so a value is accumulated every
+    cycle and the only loop-carried logic is one wide add. Normalization and rounding
+    only happen on the readout path, and the sum is exact until then (no matter the
+    order of the inputs). Infinities and NaN are remembered until the next clear;
+    overflowing the register is reported as an infinity of the sign of the input
+    that overflowed it.
+    """
+    fmt = _fp_format(precision)
+    p = fmt.fraction_bits + 1
+    eb = fmt.exponent_bits
+    # The lsb is the lsb of the smallest normal number; the largest exponent shifts the
+    # significand left by 2 ** eb - 3.
+    width = p + 2 ** eb - 3 + carry_bits + 1
+    xp = _fp_unpack(x, fmt)
+    valid, clear = pyrtl.as_wires(valid), pyrtl.as_wires(clear)
+
+    acc = pyrtl.Register(width)
+    pos_inf, neg_inf, nan = pyrtl.Register(1), pyrtl.Register(1), pyrtl.Register(1)
+
+    finite = valid & ~xp.is_zero & ~xp.is_inf & ~xp.is_nan
+    shift = (xp.exponent - 1)[:eb]
+    fixed = pyrtl.shift_left_logical(xp.significand.zero_extended(width), shift)
+    addend = pyrtl.select(finite, pyrtl.select(xp.sign, (~fixed + 1)[:width], fixed),
+                          pyrtl.Const(0, width))
+    base = pyrtl.select(clear, pyrtl.Const(0, width), acc)
+    total = (base + addend)[:width]
+    overflow = finite & (base[-1] == addend[-1]) & (total[-1] != base[-1])
+
+    acc.next <<= total
+    keep = ~clear
+    pos_inf.next <<= (keep & pos_inf) | (valid & xp.is_inf & ~xp.sign) | (overflow & ~xp.sign)
+    neg_inf.next <<= (keep & neg_inf) | (valid & xp.is_inf & xp.sign) | (overflow & xp.sign)
+    nan.next <<= (keep & nan) | (valid & xp.is_nan)
+
+    # Readout: normalize and round the register
+    sign = acc[-1]
+    magnitude = pyrtl.select(sign, (~acc + 1)[:width], acc)
+    lz = count_zeroes_from_end(magnitude)
+    significand = pyrtl.shift_left_logical(magnitude, lz)
+    ew = max(_exp_bitwidth(fmt), width.bit_length() + 2)
+    exponent = (pyrtl.Const(width - fmt.fraction_bits, ew) - lz)[:ew]
+    res = _fp_round_and_pack(sign, _fp_clamp_exponent(exponent, fmt), significand, fmt)
+
+    res = pyrtl.select(magnitude == 0, pyrtl.Const(0, fmt.bitwidth), res)
+    res = pyrtl.select(pos_inf, _fp_inf(pyrtl.Const(0), fmt), res)
+    res = pyrtl.select(neg_inf, _fp_inf(pyrtl.Const(1), fmt), res)
+    res = pyrtl.select(nan | (pos_inf & neg_inf), _fp_nan(fmt), res)
+    return res, acc
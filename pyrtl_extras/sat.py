@@ -0,0 +1,357 @@
+import collections
+import heapq
+import pyrtl
+
+from .bitsliced import _GateBuilder, _lower
+
+try:
+    import pycosat
+except ImportError:
+    pycosat = None
+
+
+def _luby(i):
+    """ The i-th term (from 0) of the Luby sequence 1, 1, 2, 1, 1, 2, 4, ... """
+    size, seq = 1, 0
+    while size < i + 1:
+        seq += 1
+        size = 2 * size + 1
+    while size - 1 != i:
+        size = (size - 1) >> 1
+        seq -= 1
+        i %= size
+    return 1 << seq
+
+
+class _CDCLSolver(object):
+    """ A small conflict driven clause learning SAT solver.
+
+    Literals are nonzero ints as in DIMACS: v for variable v, -v for its negation.
+    It has two watched literals per clause, first-UIP learning with clause
+    minimization, VSIDS-like activities, phase saving and Luby restarts, which is
+    plenty for the netlists here. Clauses can be added between calls to solve(), and
+    solve() takes assumptions, which is what bounded model checking needs.
+    """
+
+    def __init__(self):
+        self.nvars = 0
+        self.value = [0]  # per variable: 1 true, -1 false, 0 unassigned
+        self.level = [0]
+        self.reason = [None]
+        self.activity = [0.0]
+        self.phase = [False]
+        self.seen = [False]
+        self.watches = collections.defaultdict(list)
+        self.trail, self.trail_lim, self.qhead = [], [], 0
+        self.heap = []
+        self.var_inc = 1.0
+        self.ok = True
+        self.conflicts = 0
+
+    def _ensure_vars(self, n):
+        while self.nvars < n:
+            self.nvars += 1
+            for a, x in ((self.value, 0), (self.level, 0), (self.reason, None),
+                         (self.activity, 0.0), (self.phase, False), (self.seen, False)):
+                a.append(x)
+            heapq.heappush(self.heap, (0.0, self.nvars))
+
+    def _lit_value(self, lit):
+        v = self.value[lit] if lit > 0 else -self.value[-lit]
+        return v
+
+    def _enqueue(self, lit, reason):
+        v = abs(lit)
+        self.value[v] = 1 if lit > 0 else -1
+        self.level[v] = len(self.trail_lim)
+        self.reason[v] = reason
+        self.trail.append(lit)
+
+    def add_clause(self, clause):
+        """ Add a clause (a list of literals); returns False once the clauses are
+        known to be unsatisfiable """
+        if not self.ok:
+            return False
+        self._backtrack(0)
+        self._ensure_vars(max((abs(lit) for lit in clause), default=0))
+        lits = []
+        for lit in set(clause):
+            if -lit in lits or self._lit_value(lit) == 1:
+                return True
+            if self._lit_value(lit) == 0:
+                lits.append(lit)
+        if not lits:
+            self.ok = False
+        elif len(lits) == 1:
+            self._enqueue(lits[0], None)
+            self.ok = self._propagate() is None
+        else:
+            self.watches[lits[0]].append(lits)
+            self.watches[lits[1]].append(lits)
+        return self.ok
+
+    def _propagate(self):
+        """ Unit propagation; returns a conflicting clause, or None """
+        value, watches, trail = self.value, self.watches, self.trail
+        while self.qhead < len(trail):
+            false_lit = -trail[self.qhead]
+            self.qhead += 1
+            ws = watches[false_lit]
+            kept = []
+            for idx, c in enumerate(ws):
+                if c[0] == false_lit:
+                    c[0], c[1] = c[1], c[0]
+                first = c[0]
+                first_value = value[first] if first > 0 else -value[-first]
+                if first_value == 1:
+                    kept.append(c)
+                    continue
+                for k in range(2, len(c)):
+                    lit = c[k]
+                    if (value[lit] if lit > 0 else -value[-lit]) != -1:
+                        c[1], c[k] = lit, false_lit
+                        watches[lit].append(c)
+                        break
+                else:
+                    kept.append(c)
+                    if first_value == -1:
+                        kept.extend(ws[idx + 1:])
+                        watches[false_lit] = kept
+                        return c
+                    self._enqueue(first, c)
+            watches[false_lit] = kept
+        return None
+
+    def _bump(self, v):
+        self.activity[v] += self.var_inc
+        if self.activity[v] > 1e100:
+            self.activity = [a * 1e-100 for a in self.activity]
+            self.var_inc *= 1e-100
+            self.heap = [(-self.activity[u], u) for u in range(1, self.nvars + 1)
+                         if self.value[u] == 0]
+            heapq.heapify(self.heap)
+        if self.value[v] == 0:
+            heapq.heappush(self.heap, (-self.activity[v], v))
+
+    def _analyze(self, confl):
+        """ First-UIP conflict analysis; returns the learnt clause (with the asserting
+        literal first) and the level to go back to """
+        seen, level, reason, trail = self.seen, self.level, self.reason, self.trail
+        current = len(self.trail_lim)
+        learnt, counter, p, idx = [None], 0, None, len(trail) - 1
+        while True:
+            for q in (confl if p is None else confl[1:]):
+                v = abs(q)
+                if not seen[v] and level[v] > 0:
+                    seen[v] = True
+                    self._bump(v)
+                    if level[v] >= current:
+                        counter += 1
+                    else:
+                        learnt.append(q)
+            while not seen[abs(trail[idx])]:
+                idx -= 1
+            p = trail[idx]
+            idx -= 1
+            confl = reason[abs(p)]
+            seen[abs(p)] = False
+            counter -= 1
+            if counter == 0:
+                break
+        learnt[0] = -p
+
+        # Drop literals implied by the others
+        def redundant(q):
+            r = reason[abs(q)]
+            return r is not None and all(seen[abs(x)] or level[abs(x)] == 0 for x in r[1:])
+        minimized = [learnt[0]] + [q for q in learnt[1:] if not redundant(q)]
+        for q in learnt[1:]:
+            seen[abs(q)] = False
+
+        if len(minimized) == 1:
+            return minimized, 0
+        i = max(range(1, len(minimized)), key=lambda i: level[abs(minimized[i])])
+        minimized[1], minimized[i] = minimized[i], minimized[1]
+        return minimized, level[abs(minimized[1])]
+
+    def _backtrack(self, to_level):
+        if len(self.trail_lim) <= to_level:
+            return
+        start = self.trail_lim[to_level]
+        for lit in self.trail[start:]:
+            v = abs(lit)
+            self.value[v] = 0
+            self.reason[v] = None
+            self.phase[v] = lit > 0
+            heapq.heappush(self.heap, (-self.activity[v], v))
+        del self.trail[start:]
+        del self.trail_lim[to_level:]
+        self.qhead = len(self.trail)
+
+    def _pick(self):
+        while self.heap:
+            _, v = heapq.heappop(self.heap)
+            if self.value[v] == 0:
+                return v
+        return None
+
+    def solve(self, assumptions=()):
+        """ :return: a list of the value (True or False) of each variable, indexed by
+            variable, if the clauses and assumptions are satisfiable, else None """
+        if not self.ok:
+            return None
+        self._ensure_vars(max((abs(lit) for lit in assumptions), default=0))
+        self._backtrack(0)
+        restarts, budget = 0, 100 * _luby(0)
+        while True:
+            confl = self._propagate()
+            if confl is not None:
+                self.conflicts += 1
+                budget -= 1
+                if not self.trail_lim:
+                    self.ok = False
+                    return None
+                learnt, back_to = self._analyze(confl)
+                self._backtrack(back_to)
+                if len(learnt) == 1:
+                    self._enqueue(learnt[0], None)
+                else:
+                    self.watches[learnt[0]].append(learnt)
+                    self.watches[learnt[1]].append(learnt)
+                    self._enqueue(learnt[0], learnt)
+                self.var_inc /= 0.95
+                continue
+            if budget <= 0:
+                restarts += 1
+                budget = 100 * _luby(restarts)
+                self._backtrack(0)
+                continue
+            if len(self.trail_lim) < len(assumptions):
+                lit = assumptions[len(self.trail_lim)]
+                val = self._lit_value(lit)
+                if val == -1:
+                    self._backtrack(0)
+                    return None
+                self.trail_lim.append(len(self.trail))
+                if val == 0:
+                    self._enqueue(lit, None)
+                continue
+            v = self._pick()
+            if v is None:
+                model = [v == 1 for v in self.value]
+                self._backtrack(0)
+                return model
+            self.trail_lim.append(len(self.trail))
+            self._enqueue(v if self.phase[v] else -v, None)
+
+
+_Solvers = ('auto', 'cdcl', 'pycosat')
+
+
+class _Tseitin(_GateBuilder):
+    """ Tseitin encoding of gates into CNF, a new variable per gate.
+
+    Variable 1 is the constant true. Gates are folded with constants and shared
+    when they have the same inputs (up to order and negation), so that structurally
+    identical parts of a miter collapse into the same variables.
+    """
+
+    def __init__(self, solver='auto'):
+        if solver not in _Solvers:
+            raise pyrtl.PyrtlError("solver must be one of %s"
+                                   % ", ".join("'%s'" % s for s in _Solvers))
+        if solver == 'pycosat' and pycosat is None:
+            raise pyrtl.PyrtlError("solver='pycosat' needs the pycosat package")
+        self.use_pycosat = solver == 'pycosat' or (solver == 'auto' and pycosat is not None)
+        self.one, self.zero = 1, -1
+        self.nvars = 1
+        self.clauses = [[1]]
+        self.gates = {}
+        self.solver = None
+        self.added = 0
+
+    def new_var(self):
+        self.nvars += 1
+        return self.nvars
+
+    def new_vars(self, n):
+        return [self.new_var() for _ in range(n)]
+
+    def not_(self, a):
+        return -a
+
+    def and_(self, a, b):
+        if a == self.zero or b == self.zero or a == -b:
+            return self.zero
+        if a == self.one or a == b:
+            return b
+        if b == self.one:
+            return a
+        key = ('&', min(a, b), max(a, b))
+        if key not in self.gates:
+            c = self.gates[key] = self.new_var()
+            self.clauses += [[-c, a], [-c, b], [c, -a, -b]]
+        return self.gates[key]
+
+    def or_(self, a, b):
+        return -self.and_(-a, -b)
+
+    def xor(self, a, b):
+        if abs(a) == 1 or abs(b) == 1:
+            if abs(a) == 1:
+                a, b = b, a
+            return a if b == self.zero else -a
+        if a == b or a == -b:
+            return self.zero if a == b else self.one
+        # xor(-a, b) == -xor(a, b)
+        sign = (a < 0) != (b < 0)
+        a, b = sorted((abs(a), abs(b)))
+        key = ('^', a, b)
+        if key not in self.gates:
+            c = self.gates[key] = self.new_var()
+            self.clauses += [[-c, a, b], [-c, -a, -b], [c, -a, b], [c, a, -b]]
+        return -self.gates[key] if sign else self.gates[key]
+
+    def mux(self, sel, f, t):
+        if sel == self.one or sel == self.zero or f == t:
+            return t if sel == self.one or f == t else f
+        if sel < 0:
+            sel, f, t = -sel, t, f
+        key = ('?', sel, f, t)
+        if key not in self.gates:
+            c = self.gates[key] = self.new_var()
+            self.clauses += [[-sel, -t, c], [-sel, t, -c], [sel, -f, c], [sel, f, -c],
+                             [-f, -t, c], [f, t, -c]]
+        return self.gates[key]
+
+    def solve(self, assumptions=()):
+        """ Solve the clauses so far under the assumptions (literals taken to be true).
+
+        :return: a function giving the value (True or False) of a literal in a
+            satisfying assignment, or None if there isn't one
+        """
+        if self.use_pycosat:
+            res = pycosat.solve(self.clauses + [[lit] for lit in assumptions],
+                                vars=self.nvars)
+            if res in ('UNSAT', 'UNKNOWN'):
+                return None
+            model = [False] + [lit > 0 for lit in res]
+        else:
+            if self.solver is None:
+                self.solver = _CDCLSolver()
+            for clause in self.clauses[self.added:]:
+                self.solver.add_clause(clause)
+            self.added = len(self.clauses)
+            model = self.solver.solve(list(assumptions))
+            if model is None:
+                return None
+            model += [False] * (self.nvars + 1 - len(model))
+        return lambda lit: model[lit] if lit > 0 else not model[-lit]
+
+    def value(self, bits, model):
+        """ The value of a list of bits (least significant first) in a model """
+        return sum(model(b) << k for k, b in enumerate(bits))
+
+    def lower(self, block, sources):
+        """ Encode a block; see bitsliced._lower() """
+        return _lower(block, self, sources)
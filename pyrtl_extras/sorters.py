@@ -1,5 +1,11 @@
+import collections
+import functools
+import itertools
+import random
 import pyrtl
 
+from .floating_point import fp_to_sortable, sortable_to_fp
+
 
 class _BitonicSorter:
     """ Only created this class to store the `signed` attribute
@@ -9,57 +15,720 @@ class _BitonicSorter:
     def __init__(self, signed=False):
         self.signed = signed
 
+    def lt(self, a, b):
+        return pyrtl.signed_lt(a, b) if self.signed else a < b
+
     def comp(self, a, b):
-        lt = pyrtl.signed_lt(a, b) if self.signed else a < b
+        lt = self.lt(a, b)
         low = pyrtl.select(lt, a, b)
         high = pyrtl.select(lt, b, a)
         return low, high
 
-    def split(self, *args):
-        mid = len(args) // 2
-        return args[:mid], args[mid:]
-
-    def cleaner(self, *args):
-        upper, lower = self.split(*args)
-        res = [self.comp(*t) for t in zip(upper, lower)]
-        new_upper = tuple(t[0] for t in res)
-        new_lower = tuple(t[1] for t in res)
-        return new_upper, new_lower
-
-    def crossover(self, *args):
-        upper, lower = self.split(*args)
-        res = [self.comp(*t) for t in zip(upper, lower[::-1])]
-        new_upper = tuple(t[0] for t in res)
-        new_lower = tuple(t[1] for t in res[::-1])
-        return new_upper, new_lower
-
-    def merge_network(self, *args):
-        if len(args) == 1:
-            return args
-        upper, lower = self.cleaner(*args)
-        return self.merge_network(*upper) + self.merge_network(*lower)
-
-    def block(self, *args):
-        upper, lower = self.crossover(*args)
-        if len(upper + lower) == 2:
-            return upper + lower
-        return self.merge_network(*upper) + self.merge_network(*lower)
-
-    def bitonic_helper(self, *args):
-        if len(args) == 1:
-            return args
-        else:
-            upper, lower = self.split(*args)
-            new_upper = self.bitonic_helper(*upper)
-            new_lower = self.bitonic_helper(*lower)
-            return self.block(*new_upper + new_lower)
-
-
-def bitonic_sort(*args, signed=False):
+    def comp_records(self, a, b):
+        """ Like comp(), on (key, payload) pairs compared by key alone """
+        lt = self.lt(a[0], b[0])
+        low = tuple(pyrtl.select(lt, x, y) for x, y in zip(a, b))
+        high = tuple(pyrtl.select(lt, y, x) for x, y in zip(a, b))
+        return low, high
+
+
+# Best known sorting networks for small numbers of inputs (fewest comparators, see
+# Knuth, TAOCP vol. 3, 5.3.4), one list of comparators per layer. A comparator (i, j)
+# leaves the smaller value on i. The 14 and 15 input networks are the 16 input one
+# with its lowest lanes removed.
+_Best_networks = {
+    2: [[(0, 1)]],
+    3: [[(0, 2)], [(0, 1)], [(1, 2)]],
+    4: [[(0, 1), (2, 3)], [(0, 2), (1, 3)], [(1, 2)]],
+    5: [[(0, 3), (1, 4)], [(0, 2), (1, 3)], [(0, 1), (2, 4)], [(1, 2), (3, 4)], [(2, 3)]],
+    6: [[(0, 5), (1, 3), (2, 4)], [(1, 2), (3, 4)], [(0, 3), (2, 5)], [(0, 1), (2, 3), (4, 5)],
+        [(1, 2), (3, 4)]],
+    7: [[(0, 6), (2, 3), (4, 5)], [(0, 2), (1, 4), (3, 6)], [(0, 1), (2, 5), (3, 4)],
+        [(1, 2), (4, 6)], [(2, 3), (4, 5)], [(1, 2), (3, 4), (5, 6)]],
+    8: [[(0, 2), (1, 3), (4, 6), (5, 7)], [(0, 4), (1, 5), (2, 6), (3, 7)],
+        [(0, 1), (2, 3), (4, 5), (6, 7)], [(2, 4), (3, 5)], [(1, 4), (3, 6)],
+        [(1, 2), (3, 4), (5, 6)]],
+    9: [[(0, 3), (1, 7), (2, 5), (4, 8)], [(0, 7), (2, 4), (3, 8), (5, 6)],
+        [(0, 2), (1, 3), (4, 5), (7, 8)], [(1, 4), (3, 6), (5, 7)],
+        [(0, 1), (2, 4), (3, 5), (6, 8)], [(2, 3), (4, 5), (6, 7)], [(1, 2), (3, 4), (5, 6)]],
+    10: [[(0, 8), (1, 9), (2, 7), (3, 5), (4, 6)], [(0, 2), (1, 4), (5, 8), (7, 9)],
+         [(0, 3), (2, 4), (5, 7), (6, 9)], [(0, 1), (3, 6), (8, 9)],
+         [(1, 5), (2, 3), (4, 8), (6, 7)], [(1, 2), (3, 5), (4, 6), (7, 8)],
+         [(2, 3), (4, 5), (6, 7)], [(3, 4), (5, 6)]],
+    11: [[(0, 9), (1, 6), (2, 4), (3, 7), (5, 8)], [(0, 1), (3, 5), (4, 10), (6, 9), (7, 8)],
+         [(1, 3), (2, 5), (4, 7), (8, 10)], [(0, 4), (1, 2), (3, 7), (5, 9), (6, 8)],
+         [(0, 1), (2, 6), (4, 5), (7, 8), (9, 10)], [(2, 4), (3, 6), (5, 7), (8, 9)],
+         [(1, 2), (3, 4), (5, 6), (7, 8)], [(2, 3), (4, 5), (6, 7)]],
+    12: [[(0, 8), (1, 7), (2, 6), (3, 11), (4, 10), (5, 9)],
+         [(0, 1), (2, 5), (3, 4), (6, 9), (7, 8), (10, 11)], [(0, 2), (1, 6), (5, 10), (9, 11)],
+         [(0, 3), (1, 2), (4, 6), (5, 7), (8, 11), (9, 10)], [(1, 4), (3, 5), (6, 8), (7, 10)],
+         [(1, 3), (2, 5), (6, 9), (8, 10)], [(2, 3), (4, 5), (6, 7), (8, 9)], [(4, 6), (5, 7)],
+         [(3, 4), (5, 6), (7, 8)]],
+    13: [[(0, 12), (1, 10), (2, 9), (3, 7), (5, 11), (6, 8)],
+         [(1, 6), (2, 3), (4, 11), (7, 9), (8, 10)],
+         [(0, 4), (1, 2), (3, 6), (7, 8), (9, 10), (11, 12)], [(4, 6), (5, 9), (8, 11), (10, 12)],
+         [(0, 5), (3, 8), (4, 7), (6, 11), (9, 10)], [(0, 1), (2, 5), (6, 9), (7, 8), (10, 11)],
+         [(1, 3), (2, 4), (5, 6), (9, 10)], [(1, 2), (3, 4), (5, 7), (6, 8)],
+         [(2, 3), (4, 5), (6, 7), (8, 9)], [(3, 4), (5, 6)]],
+    14: [[(0, 13), (1, 12), (2, 6), (3, 4), (5, 9), (7, 8)],
+         [(0, 7), (1, 2), (4, 11), (6, 12), (8, 13), (9, 10)],
+         [(0, 1), (2, 3), (4, 6), (5, 7), (8, 9), (10, 11), (12, 13)],
+         [(2, 8), (3, 9), (4, 5), (6, 7), (10, 12), (11, 13)],
+         [(1, 10), (2, 4), (3, 5), (6, 8), (7, 9), (11, 12)],
+         [(0, 4), (3, 6), (5, 8), (7, 11), (9, 12)], [(0, 2), (1, 4), (7, 10), (9, 11)],
+         [(1, 3), (4, 6), (5, 7), (8, 10)], [(1, 2), (3, 4), (5, 6), (7, 8), (9, 10)],
+         [(4, 5), (6, 7)]],
+    15: [[(0, 11), (1, 14), (2, 13), (3, 7), (4, 5), (6, 10), (8, 9)],
+         [(0, 6), (1, 8), (2, 3), (5, 12), (7, 13), (9, 14), (10, 11)],
+         [(1, 2), (3, 4), (5, 7), (6, 8), (9, 10), (11, 12), (13, 14)],
+         [(0, 2), (3, 9), (4, 10), (5, 6), (7, 8), (11, 13), (12, 14)],
+         [(0, 1), (2, 11), (3, 5), (4, 6), (7, 9), (8, 10), (12, 13)],
+         [(0, 3), (1, 5), (4, 7), (6, 9), (8, 12), (10, 13)], [(1, 3), (2, 5), (8, 11), (10, 12)],
+         [(2, 4), (5, 7), (6, 8), (9, 11)], [(2, 3), (4, 5), (6, 7), (8, 9), (10, 11)],
+         [(5, 6), (7, 8)]],
+    16: [[(0, 13), (1, 12), (2, 15), (3, 14), (4, 8), (5, 6), (7, 11), (9, 10)],
+         [(0, 5), (1, 7), (2, 9), (3, 4), (6, 13), (8, 14), (10, 15), (11, 12)],
+         [(0, 1), (2, 3), (4, 5), (6, 8), (7, 9), (10, 11), (12, 13), (14, 15)],
+         [(0, 2), (1, 3), (4, 10), (5, 11), (6, 7), (8, 9), (12, 14), (13, 15)],
+         [(1, 2), (3, 12), (4, 6), (5, 7), (8, 10), (9, 11), (13, 14)],
+         [(1, 4), (2, 6), (5, 8), (7, 10), (9, 13), (11, 14)], [(2, 4), (3, 6), (9, 12), (11, 13)],
+         [(3, 5), (6, 8), (7, 9), (10, 12)], [(3, 4), (5, 6), (7, 8), (9, 10), (11, 12)],
+         [(6, 7), (8, 9)]],
+}
+
+
+def _odd_even_merge_network(n):
+    """ Comparators of Batcher's odd-even merge sort on n (a power of 2) inputs """
+    comparators = []
+    # p is the size of the sorted runs being merged, k the distance compared in the
+    # current step of the merge; comparators across two runs of size 2p are skipped
+    p = 1
+    while p < n:
+        k = p
+        while k >= 1:
+            for j in range(k % p, n - k, 2 * k):
+                comparators.extend((i + j, i + j + k) for i in range(min(k, n - j - k))
+                                   if (i + j) // (2 * p) == (i + j + k) // (2 * p))
+            k //= 2
+        p *= 2
+    return comparators
+
+
+def _bitonic_network(n):
+    """ Comparators of the bitonic sorter on n (a power of 2) inputs """
+    comparators = []
+    # Each block of size k holds two sorted halves; comparing them crossed over (the
+    # first with the last, ...) leaves both halves bitonic, and half-cleaners of
+    # decreasing span then sort them, so every comparator puts the smaller value first
+    k = 2
+    while k <= n:
+        for base in range(0, n, k):
+            comparators.extend((base + i, base + k - 1 - i) for i in range(k // 2))
+        span = k // 4
+        while span >= 1:
+            for base in range(0, n, 2 * span):
+                comparators.extend((base + i, base + i + span) for i in range(span))
+            span //= 2
+        k *= 2
+    return comparators
+
+
+def _prune(comparators, n, size):
+    """ Cut a sorting network on size inputs down to its first n lanes.
+
+    The lanes from n up are treated as padding holding +inf. A comparator whose
+    larger side is padding never does anything, and one whose smaller side is
+    padding always swaps, so neither needs hardware: the swap is done by renaming
+    lanes instead. The result sorts n inputs.
+    """
+    holder = list(range(n)) + [None] * (size - n)
+    kept = []
+    for i, j in comparators:
+        if holder[i] is not None and holder[j] is not None:
+            kept.append((holder[i], holder[j]))
+        elif holder[j] is not None:
+            holder[i], holder[j] = holder[j], holder[i]
+    # The padding ends up on the top lanes, so the k-th smallest value ends up on the
+    # lane that was holder[k]; number the lanes to match.
+    position = {holder[k]: k for k in range(n)}
+    return [(position[i], position[j]) for i, j in kept]
+
+
+@functools.lru_cache(maxsize=None)
+def _network(n, algorithm):
+    """ Comparators of a sorting network on n inputs, as a tuple (computed once) """
+    if algorithm == 'optimal':
+        return tuple(c for layer in _Best_networks.get(n, []) for c in layer)
+    size = 1 << (n - 1).bit_length()
+    if algorithm == 'bitonic':
+        comparators = _bitonic_network(size)
+    else:
+        comparators = _odd_even_merge_network(size)
+    return tuple(comparators if size == n else _prune(comparators, n, size))
+
+
+def _run_network(comparators, args, comp):
+    wires = list(args)
+    for i, j in comparators:
+        wires[i], wires[j] = comp(wires[i], wires[j])
+    return tuple(wires)
+
+
+_Algorithms = ('bitonic', 'odd_even_merge', 'optimal')
+
+
+def _check_operand_args(name, n, signed, key):
+    if n == 0:
+        raise pyrtl.PyrtlError("%s requires at least one argument to sort" % name)
+    if key not in (None, 'fp'):
+        raise pyrtl.PyrtlError("key must be None or 'fp'")
+    if key == 'fp' and signed:
+        raise pyrtl.PyrtlError("signed does not apply to key='fp'")
+
+
+def _check_sort_args(name, n, signed, key, algorithm):
+    _check_operand_args(name, n, signed, key)
+    if algorithm not in _Algorithms:
+        raise pyrtl.PyrtlError("algorithm must be one of %s"
+                               % ", ".join("'%s'" % name for name in _Algorithms))
+    if algorithm == 'optimal' and n > max(_Best_networks):
+        raise pyrtl.PyrtlError("no best known network for %d arguments (only up to %d)"
+                               % (n, max(_Best_networks)))
+
+
+def _layers(comparators):
+    """ Group comparators into layers, each as early as its inputs allow """
+    layers, depth = [], {}
+    for i, j in comparators:
+        d = max(depth.get(i, 0), depth.get(j, 0))
+        if d == len(layers):
+            layers.append([])
+        layers[d].append((i, j))
+        depth[i] = depth[j] = d + 1
+    return layers
+
+
+@functools.lru_cache(maxsize=None)
+def sorting_network(n, algorithm='odd_even_merge'):
+    """ The comparator schedule that sort() builds for n inputs.
+
+    :param int n: the number of inputs
+    :param algorithm: 'bitonic', 'odd_even_merge' (default) or 'optimal' (see sort())
+    :return: tuple of (i, j, ascending) comparators, in an order they can be applied
+        in, with i < j; ascending is True if the smaller value goes to lane i
+
+    The schedules are generated iteratively and cached per size and algorithm, so
+    they are cheap to ask for again, even for thousands of inputs. Every network
+    here puts the smaller value on the lower lane; the direction is included so the
+    schedule can be used as is, e.g. by a software model or another backend.
+    """
+    _check_sort_args('sorting_network', n, False, None, algorithm)
+    return tuple((min(i, j), max(i, j), i < j) for i, j in _network(n, algorithm))
+
+
+def sort(*args, signed=False, key=None, algorithm='odd_even_merge', payloads=None):
+    """ Sort the wires given, smallest first, with a sorting network.
+
+    :param args: the WireVectors to sort
+    :param signed: if True, compare them as two's complement numbers
+    :param key: None to compare the wires as integers, or 'fp' to compare them
+        as floating point numbers (of any format)
+    :param algorithm: which network to build:
+        'bitonic' (n/4 log n (log n + 1) comparators for a power of 2 inputs),
+        'odd_even_merge' (Batcher's odd-even merge sort, the same depth as bitonic
+        but fewer comparators: 63 rather than 80 for 16 inputs), or 'optimal' (up
+        to 16 inputs; the best known network, e.g. 60 comparators for 16 inputs)
+    :param payloads: optional WireVectors, one per arg, to carry along with the
+        args without being compared
+    :return: tuple of the sorted WireVectors, or if payloads are given, a tuple of
+        the sorted args and a tuple of their payloads in the same order
+
+    Any number of inputs can be sorted. For bitonic and odd_even_merge, a network
+    for the next power of 2 is built as if the extra inputs were padding larger
+    than every value, and every comparator that touches the padding is left out,
+    e.g. 24 inputs take 132 comparators with odd_even_merge instead of the 191
+    of a padded 32 input network.
+
+    With key='fp', each value is mapped once on the way in and once on the way
+    out (see fp_to_sortable()), so every comparator in between is a plain
+    unsigned compare. NaNs sort to the ends: those with the sign bit set below
+    -inf, the others above +inf.
+
+    To sort wide records, pass the part to sort by as args and the rest as payloads:
+    the comparators are then only as wide as the keys. Wide payloads still go through
+    a mux at every comparator, so if they can be fetched afterwards (e.g. from a
+    memory), argsort() carries just their indices instead.
+    """
+    n = len(args)
+    _check_sort_args('sort', n, signed, key, algorithm)
+    if payloads is not None and len(payloads) != n:
+        raise pyrtl.PyrtlError("sort needs exactly one payload per argument")
+
+    if key == 'fp':
+        args = tuple(fp_to_sortable(w) for w in args)
+    bs = _BitonicSorter(signed=signed)
+    if payloads is None:
+        res = _run_network(_network(n, algorithm), args, bs.comp)
+    else:
+        records = list(zip(args, (pyrtl.as_wires(p) for p in payloads)))
+        records = _run_network(_network(n, algorithm), records, bs.comp_records)
+        res, payloads = tuple(r[0] for r in records), tuple(r[1] for r in records)
+    if key == 'fp':
+        res = tuple(sortable_to_fp(w) for w in res)
+    return res if payloads is None else (res, payloads)
+
+
+def bitonic_sort(*args, signed=False, key=None, payloads=None):
+    """ Sort the wires given, smallest first, with a bitonic sorting network.
+
+    Same as sort(*args, signed=signed, key=key, algorithm='bitonic', payloads=payloads).
+    """
     if len(args) == 0:
         raise pyrtl.PyrtlError("bitonic_sort requires at least one argument to sort")
-    if len(args) & (len(args) - 1) != 0:
-        raise pyrtl.PyrtlError("number of arguments to bitonic_sort must be a power of 2")
+    return sort(*args, signed=signed, key=key, algorithm='bitonic', payloads=payloads)
+
+
+def argsort(*args, signed=False, key=None, algorithm='odd_even_merge'):
+    """ The permutation that sorts the wires given.
+
+    :param args: the WireVectors to sort
+    :param signed: if True, compare them as two's complement numbers
+    :param key: None or 'fp' (see sort())
+    :param algorithm: 'bitonic', 'odd_even_merge' (default) or 'optimal' (see sort())
+    :return: tuple of index WireVectors: the i-th is the position in args of the
+        i-th smallest value (ties in no particular order)
+
+    Only the indices (log2 n bits each) travel through the network with the keys,
+    so payloads can be gathered once afterwards, e.g. with pyrtl.mux(index, *payloads)
+    or by reading them from a memory.
+    """
+    n = len(args)
+    _check_sort_args('argsort', n, signed, key, algorithm)
+    indices = [pyrtl.Const(i, max(1, (n - 1).bit_length())) for i in range(n)]
+    return sort(*args, signed=signed, key=key, algorithm=algorithm, payloads=indices)[1]
+
+
+def _mixed_digits(v, digits):
+    res = []
+    for _, radix in digits:
+        v, d = divmod(v, radix)
+        res.append(d)
+    return res
+
+
+def _binary_inputs(n, pairs, chunk_size=1 << 18):
+    """ Every binary input to n lanes, as it is after the disjoint comparators in pairs.
+
+    Each pair can then only hold 00, 01 or 11, which leaves 3 rather than 4 cases to
+    check per pair. The inputs are numbered in mixed radix (a digit per pair or lone
+    lane) and handed out a chunk at a time.
+
+    :return: generator of (lanes, decode): bit v of lanes[k] is lane k of input v of
+        the chunk, and decode(v) gives that input as a list of bits
+    """
+    paired = {lane for pair in pairs for lane in pair}
+    digits = [(tuple(pair), 3) for pair in pairs]
+    digits += [((k,), 2) for k in range(n) if k not in paired]
+    low, size = 0, 1
+    while low < len(digits) and size * digits[low][1] <= chunk_size:
+        size *= digits[low][1]
+        low += 1
+
+    # The low digits go through the same values in every chunk
+    ones = (1 << size) - 1
+    low_lanes, stride = [0] * n, 1
+    for lanes, radix in digits[:low]:
+        period = radix * stride
+        repeat = ones // ((1 << period) - 1)
+        for q, lane in enumerate(lanes):
+            # lane is 1 for digit values from radix - 1 - q up
+            start = (radix - 1 - q) * stride
+            low_lanes[lane] = (((1 << period) - 1) >> start << start) * repeat
+        stride = period
+
+    def values(lanes, radix, d):
+        return [int(d >= radix - 1 - q) for q in range(len(lanes))]
+
+    for high in itertools.product(*(range(radix) for _, radix in digits[low:])):
+        chunk = list(low_lanes)
+        for (lanes, radix), d in zip(digits[low:], high):
+            for lane, value in zip(lanes, values(lanes, radix, d)):
+                chunk[lane] = ones if value else 0
+
+        def decode(v, high=high):
+            bits = [0] * n
+            for (lanes, radix), d in zip(digits, _mixed_digits(v, digits[:low]) + list(high)):
+                for lane, value in zip(lanes, values(lanes, radix, d)):
+                    bits[lane] = value
+            return bits
+        yield chunk, decode
+
+
+def _check_netlist(comparators, n, samples):
+    """ Simulate the network built on 1-bit wires; return a sample it doesn't sort """
+    with pyrtl.set_working_block(pyrtl.Block()):
+        ins = [pyrtl.Input(1, 'in%d' % k) for k in range(n)]
+        for k, w in enumerate(_run_network(comparators, ins, _BitonicSorter().comp)):
+            out = pyrtl.Output(1, 'out%d' % k)
+            out <<= w
+        sim = pyrtl.FastSimulation()
+        sim.step_multiple({'in%d' % k: [v >> k & 1 for v in samples] for k in range(n)})
+        trace = sim.tracer.trace
+    for step, v in enumerate(samples):
+        zeros = n - bin(v).count('1')
+        if any(trace['out%d' % k][step] != (k >= zeros) for k in range(n)):
+            return v
+    return None
+
 
+def verify_sorting_network(n, algorithm='odd_even_merge', schedule=None, netlist_samples=256):
+    """ Prove that a sorting network sorts, by checking it on every binary input.
+
+    :param int n: the number of inputs
+    :param algorithm: which of sort()'s networks to check (see sorting_network())
+    :param schedule: a schedule of (i, j, ascending) comparators to check instead
+    :param netlist_samples: how many binary inputs (chosen at random) to also
+        simulate through the network built from PyRTL wires
+    :return: None if it sorts, otherwise a list of n bits it doesn't sort
+
+    By the 0-1 principle, a comparator network sorts every input if it sorts all
+    2**n inputs made of 0s and 1s. These are checked a chunk at a time, with bit v
+    of an integer per lane standing for input v, so each comparator is just an AND
+    (the min) and an OR (the max) over some 2**18 inputs at once. The first layer of
+    comparators is folded into how the inputs are enumerated, which leaves 3**(n/2)
+    rather than 2**n of them, so n = 28 takes well under a second. The netlist check
+    catches mistakes in turning a schedule into hardware rather than in the schedule.
+    """
+    if schedule is None:
+        schedule = sorting_network(n, algorithm)
+    comparators = [(i, j) if ascending else (j, i) for i, j, ascending in schedule]
+    if any(not 0 <= lane < n for c in comparators for lane in c):
+        raise pyrtl.PyrtlError("schedule uses lanes outside of 0 .. %d" % (n - 1))
+
+    # The leading comparators on distinct lanes are applied by the enumeration itself
+    first, seen = 0, set()
+    while first < len(comparators) and not seen.intersection(comparators[first]):
+        seen.update(comparators[first])
+        first += 1
+    for lanes, decode in _binary_inputs(n, comparators[:first]):
+        for i, j in comparators[first:]:
+            lanes[i], lanes[j] = lanes[i] & lanes[j], lanes[i] | lanes[j]
+        # A 1 above a 0 on the next lane is a failure
+        bad = 0
+        for k in range(n - 1):
+            bad |= lanes[k] & ~lanes[k + 1]
+        if bad:
+            return decode((bad & -bad).bit_length() - 1)
+
+    if n > 1 and netlist_samples:
+        samples = [0, (1 << n) - 1] + [random.getrandbits(n) for _ in range(netlist_samples)]
+        v = _check_netlist(comparators, n, samples)
+        if v is not None:
+            return [v >> k & 1 for k in range(n)]
+    return None
+
+
+def _used_comparators(comparators, outputs):
+    """ Drop the comparators that don't affect the lanes in outputs.
+
+    :return: list of (i, j, use_min, use_max), where use_min (use_max) says whether
+        the smaller value (on i) or the larger one (on j) is needed afterwards
+    """
+    needed, used = set(outputs), []
+    for i, j in reversed(comparators):
+        use_min, use_max = i in needed, j in needed
+        if use_min or use_max:
+            used.append((i, j, use_min, use_max))
+            needed.update((i, j))
+    return used[::-1]
+
+
+def _merge_top_k_network(n, k):
+    """ Comparators that leave the k smallest of n values, sorted, on some k lanes.
+
+    With k rounded up to a power of 2, each half of the lanes is reduced to its own
+    k smallest (sorting the lanes directly once there are no more than k of them).
+    The two sorted lists are then combined by comparing the first with the second
+    reversed, which leaves the k smallest in the first as a bitonic sequence, and a
+    bitonic merge sorts them.
+
+    :return: the comparators, and the lanes holding the result, smallest first
+    """
+    comparators = []
+    kk = 1 << (k - 1).bit_length()
+
+    def select(lanes):
+        if len(lanes) <= kk:
+            comparators.extend((lanes[i], lanes[j]) for i, j in _network(len(lanes), 'optimal'
+                               if len(lanes) <= max(_Best_networks) else 'odd_even_merge'))
+            return lanes
+        # The first part is big enough to give a full k lanes back
+        mid = max(kk, len(lanes) // 2)
+        a, b = select(lanes[:mid]), select(lanes[mid:])
+        # Missing entries of b act as +inf, and never win a comparison
+        comparators.extend((a[i], b[kk - 1 - i]) for i in range(kk - len(b), kk))
+        merge(a)
+        return a
+
+    def merge(lanes):
+        if len(lanes) > 1:
+            half = len(lanes) // 2
+            comparators.extend(zip(lanes[:half], lanes[half:]))
+            merge(lanes[:half])
+            merge(lanes[half:])
+
+    return comparators, select(list(range(n)))
+
+
+def _selection_network(n, ranks):
+    """ The cheapest network we know of that puts the values of the given ranks
+    (0 is the smallest) on some lanes.
+
+    :return: the used comparators (see _used_comparators()) and the lane of each rank
+    """
+    candidates = []
+    algorithms = _Algorithms if n <= max(_Best_networks) else _Algorithms[:2]
+    for algorithm in algorithms:
+        candidates.append((_used_comparators(_network(n, algorithm), ranks), ranks))
+    top = max(ranks) + 1
+    if top < n:
+        comparators, lanes = _merge_top_k_network(n, top)
+        outputs = [lanes[r] for r in ranks]
+        candidates.append((_used_comparators(comparators, outputs), outputs))
+    return min(candidates, key=lambda c: len(c[0]))
+
+
+def _run_selection(used, args, sorter, largest):
+    wires = list(args)
+    for i, j, use_min, use_max in used:
+        a, b = wires[i], wires[j]
+        first = sorter.lt(b, a) if largest else sorter.lt(a, b)
+        if use_min:
+            wires[i] = pyrtl.select(first, a, b)
+        if use_max:
+            wires[j] = pyrtl.select(first, b, a)
+    return wires
+
+
+def top_k(*args, k, signed=False, key=None, largest=False):
+    """ Select the k smallest (or largest) of the wires given.
+
+    :param args: the WireVectors to select from
+    :param int k: how many to select
+    :param signed: if True, compare them as two's complement numbers
+    :param key: None or 'fp' (see sort())
+    :param largest: select the k largest instead, largest first
+    :return: tuple of the k selected WireVectors, smallest first (largest first
+        if largest is True)
+
+    Only the comparators that matter for the selected values are built, and only
+    the muxes for the side of each comparator that's used. The network is the smaller
+    of a pruned sorting network and a merge based one (each half reduced to its k
+    smallest, then merged), e.g. 29 comparators for the 2 smallest of 16 rather
+    than the 60 of a full sort.
+    """
+    n = len(args)
+    _check_operand_args('top_k', n, signed, key)
+    if not 1 <= k <= n:
+        raise pyrtl.PyrtlError("k must be between 1 and the number of arguments")
+    used, lanes = _selection_network(n, list(range(k)))
+    if key == 'fp':
+        args = tuple(fp_to_sortable(w) for w in args)
+    wires = _run_selection(used, args, _BitonicSorter(signed=signed), largest)
+    res = tuple(wires[lane] for lane in lanes)
+    return tuple(sortable_to_fp(w) for w in res) if key == 'fp' else res
+
+
+def median(*args, signed=False, key=None):
+    """ Select the median of the wires given.
+
+    :param args: the WireVectors to select from
+    :param signed: if True, compare them as two's complement numbers
+    :param key: None or 'fp' (see sort())
+    :return: the median; for an even number of arguments, the lower of the middle two
+
+    Built like top_k(), keeping only what decides the middle value, e.g. 20
+    comparators for the median of 9 rather than the 25 of a full sort.
+    """
+    n = len(args)
+    _check_operand_args('median', n, signed, key)
+    used, lanes = _selection_network(n, [(n - 1) // 2])
+    if key == 'fp':
+        args = tuple(fp_to_sortable(w) for w in args)
+    res = _run_selection(used, args, _BitonicSorter(signed=signed), False)[lanes[0]]
+    return sortable_to_fp(res) if key == 'fp' else res
+
+
+PipelinedSort = collections.namedtuple(
+    'PipelinedSort', ['outputs', 'valid_out', 'ready_in', 'latency'])
+
+
+def _pipeline_register(w, enable):
+    r = pyrtl.Register(len(w))
+    r.next <<= pyrtl.select(enable, w, r)
+    return r
+
+
+def pipelined_sort(*args, valid_in, ready_out, signed=False, key=None, algorithm='bitonic',
+                   layers_per_stage=1):
+    """ A sorting network with pipeline registers between its layers of comparators.
+
+    :param args: the WireVectors to sort
+    :param valid_in: high when args hold a vector to sort
+    :param ready_out: high when whoever consumes the outputs can take them
+    :param signed: if True, compare them as two's complement numbers
+    :param key: None or 'fp' (see sort())
+    :param algorithm: 'bitonic' (default), 'odd_even_merge' or 'optimal' (see sort())
+    :param int layers_per_stage: how many layers of comparators to put between
+        registers (default 1, a register after every layer)
+    :return: a PipelinedSort of the sorted outputs (from the last register), valid_out,
+        ready_in (high when the input vector is accepted this cycle) and the latency
+        in cycles from an input being accepted to its outputs being valid
+
+    A new vector can be accepted every cycle. When the outputs are valid and ready_out
+    is low, the whole pipeline stalls (and ready_in goes low) until they are taken;
+    otherwise it keeps moving, so empty stages never hold anything up.
+
+    Example::
+
+        res = pipelined_sort(*ins, valid_in=v, ready_out=pyrtl.Const(1))
+        res.latency  # 6 for 8 inputs: 6 layers of comparators in a bitonic network
+    """
+    n = len(args)
+    _check_sort_args('pipelined_sort', n, signed, key, algorithm)
+    if layers_per_stage < 1:
+        raise pyrtl.PyrtlError("layers_per_stage must be at least 1")
+
+    layers = _layers(_network(n, algorithm))
+    advance = pyrtl.WireVector(1)
+    wires = [fp_to_sortable(w) for w in args] if key == 'fp' else list(args)
+    valid = pyrtl.as_wires(valid_in)
     bs = _BitonicSorter(signed=signed)
-    return bs.bitonic_helper(*args)
+    for start in range(0, len(layers), layers_per_stage):
+        for layer in layers[start:start + layers_per_stage]:
+            wires = _run_network(layer, wires, bs.comp)
+        wires = [_pipeline_register(w, advance) for w in wires]
+        valid = _pipeline_register(valid, advance)
+    advance <<= ready_out | ~valid
+
+    outputs = tuple(sortable_to_fp(w) for w in wires) if key == 'fp' else tuple(wires)
+    return PipelinedSort(outputs, valid, advance, -(-len(layers) // layers_per_stage))
+
+
+StreamSort = collections.namedtuple('StreamSort', ['out', 'valid_out', 'last_out', 'ready_in'])
+
+
+def stream_sort(inputs, valid_in, ready_out, length, signed=False):
+    """ Sort a sequence much longer than a sorting network is wide, over many cycles.
+
+    :param inputs: list of w WireVectors (w a power of 2), the next w elements of the
+        sequence, taken whenever valid_in and ready_in are both high
+    :param valid_in: high when inputs hold elements
+    :param ready_out: high when whoever consumes the output can take it
+    :param int length: number of elements in each sequence, a power of 2 multiple of w
+    :param signed: if True, compare the elements as two's complement numbers
+    :return: a StreamSort of the sorted sequence, one element per cycle (out, with
+        valid_out), last_out marking its final element, and ready_in (high while
+        the unit is taking in a sequence)
+
+    Each group of w elements is sorted by a w input bitonic network as it arrives and
+    stored as one row of a memory, giving length / w sorted runs. Merge passes then
+    double the run length each time, reading two runs and writing one element per
+    cycle, ping-ponging between two memories; the last pass streams its result out
+    instead of storing it. Only the w input network and one more comparator are
+    built, and a sequence takes length / w cycles to load plus
+    length * max(1, log2(length / w)) to merge and stream out, after which the next
+    sequence can be loaded.
+    """
+    w = len(inputs)
+    if w == 0 or w & (w - 1) != 0:
+        raise pyrtl.PyrtlError("stream_sort needs a power of 2 number of inputs")
+    if length < w or length % w != 0 or (length // w) & (length // w - 1) != 0:
+        raise pyrtl.PyrtlError("length must be a power of 2 multiple of the number of inputs")
+    inputs = [pyrtl.as_wires(x) for x in inputs]
+    bw = max(len(x) for x in inputs)
+    col_bits = (w - 1).bit_length()
+    rows = length // w
+    row_bits = max(1, (rows - 1).bit_length())
+    cw = length.bit_length() + 2  # wide enough for every element count
+
+    def element(word, col):
+        elems = [word[i * bw:(i + 1) * bw] for i in range(w)]
+        return pyrtl.mux(col, *elems) if w > 1 else elems[0]
+
+    def split_index(idx):
+        return idx[col_bits:col_bits + row_bits], idx[:col_bits] if w > 1 else None
+
+    mems = [pyrtl.MemBlock(w * bw, row_bits, asynchronous=True) for _ in range(2)]
+    loading = pyrtl.Register(1, reset_value=1)
+    src = pyrtl.Register(1)
+    load_row = pyrtl.Register(row_bits)
+    run = pyrtl.Register(cw, reset_value=w)  # length of the runs being merged
+    base, ia, ib = pyrtl.Register(cw), pyrtl.Register(cw), pyrtl.Register(cw)
+    buffer = [pyrtl.Register(bw) for _ in range(w - 1)]
+
+    # Loading: sort each block and store it as a row of the first memory
+    sorted_block = sort(*[x.sign_extended(bw) if signed else x.zero_extended(bw)
+                          for x in inputs], signed=signed, algorithm='bitonic')
+    take_block = loading & valid_in
+
+    # Merging: runs [base, base + run) and [base + run, base + 2 * run)
+    final = run >= length // 2
+    run_b = pyrtl.select(run < length, run, pyrtl.Const(0, cw))
+    pair_len = (run + run_b)[:cw]
+    a_row, a_col = split_index((base + ia)[:cw])
+    b_row, b_col = split_index((base + run + ib)[:cw])
+    a = element(pyrtl.select(src, mems[1][a_row], mems[0][a_row]), a_col)
+    b = element(pyrtl.select(src, mems[1][b_row], mems[0][b_row]), b_col)
+    a_valid = ia < run
+    b_valid = ib < run_b
+    a_le_b = pyrtl.signed_le(a, b) if signed else a <= b
+    take_a = a_valid & (~b_valid | a_le_b)
+    out = pyrtl.select(take_a, a, b)
+    advance = ~loading & (~final | ready_out)
+    pair_done = (ia + ib + 1)[:cw] == pair_len
+    pass_done = pair_done & ((base + pair_len)[:cw] == length)
+
+    # Gather merged elements into a row, and store it once it's full
+    out_row, out_col = split_index((base + ia + ib)[:cw])
+    row_full = advance & ~final & (out_col == w - 1 if w > 1 else pyrtl.Const(1))
+    merged = pyrtl.concat_list(buffer + [out])
+    for i, r in enumerate(buffer):
+        with pyrtl.conditional_assignment:
+            with advance & (out_col == i):
+                r.next |= out
+    mems[0][pyrtl.select(loading, load_row, out_row)] <<= pyrtl.MemBlock.EnabledWrite(
+        pyrtl.select(loading, pyrtl.concat_list(sorted_block), merged),
+        take_block | (row_full & src))
+    mems[1][out_row] <<= pyrtl.MemBlock.EnabledWrite(merged, row_full & ~src)
+
+    with pyrtl.conditional_assignment:
+        with take_block:
+            with load_row == rows - 1:
+                load_row.next |= 0
+                loading.next |= 0
+            with pyrtl.otherwise:
+                load_row.next |= load_row + 1
+        with advance:
+            with pass_done:
+                base.next |= 0
+                ia.next |= 0
+                ib.next |= 0
+                with final:
+                    loading.next |= 1
+                    src.next |= 0
+                    run.next |= w
+                with pyrtl.otherwise:
+                    src.next |= ~src
+                    run.next |= pyrtl.concat(run, pyrtl.Const(0))[:cw]
+            with pair_done:
+                base.next |= (base + pair_len)[:cw]
+                ia.next |= 0
+                ib.next |= 0
+            with take_a:
+                ia.next |= ia + 1
+            with pyrtl.otherwise:
+                ib.next |= ib + 1
+
+    valid_out = ~loading & final
+    return StreamSort(out, valid_out, valid_out & pass_done, loading)
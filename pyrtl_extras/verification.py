@@ -1,29 +1,58 @@
+import collections
+import itertools
+import multiprocessing
 import subprocess
 import os
+import random
 import tempfile
+import time
 from inspect import signature
-import itertools
 import pyrtl
 
+from .bitsliced import BitslicedSimulation, _compile, _extend, _to_bitslices
+from .sat import _Tseitin
+
+
+Counterexample = collections.namedtuple('Counterexample', ['inputs', 'outputs1', 'outputs2'])
+
+
+class EquivalenceResult(collections.namedtuple(
+        'EquivalenceResult', ['equivalent', 'counterexamples', 'mismatches', 'vectors_checked',
+                              'seconds'])):
+    """ The outcome of an equivalence check.
+
+    equivalent is False if any input vector gave different outputs; counterexamples
+    holds the first few of them (as Counterexample tuples of the input values and the
+    output values of each function), mismatches how many were found in total, and
+    vectors_checked how many input vectors were simulated in seconds. The result is
+    truthy exactly when the functions were found equivalent.
+    """
+    __slots__ = ()
+
+    def __bool__(self):
+        return self.equivalent
+
+    @property
+    def throughput(self):
+        """ Input vectors checked per second """
+        return self.vectors_checked / self.seconds if self.seconds else float('inf')
+
 
 # TODO can we using type annotations (see WVType in meta.py) to be able
 # to not take in bitwidths? Or use runtime type information in some way like this?
-def equivalent_comb_via_sim(f1, f2, bitwidths, **kwargs):
-    """ Brute-force test two functions for equivalence by generating all possible values
-        for each input and comparing the resulting output of each function. Requires
-        that both functions have the same number and order of inputs and outputs.
+def _output(w, name):
+    """ Drive a new Output with w, so its values can be traced by name """
+    out = pyrtl.Output(name=name)
+    out <<= w
+    return out
 
-        Some caveats: you should only supply non-wire arguments (i.e. what you
-        would call "parameters" in Verilog) in the kwargs map. It is assumed
-        that all wire arguments come before any of the arguments in kwargs,
-        and these wire arguments will be generated internally here for you.
 
-        :param f1: The first function to test
-        :parma f2: The second function to test
-        :param bitwidths: A list of bitwidths for each input to the functions
-        :param kwargs: A map of keyword arguments to pass to the functions
-    """
+def _instantiate_both(f1, f2, bitwidths, kwargs):
+    """ Call both functions on the same new Inputs, and drive an Output with each of
+    their results.
 
+    :return: the Inputs, and the Outputs of f1 and of f2
+    """
     sig1 = signature(f1)
     sig2 = signature(f2)
     if len(sig1.parameters) != len(sig2.parameters):
@@ -42,36 +71,638 @@ def equivalent_comb_via_sim(f1, f2, bitwidths, **kwargs):
 
     assert len(out1) == len(out2), "Both functions should return the same number of values."
 
-    for n, o in enumerate(out1):
-        pyrtl.probe(o, f"f1_out{n}")
+    outs1 = [_output(o, f"f1_out{n}") for n, o in enumerate(out1)]
+    outs2 = [_output(o, f"f2_out{n}") for n, o in enumerate(out2)]
+    return arg_wires, outs1, outs2
 
-    for n, o in enumerate(out2):
-        pyrtl.probe(o, f"f2_out{n}")
 
-    tracer = pyrtl.SimulationTrace()
-    sim = pyrtl.Simulation(tracer)
-    # Example:
-    # A: 4 bits = [0b0000, 0b0001, ..., 0b1111]
-    # B: 2 bits = [0b00, 0b01, 0b10, 0b11]
-    # C: 3 bits = [0b000, 0b001, ..., 0b111]
-    # combs = [(a, b, c) for a in A for b in B for c in C]
-    # combs = [(0, 0, 0), (0, 0, 1), (0, 0, 2), ..., (0, 0, 7), (0, 1, 0), ...]
-    combs = list(itertools.product(*[range(0, p.bitmask + 1) for p in arg_wires]))
-    for stepn, input in enumerate(combs):
-        sim.step({
-            p.name: input[j] for j, p in enumerate(arg_wires)
-        })
-        for o1, o2 in zip(out1, out2):
-            v1 = sim.inspect(o1)
-            v2 = sim.inspect(o2)
+def _check_range(sim, arg_wires, outs1, outs2, start, stop, chunk_size, max_counterexamples,
+                 stop_on_first, progress=None):
+    """ Simulate the input vectors numbered start up to stop, and compare the outputs.
+
+    Vector v holds the args concatenated, the first in the most significant bits, so
+    they come in the same order as itertools.product() would give them.
+
+    :return: the counterexamples (up to max_counterexamples), the number of
+        mismatches and the number of vectors checked
+    """
+    shifts = [sum(len(w) for w in arg_wires[j + 1:]) for j in range(len(arg_wires))]
+    if isinstance(sim, BitslicedSimulation):
+        return _check_range_bitsliced(sim, arg_wires, shifts, outs1, outs2, start, stop,
+                                      chunk_size, max_counterexamples, stop_on_first, progress)
+    counterexamples, mismatches, checked = [], 0, 0
+    for lo in range(start, stop, chunk_size):
+        vectors = range(lo, min(lo + chunk_size, stop))
+        columns = [[v >> shift & p.bitmask for v in vectors]
+                   for shift, p in zip(shifts, arg_wires)]
+        sim.step_multiple({p.name: columns[j] for j, p in enumerate(arg_wires)},
+                          nsteps=len(vectors))
+        trace = sim.tracer.trace
+        values1 = zip(*(trace[o.name] for o in outs1))
+        values2 = zip(*(trace[o.name] for o in outs2))
+        for i, v1, v2 in zip(range(len(vectors)), values1, values2):
+            checked += 1
             if v1 != v2:
-                print(f"{v1} != {v2} for input {input} (step #{stepn})")
+                mismatches += 1
+                if len(counterexamples) < max_counterexamples:
+                    input = tuple(column[i] for column in columns)
+                    counterexamples.append(Counterexample(input, v1, v2))
+                if stop_on_first:
+                    break
+        for values in trace.values():
+            values.clear()
+        if progress is not None:
+            progress(checked)
+        if mismatches and stop_on_first:
+            break
+    return counterexamples, mismatches, checked
+
+
+def _check_range_bitsliced(sim, arg_wires, shifts, outs1, outs2, start, stop, chunk_size,
+                           max_counterexamples, stop_on_first, progress):
+    """ Like _check_range(), but with every bit of the inputs and outputs as one
+    bit-slice over a whole chunk of vectors.
+
+    Bit b of the vector number alternates every 2**b vectors, so the input slices
+    are fixed patterns within a chunk (a power of 2 in size, starting at a multiple
+    of its size) and the outputs are compared with one XOR per bit.
+    """
+    size = 1 << (min(chunk_size, stop - start).bit_length() - 1)
+    ones = (1 << size) - 1
+    patterns = [(((1 << (1 << b)) - 1) << (1 << b)) * (ones // ((1 << (2 << b)) - 1))
+                for b in range(size.bit_length() - 1)]
+    counterexamples, mismatches, checked = [], 0, 0
+    for lo in range(start, stop, size):
+        inputs = {p.name: [patterns[b] if b < len(patterns) else ones * (lo >> b & 1)
+                           for b in range(shift, shift + len(p))]
+                  for shift, p in zip(shifts, arg_wires)}
+        res = sim.evaluate(inputs, ones)
+        diff = 0
+        for o1, o2 in zip(outs1, outs2):
+            s1, s2 = res[o1.name], res[o2.name]
+            s1, s2 = (s + [0] * (max(len(s1), len(s2)) - len(s)) for s in (s1, s2))
+            for x, y in zip(s1, s2):
+                diff |= x ^ y
+        if diff and stop_on_first:
+            diff &= -diff
+        checked += (diff & -diff).bit_length() if stop_on_first and diff else size
+        mismatches += bin(diff).count('1')
+        while diff and len(counterexamples) < max_counterexamples:
+            i = (diff & -diff).bit_length() - 1
+            diff &= diff - 1
+            input = tuple(lo + i >> shift & p.bitmask for shift, p in zip(shifts, arg_wires))
+            v1, v2 = (tuple(sum((s >> i & 1) << k for k, s in enumerate(res[o.name]))
+                            for o in outs) for outs in (outs1, outs2))
+            counterexamples.append(Counterexample(input, v1, v2))
+        if progress is not None:
+            progress(checked)
+        if mismatches and stop_on_first:
+            break
+    return counterexamples, mismatches, checked
+
+
+# What a forked worker needs to check its part of the input space; set up by the
+# parent before forking, so the block doesn't need to be pickled
+_worker_args = None
+_worker_sim = None
+
+
+def _init_worker():
+    global _worker_sim
+    simulation, arg_wires, outs1, outs2 = _worker_args[:4]
+    _worker_sim = simulation(tracer=pyrtl.SimulationTrace(wires_to_track=outs1 + outs2))
+
+
+def _check_part(part):
+    return _check_range(_worker_sim, *_worker_args[1:4], *part, *_worker_args[4:])
+
+
+def equivalent_comb_via_sim(f1, f2, bitwidths, *, max_counterexamples=10, stop_on_first=False,
+                            chunk_size=None, simulation=pyrtl.FastSimulation, workers=1,
+                            progress=None, **kwargs):
+    """ Brute-force test two functions for equivalence by generating all possible values
+        for each input and comparing the resulting output of each function. Requires
+        that both functions have the same number and order of inputs and outputs.
+
+        Some caveats: you should only supply non-wire arguments (i.e. what you
+        would call "parameters" in Verilog) in the kwargs map. It is assumed
+        that all wire arguments come before any of the arguments in kwargs,
+        and these wire arguments will be generated internally here for you.
+
+        :param f1: The first function to test
+        :param f2: The second function to test
+        :param bitwidths: A list of bitwidths for each input to the functions
+        :param max_counterexamples: How many mismatching input vectors to keep
+        :param stop_on_first: If True, stop at the first mismatch rather than checking
+            every input vector
+        :param chunk_size: How many input vectors to simulate at a time (by default
+            4096, or 65536 for BitslicedSimulation, which rounds it down to a power of 2)
+        :param simulation: The simulation class to use: pyrtl.FastSimulation (the
+            default), pyrtl.CompiledSimulation (compiled to C, which pays off for
+            large circuits), pyrtl.Simulation, or BitslicedSimulation (combinational
+            circuits only; it evaluates a whole chunk of vectors with each bitwise
+            operation, and is by far the fastest for exhaustive checks)
+        :param workers: How many processes to split the input vectors between
+            (None for one per CPU)
+        :param progress: If given, called with the number of vectors checked so far
+            and the total number, as the check goes along
+        :param kwargs: A map of keyword arguments to pass to the functions
+        :return: an EquivalenceResult
+
+        The input vectors are generated lazily and simulated chunk_size at a time
+        with step_multiple(); only the outputs are traced, and the trace is
+        cleared after each chunk, so memory use doesn't grow with the number of
+        inputs.
+
+        With more than one worker, the circuit is elaborated here and the workers
+        are forked from this process, each making its own simulation once and then
+        checking one contiguous range of vectors after another. Counterexamples are
+        still reported in order. Forking is needed to hand over the circuit
+        (f1 and f2 are often closures, which can't be pickled), so this is not
+        available on Windows.
+    """
+    global _worker_args
+
+    if workers is None:
+        workers = os.cpu_count()
+    if workers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+        raise pyrtl.PyrtlError("workers > 1 needs processes to be started by forking")
+
+    arg_wires, outs1, outs2 = _instantiate_both(f1, f2, bitwidths, kwargs)
+
+    # Example:
+    # A: 4 bits, B: 2 bits, C: 3 bits
+    # vectors = (0, 0, 0), (0, 0, 1), (0, 0, 2), ..., (0, 0, 7), (0, 1, 0), ...
+    # where vector v is A, B and C concatenated
+    total = 1 << sum(bitwidths)
+    if chunk_size is None:
+        chunk_size = 1 << 16 if issubclass(simulation, BitslicedSimulation) else 4096
+    start = time.perf_counter()
+    if workers <= 1:
+        sim = simulation(tracer=pyrtl.SimulationTrace(wires_to_track=outs1 + outs2))
+        report = None if progress is None else (lambda checked: progress(checked, total))
+        counterexamples, mismatches, checked = _check_range(
+            sim, arg_wires, outs1, outs2, 0, total, chunk_size, max_counterexamples,
+            stop_on_first, report)
+    else:
+        # A few parts per worker, so they all stay busy until the end; a power of 2
+        # in size, so that BitslicedSimulation's chunks line up with them
+        step = 1 << max(chunk_size - 1, -(-total // (workers * 4)) - 1).bit_length()
+        parts = [(lo, min(lo + step, total)) for lo in range(0, total, step)]
+        _worker_args = (simulation, arg_wires, outs1, outs2, chunk_size, max_counterexamples,
+                        stop_on_first)
+        counterexamples, mismatches, checked = [], 0, 0
+        try:
+            with multiprocessing.get_context('fork').Pool(workers, _init_worker) as pool:
+                for part_cexs, part_mismatches, part_checked in pool.imap(_check_part, parts):
+                    counterexamples += part_cexs[:max_counterexamples - len(counterexamples)]
+                    mismatches += part_mismatches
+                    checked += part_checked
+                    if progress is not None:
+                        progress(checked, total)
+                    if mismatches and stop_on_first:
+                        break
+        finally:
+            _worker_args = None
+
+    return EquivalenceResult(mismatches == 0, counterexamples, mismatches, checked,
+                             time.perf_counter() - start)
+
+
+def _miter(cnf, bits, outs1, outs2):
+    """ A bit that is 1 when the outputs differ """
+    miter = cnf.zero
+    for o1, o2 in zip(outs1, outs2):
+        width = max(len(o1), len(o2))
+        for x, y in zip(_extend(bits[o1], width, cnf.zero), _extend(bits[o2], width, cnf.zero)):
+            miter = cnf.or_(miter, cnf.xor(x, y))
+    return miter
+
+
+class ProofResult(collections.namedtuple(
+        'ProofResult', ['equivalent', 'counterexample', 'seconds', 'depth'],
+        defaults=(None,))):
+    """ The outcome of a formal equivalence check.
+
+    equivalent is True if the check proved the functions equivalent, and False if
+    it found how they differ, which counterexample then shows. For sequential
+    checks, depth is the number of cycles that were unrolled, and equivalent is
+    None if they don't differ within that many cycles but that wasn't enough to
+    prove them equivalent. The result is truthy exactly when the functions were
+    proved equivalent.
+    """
+    __slots__ = ()
+
+    def __bool__(self):
+        return self.equivalent is True
+
+
+def equivalent_comb_via_sat(f1, f2, bitwidths, *, solver='auto', **kwargs):
+    """ Prove two combinational functions equivalent (or find an input where they
+        differ) with a SAT solver, rather than by trying every input.
+
+        :param f1: The first function to test
+        :param f2: The second function to test
+        :param bitwidths: A list of bitwidths for each input to the functions
+        :param solver: 'cdcl' for the solver in this package, 'pycosat' to use the
+            pycosat package, or 'auto' (the default) to use pycosat if it's installed
+        :param kwargs: A map of keyword arguments to pass to the functions
+        :return: a ProofResult, whose counterexample (if any) is a Counterexample
+
+        The functions are instantiated as for equivalent_comb_via_sim(), and their
+        outputs compared in a miter: a circuit that is 1 exactly when some output
+        bit differs. The netlist is encoded into CNF (a variable per gate, with
+        gates shared when they have the same inputs) and the solver asked for an
+        input that makes the miter 1. Adders and comparators of 32 bits and more
+        are no problem (a ripple carry against a Kogge-Stone 32-bit adder takes
+        about a second). Multipliers are hard for any SAT solver: the bundled one
+        takes seconds at 5 bits and grows about tenfold per bit from there, so
+        leave those (and floating point multiplication) to pycosat or simulation.
+    """
+    arg_wires, outs1, outs2 = _instantiate_both(f1, f2, bitwidths, kwargs)
+    block = pyrtl.working_block()
+    if block.wirevector_subset(pyrtl.Register):
+        raise pyrtl.PyrtlError("equivalent_comb_via_sat needs combinational logic; "
+                               "use equivalent_seq_via_bmc() for registers")
+
+    start = time.perf_counter()
+    cnf = _Tseitin(solver)
+    sources = {w: cnf.new_vars(len(w)) for w in block.wirevector_subset(pyrtl.Input)}
+    bits = cnf.lower(block, sources)
+    model = cnf.solve([_miter(cnf, bits, outs1, outs2)])
+    if model is None:
+        return ProofResult(True, None, time.perf_counter() - start)
+    counterexample = Counterexample(tuple(cnf.value(sources[w], model) for w in arg_wires),
+                                    tuple(cnf.value(bits[o], model) for o in outs1),
+                                    tuple(cnf.value(bits[o], model) for o in outs2))
+    return ProofResult(False, counterexample, time.perf_counter() - start)
+
+
+class _Unrolling(object):
+    """ The block encoded cycle after cycle, the registers of each cycle driven by
+    the values computed for them in the one before """
+
+    def __init__(self, cnf, block, outs1, outs2, state):
+        self.cnf, self.block, self.outs1, self.outs2 = cnf, block, outs1, outs2
+        self.next_of = {net.dests[0]: net.args[0] for net in block.logic_subset('r')}
+        self.states, self.frames, self.miters = [state], [], []
+
+    def add_frame(self):
+        cnf, state = self.cnf, self.states[-1]
+        sources = dict(state)
+        sources.update({w: cnf.new_vars(len(w)) for w in self.block.wirevector_subset(pyrtl.Input)})
+        bits = cnf.lower(self.block, sources)
+        self.frames.append(bits)
+        self.miters.append(_miter(cnf, bits, self.outs1, self.outs2))
+        self.states.append({r: _extend(bits[self.next_of[r]], len(r), cnf.zero) for r in state})
+        return self.miters[-1]
+
+    def trace(self, model, arg_wires):
+        return tuple(Counterexample(tuple(self.cnf.value(bits[w], model) for w in arg_wires),
+                                    tuple(self.cnf.value(bits[o], model) for o in self.outs1),
+                                    tuple(self.cnf.value(bits[o], model) for o in self.outs2))
+                     for bits in self.frames)
+
+
+def equivalent_seq_via_bmc(f1, f2, bitwidths, *, depth=20, induction=True, solver='auto',
+                           **kwargs):
+    """ Check if two sequential circuits are equivalent, by bounded model checking
+        and k-induction on their netlists.
+
+        :param f1: The first function to test
+        :param f2: The second function to test
+        :param bitwidths: A list of bitwidths for each input to the functions
+        :param depth: The number of cycles to unroll, at most
+        :param induction: If True, try to prove equivalence for every number of
+            cycles by k-induction; otherwise only look for a difference
+        :param solver: 'cdcl', 'pycosat' or 'auto' (see equivalent_comb_via_sat())
+        :param kwargs: A map of keyword arguments to pass to the functions
+        :return: a ProofResult; a counterexample is a tuple of one Counterexample
+            per cycle from reset, up to the first cycle where the outputs differ
+
+        Both functions are instantiated on the same Inputs, with registers starting
+        at their reset values (0 if not given). The netlist is encoded into CNF once
+        per cycle, with each cycle's registers given by the values computed for
+        them in the cycle before, and a SAT solver asked whether the outputs can
+        differ in cycle k, for k = 0, 1, ...; the solver keeps what it learns
+        from one k to the next.
+
+        After cycle k is found to agree, k-induction tries to show that any run of
+        k + 1 cycles starting from any state, all different, where the outputs agree
+        in the first k cycles also agrees in the last one. If so, with no difference
+        in the first k cycles from reset, the circuits are equivalent. Memories are
+        not supported.
+    """
+    arg_wires, outs1, outs2 = _instantiate_both(f1, f2, bitwidths, kwargs)
+    block = pyrtl.working_block()
+    registers = block.wirevector_subset(pyrtl.Register)
+
+    start = time.perf_counter()
+    base = _Tseitin(solver)
+    reset = {r: [base.one if (r.reset_value or 0) >> k & 1 else base.zero for k in range(len(r))]
+             for r in registers}
+    base_unrolling = _Unrolling(base, block, outs1, outs2, reset)
+    step = _Tseitin(solver)
+    step_unrolling = _Unrolling(step, block, outs1, outs2,
+                                {r: step.new_vars(len(r)) for r in registers})
+
+    for k in range(depth):
+        miter = base_unrolling.add_frame()
+        model = base.solve([miter])
+        if model is not None:
+            return ProofResult(False, base_unrolling.trace(model, arg_wires),
+                               time.perf_counter() - start, k + 1)
+        base.clauses.append([-miter])
+
+        if induction:
+            if k > 0:
+                step.clauses.append([-step_unrolling.miters[-1]])
+            step_miter = step_unrolling.add_frame()
+            # The states entering the frames of the run are all different (it's
+            # enough to look at runs without loops, and it makes the induction
+            # complete); the state after the last frame may repeat any of them
+            new_state = step_unrolling.states[-2]
+            for state in step_unrolling.states[:-2]:
+                differ = step.zero
+                for r in registers:
+                    for x, y in zip(state[r], new_state[r]):
+                        differ = step.or_(differ, step.xor(x, y))
+                step.clauses.append([differ])
+            if step.solve([step_miter]) is None:
+                return ProofResult(True, None, time.perf_counter() - start, k + 1)
+
+    return ProofResult(None, None, time.perf_counter() - start, depth)
+
+
+class LockstepResult(collections.namedtuple(
+        'LockstepResult', ['equivalent', 'counterexample', 'run', 'seed', 'cycles_checked',
+                           'seconds'])):
+    """ The outcome of simulating two sequential circuits side by side.
+
+    equivalent is False if the outputs differed in some run, and True if they agreed
+    in every cycle of every run (which is evidence, not proof). For a difference,
+    counterexample is a tuple of one Counterexample per cycle of the run from reset,
+    up to the first cycle where the outputs differ, and run is the number of that
+    run; of all the runs that differ, the one that does so earliest is reported.
+    seed is the seed the random stimulus was made from, so it can be made again,
+    and cycles_checked how many cycles were simulated over all runs in seconds.
+    The result is truthy exactly when no difference was found.
+    """
+    __slots__ = ()
+
+    def __bool__(self):
+        return self.equivalent
+
+    @property
+    def cycle(self):
+        """ The first cycle (counting from 0) where the outputs differ, or None """
+        return None if self.counterexample is None else len(self.counterexample) - 1
+
+
+class _Lockstep(object):
+    """ Runs of the two circuits of the working block side by side from reset, each
+    on its own stimulus.
+
+    The runs are simulated on a copy of the block. For the pyrtl simulations, a new
+    Input added to the copy makes every register take its reset
+    value, so one simulation can do many runs one after the other, with a cycle of
+    reset in between, in a single step_multiple() call. Memories can't be reset
+    like that, so with memories every run gets a new simulation. BitslicedSimulation
+    instead does each run of a batch in its own bit of the bit-slices, all at once.
+    The simulation is made on first use, so forked workers each make their own.
+    """
+
+    def __init__(self, simulation, arg_wires, outs1, outs2, stimulus, nsteps, seed,
+                 chunk_size):
+        self.block = pyrtl.copy_block(update_working_block=False)
+        # copy_block() doesn't keep reset values
+        for r in pyrtl.working_block().wirevector_subset(pyrtl.Register):
+            self.block.get_wirevector_by_name(r.name).reset_value = r.reset_value
+        self.simulation, self.arg_wires, self.outs1, self.outs2 = (
+            simulation, *([self.block.get_wirevector_by_name(w.name) for w in wires]
+                          for wires in (arg_wires, outs1, outs2)))
+        self.stimulus, self.nsteps, self.seed, self.chunk_size = (
+            stimulus, nsteps, seed, chunk_size)
+        self.registers = self.block.wirevector_subset(pyrtl.Register)
+        self.bitsliced = issubclass(simulation, BitslicedSimulation)
+        self.reset = None
+        if not self.bitsliced and not self.block.logic_subset('@'):
+            with pyrtl.set_working_block(self.block, no_sanity_check=True):
+                self.reset = pyrtl.Input(1)
+                for net in list(self.block.logic_subset('r')):
+                    r = net.dests[0]
+                    self.block.logic.remove(net)
+                    next = pyrtl.select(self.reset, pyrtl.Const(r.reset_value or 0, len(r)),
+                                        net.args[0])
+                    self.block.add_net(pyrtl.LogicNet('r', None, (next[:len(r)],), (r,)))
+        self.sim = None
+
+    def cycles(self, run):
+        """ The input values of each cycle of a run, as tuples """
+        if self.stimulus is None or callable(self.stimulus):
+            rng = random.Random('%s:%d' % (self.seed, run))
+            if self.stimulus is None:
+                cycles = (tuple(rng.getrandbits(len(w)) for w in self.arg_wires)
+                          for _ in range(self.nsteps))
+            else:
+                cycles = self.stimulus(rng)
+        else:
+            cycles = self.stimulus[run]
+        cycles = [tuple(c) for c in itertools.islice(cycles, self.nsteps)]
+        for c in cycles:
+            if len(c) != len(self.arg_wires) or not all(
+                    0 <= v < 1 << len(w) for v, w in zip(c, self.arg_wires)):
+                raise pyrtl.PyrtlError("Input values %s of run %d don't fit the bitwidths %s"
+                                       % (c, run, [len(w) for w in self.arg_wires]))
+        return cycles
+
+    def check(self, runs):
+        """ Simulate the given runs, in batches of about chunk_size cycles (or runs,
+        for BitslicedSimulation).
+
+        :return: the trace and the run of the earliest difference (both None if
+            there is none), and the number of cycles simulated
+        """
+        trace, run, checked = None, None, 0
+        runs = iter(runs)
+        while trace is None or len(trace) > 1:
+            # Later runs only matter if they differ sooner
+            limit = None if trace is None else len(trace) - 1
+            batch, size = [], 0
+            for i in runs:
+                batch.append((i, self.cycles(i)[:limit]))
+                size += 1 if self.bitsliced else len(batch[-1][1]) + 1
+                if size >= self.chunk_size or (self.reset is None and not self.bitsliced):
+                    break
+            if not batch:
+                break
+            check_batch = self._check_bitsliced if self.bitsliced else self._check_batch
+            found, found_run, batch_checked = check_batch(batch)
+            checked += batch_checked
+            if found is not None and (trace is None or len(found) < len(trace)):
+                trace, run = found, found_run
+        return trace, run, checked
+
+    def _check_batch(self, batch):
+        if self.sim is None or self.reset is None:
+            self.sim = self.simulation(
+                tracer=pyrtl.SimulationTrace(wires_to_track=self.outs1 + self.outs2,
+                                             block=self.block),
+                block=self.block)
+        lead = 0 if self.reset is None else 1
+        inputs = {w.name: [] for w in self.arg_wires}
+        if self.reset is not None:
+            inputs[self.reset.name] = []
+        for _, cycles in batch:
+            if self.reset is not None:
+                inputs[self.reset.name] += [1] + [0] * len(cycles)
+            for j, w in enumerate(self.arg_wires):
+                inputs[w.name] += [0] * lead + [c[j] for c in cycles]
+        nsteps = sum(lead + len(cycles) for _, cycles in batch)
+        if nsteps == 0:
+            return None, None, 0
+        self.sim.step_multiple(inputs, nsteps=nsteps)
+
+        sim_trace = self.sim.tracer.trace
+        traces1 = [sim_trace[o.name] for o in self.outs1]
+        traces2 = [sim_trace[o.name] for o in self.outs2]
+        trace, run, pos = None, None, 0
+        for i, cycles in batch:
+            pos += lead
+            for c in range(len(cycles) if trace is None else len(trace) - 1):
+                if any(t1[pos + c] != t2[pos + c] for t1, t2 in zip(traces1, traces2)):
+                    trace = tuple(Counterexample(cycles[k],
+                                                 tuple(t[pos + k] for t in traces1),
+                                                 tuple(t[pos + k] for t in traces2))
+                                  for k in range(c + 1))
+                    run = i
+                    break
+            pos += len(cycles)
+        for values in sim_trace.values():
+            values.clear()
+        return trace, run, nsteps - lead * len(batch)
+
+    def _check_bitsliced(self, batch):
+        if self.sim is None:
+            self.sim = _compile(self.block, [o.name for o in self.outs1 + self.outs2],
+                                sequential=True)
+        ones = (1 << len(batch)) - 1
+        regs = {r.name: [ones * ((r.reset_value or 0) >> k & 1) for k in range(len(r))]
+                for r in self.registers}
+        results, checked = [], 0
+        for c in range(max(len(cycles) for _, cycles in batch)):
+            active = sum(1 << i for i, (_, cycles) in enumerate(batch) if len(cycles) > c)
+            inputs = {w.name: _to_bitslices([cycles[c][j] if len(cycles) > c else 0
+                                             for _, cycles in batch], len(w))
+                      for j, w in enumerate(self.arg_wires)}
+            res, regs = self.sim(inputs, ones, regs)
+            results.append(res)
+            checked += bin(active).count('1')
+            diff = 0
+            for o1, o2 in zip(self.outs1, self.outs2):
+                s1, s2 = res[o1.name], res[o2.name]
+                s1, s2 = (s + [0] * (max(len(s1), len(s2)) - len(s)) for s in (s1, s2))
+                for x, y in zip(s1, s2):
+                    diff |= x ^ y
+            diff &= active
+            if diff:
+                i = (diff & -diff).bit_length() - 1
+                run, cycles = batch[i]
+
+                def values(res, outs):
+                    return tuple(sum((s >> i & 1) << b for b, s in enumerate(res[o.name]))
+                                 for o in outs)
+                trace = tuple(Counterexample(cycles[k], values(res, self.outs1),
+                                             values(res, self.outs2))
+                              for k, res in enumerate(results))
+                return trace, run, checked
+        return None, None, checked
+
+
+def _check_runs(part):
+    return _worker_args.check(range(*part))
+
+
+def equivalent_seq_via_simulation(f1, f2, bitwidths, nsteps=None, *, runs=None, stimulus=None,
+                                  seed=None, simulation=pyrtl.FastSimulation, workers=1,
+                                  chunk_size=4096, **kwargs):
+    """ Check if two sequential circuits are equivalent by simulating them side by
+        side from reset, in many independent runs, and comparing their outputs every
+        cycle. It is much cheaper than equivalent_seq_via_bmc(), so it makes a good
+        first check, but it can only find differences, not rule them out.
+
+        :param f1: The first function to test
+        :param f2: The second function to test
+        :param bitwidths: A list of bitwidths for each input to the functions
+        :param nsteps: The number of cycles in each run (100 by default, or the whole
+            of each run given in stimulus)
+        :param runs: The number of runs (64 by default, or one per run given in stimulus;
+            if stimulus is a list, runs must match its length)
+        :param stimulus: The input values of each cycle, as tuples with a value for
+            each input: either a list with a sequence of them for each run, or a
+            function that is called with a random.Random for a run and returns an
+            iterable of them (for constrained random stimulus). By default every
+            input gets a uniformly random value every cycle.
+        :param seed: The seed for the random stimulus, an int or a str (a random int
+            by default); run i uses random.Random('<seed>:<i>'), so runs don't
+            depend on each other
+        :param simulation: The simulation class to use: pyrtl.FastSimulation (the
+            default), pyrtl.CompiledSimulation, pyrtl.Simulation or
+            BitslicedSimulation (no memories; it simulates a whole batch of runs at
+            once, one in each bit of its bit-slices)
+        :param workers: How many processes to split the runs between (None for one
+            per CPU)
+        :param chunk_size: How many cycles to simulate in each step_multiple() call,
+            or for BitslicedSimulation how many runs to simulate at once
+        :param kwargs: A map of keyword arguments to pass to the functions
+        :return: a LockstepResult
+
+        Registers start at their reset values (0 if not given) in every run. The
+        runs are simulated in order, and once a difference is found later runs are
+        only simulated for as long as they could still differ sooner. As in
+        equivalent_comb_via_sim(), more than one worker needs processes to be
+        started by forking.
+    """
+    global _worker_args
+
+    if workers is None:
+        workers = os.cpu_count()
+    if workers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+        raise pyrtl.PyrtlError("workers > 1 needs processes to be started by forking")
+    if stimulus is not None and not callable(stimulus):
+        stimulus = list(stimulus)
+        if runs is not None and runs != len(stimulus):
+            raise pyrtl.PyrtlError("runs=%d, but stimulus has %d runs" % (runs, len(stimulus)))
+        runs = len(stimulus)
+    elif nsteps is None:
+        nsteps = 100
+    if runs is None:
+        runs = 64
+    if seed is None:
+        seed = random.randrange(1 << 32)
 
-    # sim.tracer.render_trace()
+    arg_wires, outs1, outs2 = _instantiate_both(f1, f2, bitwidths, kwargs)
+    lockstep = _Lockstep(simulation, arg_wires, outs1, outs2, stimulus, nsteps, seed,
+                         chunk_size)
 
+    start = time.perf_counter()
+    if workers <= 1:
+        trace, run, checked = lockstep.check(range(runs))
+    else:
+        step = -(-runs // (workers * 4))
+        parts = [(lo, min(lo + step, runs)) for lo in range(0, runs, step)]
+        _worker_args = lockstep
+        trace, run, checked = None, None, 0
+        try:
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                for found, found_run, part_checked in pool.imap(_check_runs, parts):
+                    checked += part_checked
+                    if found is not None and (trace is None or len(found) < len(trace)):
+                        trace, run = found, found_run
+        finally:
+            _worker_args = None
 
-def equivalent_seq_via_simulation(f1, f2, bitwidths, nsteps=None, **kwargs):
-    pass
+    return LockstepResult(trace is None, trace, run, seed, checked, time.perf_counter() - start)
 
 
 def equivalent_seq_via_cosa(f1, f2, bitwidths, **kwargs):
@@ -0,0 +1,54 @@
+import unittest
+import random
+import pyrtl
+
+import pyrtl_extras as pe
+
+
+class TestBitslicedSimulation(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+
+    def test_matches_fast_simulation(self):
+        a, b, c = pyrtl.input_list('a/5 b/3 c/1')
+        results = {
+            'add': a + b, 'sub': a - b, 'sub2': b - a, 'mul': a * b, 'lt': a < b,
+            'gt': a > b, 'eq': a == b, 'and': a & b, 'or': a | b, 'xor': a ^ b,
+            'nand': a.nand(b), 'inv': ~a, 'select': pyrtl.select(c, a, b),
+            'concat': pyrtl.concat(a, b, c), 'slice': a[1:4], 'const': a + 7,
+            'signed_lt': pyrtl.signed_lt(a, b), 'mux': pyrtl.mux(b[:2], a, b, 3, a + 1),
+            'shift': pyrtl.shift_left_logical(a, b),
+        }
+        for name, w in results.items():
+            out = pyrtl.Output(name=name)
+            out <<= w
+
+        random.seed(47)
+        inputs = {'a': [random.randrange(32) for _ in range(300)],
+                  'b': [random.randrange(8) for _ in range(300)],
+                  'c': [random.randrange(2) for _ in range(300)]}
+        fast = pyrtl.FastSimulation()
+        fast.step_multiple(inputs)
+        sim = pe.BitslicedSimulation()
+        sim.step_multiple(inputs)
+        for name in results:
+            self.assertEqual(sim.tracer.trace[name], fast.tracer.trace[name], name)
+
+    def test_evaluate(self):
+        a, b = pyrtl.input_list('a/2 b/2')
+        out = pyrtl.Output(name='out')
+        out <<= a + b
+        sim = pe.BitslicedSimulation(tracer=pyrtl.SimulationTrace(wires_to_track=[out]))
+        # Four vectors: a = 0, 1, 2, 3 and b = 3, 3, 1, 0
+        res = sim.evaluate({'a': [0b1010, 0b1100], 'b': [0b0111, 0b0011]}, 0b1111)
+        self.assertEqual(res['out'], [0b1101, 0b1101, 0b0010])
+
+    def test_sequential_rejected(self):
+        r = pyrtl.Register(4)
+        r.next <<= r + 1
+        with self.assertRaises(pyrtl.PyrtlError):
+            pe.BitslicedSimulation()
+
+
+if __name__ == "__main__":
+    unittest.main()
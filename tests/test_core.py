@@ -100,6 +100,27 @@ class TestCore(unittest.TestCase):
         )
         # sim.tracer.render_trace()
 
+    def test_checked_add(self):
+        i, j = pyrtl.input_list('i/4 j/4')
+        o, overflow = pe.checked_add(i, j, 4)
+        pyrtl.probe(o, 'o')
+        pyrtl.probe(overflow, 'overflow')
+        sim = pyrtl.Simulation()
+        i_vals = [pyrtl.formatted_str_to_val(x, 's4') for x in [-8, -8, -3, 2, 7, 2]]
+        j_vals = [pyrtl.formatted_str_to_val(x, 's4') for x in [-1, -8, 6, -4, 5, 4]]
+        sim.step_multiple({
+            'i': i_vals,
+            'j': j_vals
+        })
+        self.assertEqual(
+            sim.tracer.trace['o'],
+            [0b0111, 0b0000, 0b0011, 0b1110, 0b1100, 0b0110]
+        )
+        self.assertEqual(
+            sim.tracer.trace['overflow'],
+            [1, 1, 0, 0, 1, 0]
+        )
+
     def test_count_ones(self):
         i = pyrtl.Input(4, 'i')
         o = pe.count_ones(i)
@@ -0,0 +1,167 @@
+import unittest
+import itertools
+import math
+import random
+from fractions import Fraction
+import pyrtl
+import pyrtl_extras as pe
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _fixed_value(bits, fmt):
+    """ Exact value of a fixed point bitpattern """
+    if fmt.signed and bits >= 2 ** (fmt.bitwidth - 1):
+        bits -= 2 ** fmt.bitwidth
+    return Fraction(bits, 2 ** fmt.fraction_bits)
+
+
+def _to_fixed(v, fmt, rounding, saturate=True):
+    """ Reference rounding of an exact value into fmt; returns the bitpattern and overflow """
+    scaled = v * 2 ** fmt.fraction_bits
+    r = math.floor(scaled)
+    if rounding == 'nearest':
+        r += scaled - r >= Fraction(1, 2)
+    elif rounding == 'convergent':
+        r = round(scaled)
+    overflow = not fmt.min_int <= r <= fmt.max_int
+    if saturate:
+        r = min(max(r, fmt.min_int), fmt.max_int)
+    return r & (2 ** fmt.bitwidth - 1), int(overflow)
+
+
+class TestFixedPoint(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+
+    def _check_op(self, op, fmt, **kwargs):
+        """ Exhaustively check a two operand function against the exact result """
+        pyrtl.reset_working_block()
+        bw = fmt.bitwidth
+        a, b = pyrtl.input_list('a/%d b/%d' % (bw, bw))
+        res = pyrtl.Output(bw, 'res')
+        overflow = pyrtl.Output(1, 'overflow')
+        f = {'add': pe.fixed_add, 'sub': pe.fixed_sub, 'mul': pe.fixed_mul}[op]
+        res_w, overflow_w = f(a, b, fmt, **kwargs)
+        res <<= res_w
+        overflow <<= overflow_w
+
+        pairs = list(itertools.product(range(2 ** bw), repeat=2))
+        sim = pyrtl.FastSimulation()
+        sim.step_multiple({'a': [x for x, _ in pairs], 'b': [y for _, y in pairs]})
+        for i, (x, y) in enumerate(pairs):
+            vx, vy = _fixed_value(x, fmt), _fixed_value(y, fmt)
+            v = {'add': vx + vy, 'sub': vx - vy, 'mul': vx * vy}[op]
+            expected = _to_fixed(v, fmt, kwargs.get('rounding', 'truncate'),
+                                 kwargs.get('saturate', True))
+            self.assertEqual((sim.tracer.trace['res'][i], sim.tracer.trace['overflow'][i]),
+                             expected, "%s %s %s %s" % (op, fmt, vx, vy))
+
+    def test_q_format(self):
+        q = pe.QFormat(1, 15)
+        self.assertEqual(q.bitwidth, 16)
+        self.assertEqual(str(q), 'Q1.15')
+        self.assertEqual((q.min_value, q.max_value), (-1.0, 1 - 2 ** -15))
+        uq = pe.QFormat(8, 8, signed=False)
+        self.assertEqual(str(uq), 'UQ8.8')
+        self.assertEqual((uq.min_int, uq.max_int), (0, 2 ** 16 - 1))
+        with self.assertRaises(ValueError):
+            pe.QFormat(0, 4)
+        with self.assertRaises(ValueError):
+            pe.fixed_add(pyrtl.Input(16), pyrtl.Input(16), 'Q1_15')
+
+    def test_fixed_add(self):
+        for fmt in (pe.QFormat(2, 2), pe.QFormat(3, 1, signed=False)):
+            for saturate in (True, False):
+                self._check_op('add', fmt, saturate=saturate)
+
+    def test_fixed_sub(self):
+        for fmt in (pe.QFormat(2, 2), pe.QFormat(3, 1, signed=False)):
+            for saturate in (True, False):
+                self._check_op('sub', fmt, saturate=saturate)
+
+    def test_fixed_mul(self):
+        for fmt in (pe.QFormat(2, 2), pe.QFormat(1, 3), pe.QFormat(1, 4, signed=False)):
+            for rounding in ('truncate', 'nearest', 'convergent'):
+                self._check_op('mul', fmt, rounding=rounding)
+        self._check_op('mul', pe.QFormat(2, 3), rounding='nearest', saturate=False)
+
+    def test_fixed_mul_q15(self):
+        a, b = pyrtl.input_list('a/16 b/16')
+        res = pyrtl.Output(16, 'res')
+        res <<= pe.fixed_mul(a, b, 'Q1.15').result
+        fmt = pe.QFormat(1, 15)
+        random.seed(34)
+        xs = [random.getrandbits(16) for _ in range(500)] + [0x8000]
+        ys = [random.getrandbits(16) for _ in range(500)] + [0x8000]
+        sim = pyrtl.FastSimulation()
+        sim.step_multiple({'a': xs, 'b': ys})
+        for x, y, r in zip(xs, ys, sim.tracer.trace['res']):
+            v = _fixed_value(x, fmt) * _fixed_value(y, fmt)
+            self.assertEqual(r, _to_fixed(v, fmt, 'nearest')[0])
+
+    def test_fixed_convert(self):
+        fmts = [pe.QFormat(2, 2), pe.QFormat(1, 3), pe.QFormat(0, 4, signed=False),
+                pe.QFormat(3, 1, signed=False), pe.QFormat(4, 0), pe.QFormat(5, 3)]
+        for from_fmt, to_fmt in itertools.product(fmts, repeat=2):
+            for rounding in ('truncate', 'nearest', 'convergent'):
+                pyrtl.reset_working_block()
+                a = pyrtl.Input(from_fmt.bitwidth, 'a')
+                res = pyrtl.Output(to_fmt.bitwidth, 'res')
+                overflow = pyrtl.Output(1, 'overflow')
+                res_w, overflow_w = pe.fixed_convert(a, from_fmt, to_fmt, rounding)
+                res <<= res_w
+                overflow <<= overflow_w
+                xs = list(range(2 ** from_fmt.bitwidth))
+                sim = pyrtl.FastSimulation()
+                sim.step_multiple({'a': xs})
+                for x, r, o in zip(xs, sim.tracer.trace['res'], sim.tracer.trace['overflow']):
+                    self.assertEqual((r, o), _to_fixed(_fixed_value(x, from_fmt), to_fmt, rounding))
+
+    def test_fixed_bad_width(self):
+        with self.assertRaises(pyrtl.PyrtlError):
+            pe.fixed_mul(pyrtl.Input(16), pyrtl.Input(15), 'Q1.15')
+
+
+@unittest.skipIf(numpy is None, "float_to_fixed and fixed_to_float require NumPy")
+class TestFixedPointConversion(unittest.TestCase):
+    def test_float_to_fixed_scalar(self):
+        self.assertEqual(pe.float_to_fixed(-1.25, 'Q4.12'), 0xec00)
+        self.assertEqual(pe.fixed_to_float(0xec00, 'Q4.12'), -1.25)
+        self.assertEqual(pe.float_to_fixed(2.5, 'UQ2.0', rounding='nearest'), 3)
+        self.assertEqual(pe.float_to_fixed(2.5, 'UQ2.0', rounding='convergent'), 2)
+        self.assertEqual(pe.float_to_fixed(-2.5, 'Q3.0', rounding='truncate'), 0b101)
+
+    def test_float_to_fixed_vectorized(self):
+        fmt = pe.QFormat(1, 15)
+        bits = numpy.arange(2 ** 16)
+        values = pe.fixed_to_float(bits, fmt)
+        self.assertEqual(values[0x8000], -1.0)
+        numpy.testing.assert_array_equal(pe.float_to_fixed(values, fmt), bits)
+        # Halfway between representable values, which all round to even
+        halves = values[values < fmt.max_value] + 2.0 ** -16
+        numpy.testing.assert_array_equal(
+            pe.float_to_fixed(halves, fmt, rounding='convergent') & 1,
+            numpy.zeros(len(halves), dtype=numpy.int64))
+
+    def test_float_to_fixed_saturate(self):
+        self.assertEqual(list(pe.float_to_fixed([1.0, -2.0, math.inf, -math.inf], 'Q1.15')),
+                         [0x7fff, 0x8000, 0x7fff, 0x8000])
+        self.assertEqual(list(pe.float_to_fixed([-1.0, 1e300], 'UQ8.8')), [0, 0xffff])
+        with self.assertRaises(ValueError):
+            pe.float_to_fixed([0.5, 1.0], 'Q1.15', saturate=False)
+        with self.assertRaises(ValueError):
+            pe.float_to_fixed(math.nan, 'Q1.15')
+
+    def test_float_to_fixed_wide(self):
+        fmt = pe.QFormat(8, 56)
+        self.assertEqual(pe.float_to_fixed(-1.0, fmt), 2 ** 64 - 2 ** 56)
+        self.assertEqual(pe.fixed_to_float(2 ** 64 - 2 ** 56, fmt), -1.0)
+        self.assertEqual(pe.float_to_fixed(1e300, fmt), 2 ** 63 - 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
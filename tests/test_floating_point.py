@@ -1,8 +1,62 @@
 import unittest
+import itertools
 import math
+import random
+import struct
+from fractions import Fraction
 import pyrtl
 import pyrtl_extras as pe
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _fp_value(bits, eb, fb):
+    """ Exact value of a (non-special) floating point bit pattern; subnormals are zero """
+    s, e, f = bits >> (eb + fb), (bits >> fb) & (2 ** eb - 1), bits & (2 ** fb - 1)
+    if e == 0:
+        return Fraction(0)
+    v = Fraction(2 ** fb + f, 2 ** fb) * Fraction(2) ** (e - (2 ** (eb - 1) - 1))
+    return -v if s else v
+
+
+def _round_to_fp(v, eb, fb):
+    """ Round an exact value to nearest even, overflowing to infinity and
+    flushing anything below the smallest normal number to zero.
+    """
+    s = 1 if v < 0 else 0
+    v = abs(v)
+    if v == 0:
+        return 0
+    e = v.numerator.bit_length() - v.denominator.bit_length()
+    if Fraction(2) ** e > v:
+        e -= 1
+    m = v / Fraction(2) ** e * 2 ** fb
+    q, r = divmod(m.numerator, m.denominator)
+    if 2 * r > m.denominator or (2 * r == m.denominator and q & 1):
+        q += 1
+    if q == 2 ** (fb + 1):
+        q, e = q // 2, e + 1
+    e += 2 ** (eb - 1) - 1
+    if e <= 0:
+        return s << (eb + fb)
+    if e >= 2 ** eb - 1:
+        return (s << (eb + fb)) | ((2 ** eb - 1) << fb)
+    return (s << (eb + fb)) | (e << fb) | (q - 2 ** fb)
+
+
+def _half(x):
+    """ IEEE half precision bit pattern of x """
+    return struct.unpack('<H', struct.pack('<e', x))[0]
+
+
+def _random_normal(eb, fb, sign=None):
+    s = random.getrandbits(1) if sign is None else sign
+    return (s << (eb + fb)) | (random.randint(1, 2 ** eb - 2) << fb) | random.getrandbits(fb)
+
+
 class TestFloatingPoint(unittest.TestCase):
     def setUp(self):
         pyrtl.reset_working_block()
@@ -20,6 +74,472 @@ class TestFloatingPoint(unittest.TestCase):
         # TODO
         #sim.tracer.render_trace(repr_func=pe.binf(16, 16), symbol_len=None)
 
+    def _check_fp_add_dual_path(self, precision, eb, fb, pairs):
+        w = 1 + eb + fb
+        a, b = pyrtl.input_list('a/%d b/%d' % (w, w))
+        res = pyrtl.Output(w, 'res')
+        res <<= pe.fp_add_dual_path(a, b, precision=precision)
+        sim = pyrtl.Simulation()
+        sim.step_multiple({'a': [p[0] for p in pairs], 'b': [p[1] for p in pairs]})
+        for (x, y), r in zip(pairs, sim.tracer.trace['res']):
+            expected = _round_to_fp(_fp_value(x, eb, fb) + _fp_value(y, eb, fb), eb, fb)
+            self.assertEqual(r, expected, "%s + %s" % (bin(x), bin(y)))
+
+    def test_fp_add_dual_path_half(self):
+        self._check_fp_add_dual_path('half', 5, 10, [
+            (_half(0.5), _half(3.75)),
+            (_half(1.0), _half(-0.99951171875)),
+            (_half(-5.0), _half(5.0)),
+            (_half(65504), _half(65504)),
+            (_half(2 ** -14), _half(-1.5 * 2 ** -14)),
+            (_half(1024), _half(0.5)),
+            (_half(1024), _half(1.5)),
+        ])
+
+    def test_fp_add_dual_path_random(self):
+        random.seed(26)
+        pairs = []
+        for _ in range(500):
+            x = _random_normal(5, 10)
+            # Nearby exponents with opposite signs exercise the near path
+            y = _random_normal(5, 10, sign=(x >> 15) ^ 1) if random.random() < 0.5 else \
+                _random_normal(5, 10)
+            if random.random() < 0.5:
+                y = (y & ~(0x1f << 10)) | (min(max((x >> 10 & 0x1f) + random.randint(-1, 1), 1),
+                                               30) << 10)
+            pairs.append((x, y))
+        self._check_fp_add_dual_path('half', 5, 10, pairs)
+
+    def test_fp_add_dual_path_random_single(self):
+        random.seed(260)
+        pairs = [(_random_normal(8, 23), _random_normal(8, 23)) for _ in range(200)]
+        self._check_fp_add_dual_path('single', 8, 23, pairs)
+
+    def test_fp_add_dual_path_special(self):
+        a, b = pyrtl.input_list('a/16 b/16')
+        res = pyrtl.Output(16, 'res')
+        res <<= pe.fp_add_dual_path(a, b, precision='half')
+        sim = pyrtl.Simulation()
+        inf, one = pe.float_to_fp(math.inf, 'half'), pe.float_to_fp(1.0, 'half')
+        neg_inf, neg_zero = inf | 0x8000, 0x8000
+        sim.step_multiple({
+            'a': [0, neg_zero, neg_zero, inf, inf, pe.float_to_fp(math.nan, 'half'), one],
+            'b': [one, neg_zero, 0, one, neg_inf, one, 0],
+        })
+        r = sim.tracer.trace['res']
+        self.assertEqual(r[:5], [one, neg_zero, 0, inf, r[4]])
+        self.assertTrue(math.isnan(pe.fp_to_float(r[4], 'half')))
+        self.assertTrue(math.isnan(pe.fp_to_float(r[5], 'half')))
+        self.assertEqual(r[6], one)
+
+    def _check_fp_mul(self, precision, eb, fb, pairs, pipelined=False):
+        w = 1 + eb + fb
+        a, b = pyrtl.input_list('a/%d b/%d' % (w, w))
+        res = pyrtl.Output(w, 'res')
+        res <<= pe.fp_mul(a, b, precision=precision, pipelined=pipelined)
+        sim = pyrtl.Simulation()
+        sim.step_multiple({'a': [p[0] for p in pairs] + [0, 0],
+                           'b': [p[1] for p in pairs] + [0, 0]})
+        trace = sim.tracer.trace['res'][2:] if pipelined else sim.tracer.trace['res']
+        for (x, y), r in zip(pairs, trace):
+            expected = _round_to_fp(_fp_value(x, eb, fb) * _fp_value(y, eb, fb), eb, fb)
+            self.assertEqual(r, expected, "%s * %s" % (bin(x), bin(y)))
+
+    def test_fp_mul_half(self):
+        self._check_fp_mul('half', 5, 10, [
+            (_half(1.5), _half(2.5)),
+            (_half(-3.0), _half(0.1)),
+            (_half(255.875), _half(-255.875)),
+            (_half(2 ** -10), _half(2 ** -10)),
+        ])
+
+    def test_fp_mul_random(self):
+        random.seed(27)
+        pairs = [(_random_normal(5, 10), _random_normal(5, 10)) for _ in range(500)]
+        self._check_fp_mul('half', 5, 10, pairs)
+
+    def test_fp_mul_random_single(self):
+        random.seed(270)
+        pairs = [(_random_normal(8, 23), _random_normal(8, 23)) for _ in range(200)]
+        self._check_fp_mul('single', 8, 23, pairs)
+
+    def test_fp_mul_pipelined(self):
+        random.seed(271)
+        pairs = [(_random_normal(5, 10), _random_normal(5, 10)) for _ in range(50)]
+        self._check_fp_mul('half', 5, 10, pairs, pipelined=True)
+
+    def test_fp_mul_special(self):
+        a, b = pyrtl.input_list('a/16 b/16')
+        res = pyrtl.Output(16, 'res')
+        res <<= pe.fp_mul(a, b, precision='half')
+        sim = pyrtl.Simulation()
+        inf, two = pe.float_to_fp(math.inf, 'half'), _half(2.0)
+        sim.step_multiple({
+            'a': [0, _half(-2.0), inf, inf],
+            'b': [two, 0, _half(-2.0), 0],
+        })
+        r = sim.tracer.trace['res']
+        self.assertEqual(r[:3], [0, 0x8000, inf | 0x8000])
+        self.assertTrue(math.isnan(pe.fp_to_float(r[3], 'half')))
+
+    def _check_fp_fma(self, precision, eb, fb, triples):
+        w = 1 + eb + fb
+        a, b, c = pyrtl.input_list('a/%d b/%d c/%d' % (w, w, w))
+        res = pyrtl.Output(w, 'res')
+        res <<= pe.fp_fma(a, b, c, precision=precision)
+        sim = pyrtl.Simulation()
+        sim.step_multiple({'a': [t[0] for t in triples], 'b': [t[1] for t in triples],
+                           'c': [t[2] for t in triples]})
+        for (x, y, z), r in zip(triples, sim.tracer.trace['res']):
+            v = _fp_value(x, eb, fb) * _fp_value(y, eb, fb) + _fp_value(z, eb, fb)
+            self.assertEqual(r, _round_to_fp(v, eb, fb), "%s * %s + %s" % (x, y, z))
+
+    def test_fp_fma_half(self):
+        self._check_fp_fma('half', 5, 10, [
+            (_half(1.5), _half(2.5), _half(0.25)),
+            (_half(3.0), _half(0.1), _half(-0.3)),
+            # Fused: 1.00098 * 1.00098 - 1 keeps the bits a separate multiply rounds away
+            (_half(1 + 2 ** -10), _half(1 + 2 ** -10), _half(-1.0)),
+            (_half(2 ** -10), _half(2 ** -10), _half(1024)),
+            (_half(1024), _half(32), _half(2 ** -14)),
+        ])
+
+    def test_fp_fma_random(self):
+        random.seed(28)
+        triples = []
+        for _ in range(500):
+            x, y = _random_normal(5, 10), _random_normal(5, 10)
+            z = _random_normal(5, 10)
+            if random.random() < 0.5:
+                # Addend close to -(x * y), for heavy cancellation
+                z = _round_to_fp(-_fp_value(x, 5, 10) * _fp_value(y, 5, 10), 5, 10)
+                if (z >> 10) & 0x1f in (0, 0x1f):
+                    z = _random_normal(5, 10)
+                z ^= random.getrandbits(random.randint(0, 10))
+            triples.append((x, y, z))
+        self._check_fp_fma('half', 5, 10, triples)
+
+    def test_fp_fma_random_single(self):
+        random.seed(280)
+        triples = [tuple(_random_normal(8, 23) for _ in range(3)) for _ in range(200)]
+        self._check_fp_fma('single', 8, 23, triples)
+
+    def test_fp_fma_subnormal_addend(self):
+        random.seed(2800)
+        triples = [(_random_normal(4, 3), _random_normal(4, 3),
+                    (random.getrandbits(1) << 7) | random.randint(1, 7)) for _ in range(500)]
+        self._check_fp_fma('fp8_e4m3', 4, 3, triples)
+        pyrtl.reset_working_block()
+        triples = [(_random_normal(5, 10), _random_normal(5, 10),
+                    (random.getrandbits(1) << 15) | random.randint(1, 2 ** 10 - 1))
+                   for _ in range(500)]
+        self._check_fp_fma('half', 5, 10, triples)
+
+    def test_fp_fma_one_fraction_bit(self):
+        # Every finite triple; with p = 2 the guard bit is close to the sticky bit
+        eb, fb = 3, 1
+        w = 1 + eb + fb
+        a, b, c = pyrtl.input_list('a/%d b/%d c/%d' % (w, w, w))
+        res = pyrtl.Output(w, 'res')
+        res <<= pe.fp_fma(a, b, c, precision=pe.FPFormat(eb, fb))
+        finite = [x for x in range(2 ** w) if (x >> fb) & (2 ** eb - 1) != 2 ** eb - 1]
+        triples = list(itertools.product(finite, repeat=3))
+        sim = pe.BitslicedSimulation()
+        sim.step_multiple({'a': [t[0] for t in triples], 'b': [t[1] for t in triples],
+                           'c': [t[2] for t in triples]})
+        for (x, y, z), r in zip(triples, sim.tracer.trace['res']):
+            product, addend = _fp_value(x, eb, fb) * _fp_value(y, eb, fb), _fp_value(z, eb, fb)
+            if product == 0 and addend == 0:
+                # Signed zeros: negative only if both are
+                expected = (x ^ y) & z & (1 << (w - 1))
+            else:
+                expected = _round_to_fp(product + addend, eb, fb)
+            self.assertEqual(r, expected, "%#x * %#x + %#x" % (x, y, z))
+
+    def test_fp_fma_special(self):
+        a, b, c = pyrtl.input_list('a/16 b/16 c/16')
+        res = pyrtl.Output(16, 'res')
+        res <<= pe.fp_fma(a, b, c, precision='half')
+        sim = pyrtl.Simulation()
+        inf, two = pe.float_to_fp(math.inf, 'half'), _half(2.0)
+        sim.step_multiple({
+            'a': [0, two, inf, inf, two],
+            'b': [two, 0x8000, two, two, two],
+            'c': [0x8000, 0x8000, two, inf | 0x8000, _half(-4.0)],
+        })
+        r = sim.tracer.trace['res']
+        self.assertEqual(r[:3], [0, 0x8000, inf])
+        self.assertTrue(math.isnan(pe.fp_to_float(r[3], 'half')))
+        self.assertEqual(r[4], 0)
+
+    def test_fp_add_dual_path_bfloat16(self):
+        random.seed(29)
+        pairs = [(_random_normal(8, 7), _random_normal(8, 7)) for _ in range(300)]
+        self._check_fp_add_dual_path('bfloat16', 8, 7, pairs)
+
+    def test_fp_mul_fp8(self):
+        random.seed(290)
+        pairs = [(_random_normal(4, 3), _random_normal(4, 3)) for _ in range(300)]
+        self._check_fp_mul('fp8_e4m3', 4, 3, pairs)
+        pyrtl.reset_working_block()
+        pairs = [(_random_normal(5, 2), _random_normal(5, 2)) for _ in range(300)]
+        self._check_fp_mul('fp8_e5m2', 5, 2, pairs)
+
+    def test_fp_fma_custom_format(self):
+        random.seed(291)
+        triples = [tuple(_random_normal(6, 9) for _ in range(3)) for _ in range(300)]
+        self._check_fp_fma(pe.FPFormat(6, 9), 6, 9, triples)
+
+    def test_fp_add_custom_format_bitwidth(self):
+        a, b = pyrtl.input_list('a/16 b/16')
+        self.assertEqual(len(pe.fp_add(a, b, precision='bfloat16')), 16)
+        self.assertEqual(len(pe.fp_add(a, b, precision=pe.FPFormat(6, 9))), 16)
+
+    def test_fp_format(self):
+        self.assertEqual(pe.FPFormat(8, 7).bias, 127)
+        self.assertEqual(pe.FPFormat(8, 7).bitwidth, 16)
+        self.assertEqual(pe.FPFormat(4, 3, bias=8).bias, 8)
+        with self.assertRaises(ValueError):
+            pe.float_to_fp(1.0, precision='float8')
+        with self.assertRaises(ValueError):
+            pe.FPFormat(1, 3)
+
+    def test_float_to_fp_reduced_precision(self):
+        self.assertEqual(pe.float_to_fp(1.0, 'bfloat16'), 0x3f80)
+        self.assertEqual(pe.float_to_fp(-2.5, 'bfloat16'), 0xc020)
+        # 1 + 2 ** -8 is a tie between 1.0 and 1 + 2 ** -7, so it rounds to the even 1.0
+        self.assertEqual(pe.float_to_fp(1 + 2 ** -8, 'bfloat16'), 0x3f80)
+        self.assertEqual(pe.float_to_fp(240.0, 'fp8_e4m3'), 0b01110111)
+        self.assertEqual(pe.float_to_fp(-0.375, 'fp8_e5m2'), 0b10110110)
+        self.assertEqual(pe.float_to_fp(1.5, pe.FPFormat(6, 9)), 0b0011111100000000)
+
+    def test_fp_to_float_reduced_precision(self):
+        self.assertEqual(pe.fp_to_float(0x4049, 'bfloat16'), 3.140625)
+        self.assertEqual(pe.fp_to_float(0b01110111, 'fp8_e4m3'), 240.0)
+        self.assertEqual(pe.fp_to_float(0b10110110, 'fp8_e5m2'), -0.375)
+        self.assertEqual(pe.fp_to_float(0b01111100, 'fp8_e5m2'), math.inf)
+        for x in (0.015625, 0.5, 1.0, 1.25, 3.5, -57344.0):
+            self.assertEqual(pe.fp_to_float(pe.float_to_fp(x, 'fp8_e5m2'), 'fp8_e5m2'), x)
+
+    def test_float_in_range_reduced_precision(self):
+        self.assertTrue(pe.float_in_range(240, 'fp8_e4m3'))
+        self.assertFalse(pe.float_in_range(241, 'fp8_e4m3'))
+        self.assertTrue(pe.float_in_range(2 ** -6, 'fp8_e4m3'))
+        self.assertFalse(pe.float_in_range(2 ** -7, 'fp8_e4m3'))
+        self.assertTrue(pe.float_in_range(3.0e38, 'bfloat16'))
+        self.assertFalse(pe.float_in_range(2 ** -127, 'bfloat16'))
+
+    def _check_fp_convert(self, src, dst, values):
+        (seb, sfb), (deb, dfb) = src[1:], dst[1:]
+        a = pyrtl.Input(1 + seb + sfb, 'a')
+        res = pyrtl.Output(1 + deb + dfb, 'res')
+        res <<= pe.fp_convert(a, src[0], dst[0])
+        sim = pyrtl.Simulation()
+        sim.step_multiple({'a': values})
+        for x, r in zip(values, sim.tracer.trace['res']):
+            self.assertEqual(r, _round_to_fp(_fp_value(x, seb, sfb), deb, dfb), bin(x))
+
+    def test_fp_convert_narrowing(self):
+        random.seed(30)
+        values = [_random_normal(8, 23) for _ in range(300)]
+        values += [pe.float_to_fp(1 + 2 ** -11), pe.float_to_fp(1 + 3 * 2 ** -11),
+                   pe.float_to_fp(65519.0), pe.float_to_fp(65520.0)]
+        self._check_fp_convert(('single', 8, 23), ('half', 5, 10), values)
+
+    def test_fp_convert_widening(self):
+        random.seed(300)
+        self._check_fp_convert(('bfloat16', 8, 7), ('single', 8, 23),
+                               [_random_normal(8, 7) for _ in range(300)])
+
+    def test_fp_convert_reduced_range(self):
+        random.seed(301)
+        self._check_fp_convert(('bfloat16', 8, 7), ('fp8_e5m2', 5, 2),
+                               [_random_normal(8, 7) for _ in range(300)])
+
+    def test_fp_convert_special(self):
+        a = pyrtl.Input(16, 'a')
+        res = pyrtl.Output(32, 'res')
+        res <<= pe.fp_convert(a, 'half', 'single')
+        sim = pyrtl.Simulation()
+        sim.step_multiple({'a': [0x8000, pe.float_to_fp(-math.inf, 'half'),
+                                 pe.float_to_fp(math.nan, 'half')]})
+        r = sim.tracer.trace['res']
+        self.assertEqual(r[:2], [0x80000000, pe.float_to_fp(-math.inf)])
+        self.assertTrue(math.isnan(pe.fp_to_float(r[2])))
+
+    def test_fp_convert_memory(self):
+        # Store bfloat16 values, compute on single precision reads
+        mem = pyrtl.MemBlock(16, 2, name='mem', max_read_ports=2, asynchronous=True)
+        addr = pyrtl.Input(2, 'addr')
+        res = pyrtl.Output(32, 'res')
+        res <<= pe.fp_add_dual_path(pe.fp_convert(mem[addr], 'bfloat16', 'single'),
+                                    pe.fp_convert(mem[(addr + 1)[:2]], 'bfloat16', 'single'))
+        values = [1.5, 0.0078125, -3.0, 1024.0]
+        sim = pyrtl.Simulation(memory_value_map={
+            mem: {i: pe.float_to_fp(v, 'bfloat16') for i, v in enumerate(values)}})
+        sim.step_multiple({'addr': [0, 1, 2]})
+        self.assertEqual([pe.fp_to_float(r) for r in sim.tracer.trace['res']],
+                         [1.5078125, -2.9921875, 1021.0])
+
+    def test_int_to_fp(self):
+        random.seed(302)
+        i = pyrtl.Input(20, 'i')
+        res_s, res_u = pyrtl.Output(16, 'res_s'), pyrtl.Output(16, 'res_u')
+        res_s <<= pe.int_to_fp(i, 'half', signed=True)
+        res_u <<= pe.int_to_fp(i, 'half')
+        values = [0, 1, 2 ** 19, 2 ** 20 - 1, 2049, 2051, 65519, 65520] + \
+            [random.getrandbits(random.randint(1, 20)) for _ in range(200)]
+        sim = pyrtl.Simulation()
+        sim.step_multiple({'i': values})
+        for v, s, u in zip(values, sim.tracer.trace['res_s'], sim.tracer.trace['res_u']):
+            signed_v = pyrtl.val_to_signed_integer(v, 20)
+            self.assertEqual(s, _round_to_fp(Fraction(signed_v), 5, 10), signed_v)
+            self.assertEqual(u, _round_to_fp(Fraction(v), 5, 10), v)
+
+    def test_fp_to_int(self):
+        a = pyrtl.Input(16, 'a')
+        res_s, res_u = pyrtl.Output(8, 'res_s'), pyrtl.Output(8, 'res_u')
+        res_s <<= pe.fp_to_int(a, 8, 'half', signed=True)
+        res_u <<= pe.fp_to_int(a, 8, 'half')
+        values = [0.0, 0.25, 0.5, 1.5, 2.5, -2.5, 127.4, 127.5, -128.0, -129.0, 255.5, 1000.0,
+                  -0.75, math.inf, -math.inf, math.nan]
+        sim = pyrtl.Simulation()
+        sim.step_multiple({'a': [_half(v) for v in values]})
+        self.assertEqual(
+            [pyrtl.val_to_signed_integer(r, 8) for r in sim.tracer.trace['res_s']],
+            [0, 0, 0, 2, 2, -2, 127, 127, -128, -128, 127, 127, -1, 127, -128, 0])
+        self.assertEqual(
+            sim.tracer.trace['res_u'],
+            [0, 0, 0, 2, 2, 0, 127, 128, 0, 0, 255, 255, 0, 255, 0, 0])
+
+    def test_fp_to_sortable(self):
+        a = pyrtl.Input(16, 'a')
+        key, back = pyrtl.Output(16, 'key'), pyrtl.Output(16, 'back')
+        sortable = pe.fp_to_sortable(a)
+        key <<= sortable
+        back <<= pe.sortable_to_fp(sortable)
+        # Every half precision bitpattern that isn't NaN or subnormal
+        patterns = [v for v in range(2 ** 16)
+                    if 0 < (v >> 10) & 0x1f < 0x1f or v & 0x7fff in (0, 0x7c00)]
+        sim = pyrtl.FastSimulation()
+        sim.step_multiple({'a': patterns})
+        self.assertEqual(sim.tracer.trace['back'], patterns)
+        by_key = [p for _, p in sorted(zip(sim.tracer.trace['key'], patterns))]
+        values = [pe.fp_to_float(p, 'half') for p in by_key]
+        self.assertEqual(values, sorted(values))
+        self.assertEqual(len(set(sim.tracer.trace['key'])), len(patterns))
+
+    def test_fp_add_packed(self):
+        random.seed(31)
+        x, y = pyrtl.input_list('x/64 y/64')
+        mode = pyrtl.Input(2, 'mode')
+        res = pyrtl.Output(64, 'res')
+        res <<= pe.fp_add_packed(x, y, mode)
+        lanes = {0: [(0, 11, 52)], 1: [(0, 8, 23), (32, 8, 23)],
+                 2: [(lo, 5, 10) for lo in (0, 16, 32, 48)]}
+        xs, ys, modes = [], [], []
+        for _ in range(100):
+            m = random.randint(0, 2)
+            xv = yv = 0
+            for lo, eb, fb in lanes[m]:
+                a, b = _random_normal(eb, fb), _random_normal(eb, fb)
+                if random.random() < 0.5:
+                    # Nearby exponents, for cancellation
+                    e = min(max(((a >> fb) & (2 ** eb - 1)) + random.randint(-1, 1), 1),
+                            2 ** eb - 2)
+                    b = (b & ~((2 ** eb - 1) << fb)) | (e << fb)
+                xv, yv = xv | (a << lo), yv | (b << lo)
+            xs.append(xv)
+            ys.append(yv)
+            modes.append(m)
+        sim = pyrtl.Simulation()
+        sim.step_multiple({'x': xs, 'y': ys, 'mode': modes})
+        for xv, yv, m, r in zip(xs, ys, modes, sim.tracer.trace['res']):
+            for lo, eb, fb in lanes[m]:
+                mask = 2 ** (1 + eb + fb) - 1
+                a, b = (xv >> lo) & mask, (yv >> lo) & mask
+                expected = _round_to_fp(_fp_value(a, eb, fb) + _fp_value(b, eb, fb), eb, fb)
+                self.assertEqual((r >> lo) & mask, expected, "mode %d lane %d" % (m, lo))
+
+    def test_fp_add_packed_lanes_independent(self):
+        x, y = pyrtl.input_list('x/64 y/64')
+        mode = pyrtl.Input(2, 'mode')
+        res = pyrtl.Output(64, 'res')
+        res <<= pe.fp_add_packed(x, y, mode)
+        halves = [_half(v) for v in (1.0, -2.0, math.inf, 65504.0)]
+        others = [_half(v) for v in (-1.0, 0.5, -math.inf, 65504.0)]
+        sim = pyrtl.Simulation()
+        sim.step_multiple({
+            'x': [sum(h << (16 * i) for i, h in enumerate(halves)),
+                  pe.float_to_fp(1.5, 'double'),
+                  pe.float_to_fp(3.0) | (pe.float_to_fp(-3.0) << 32)],
+            'y': [sum(h << (16 * i) for i, h in enumerate(others)),
+                  pe.float_to_fp(2.0 ** -40, 'double'),
+                  pe.float_to_fp(-3.0) | (pe.float_to_fp(0.25) << 32)],
+            'mode': [2, 0, 1],
+        })
+        r = sim.tracer.trace['res']
+        lanes = [(r[0] >> (16 * i)) & 0xffff for i in range(4)]
+        self.assertEqual(lanes[0], 0)
+        self.assertEqual(lanes[1], _half(-1.5))
+        self.assertTrue(math.isnan(pe.fp_to_float(lanes[2], 'half')))
+        self.assertEqual(lanes[3], pe.float_to_fp(math.inf, 'half'))
+        self.assertEqual(r[1], pe.float_to_fp(1.5 + 2.0 ** -40, 'double'))
+        self.assertEqual(r[2], pe.float_to_fp(-2.75) << 32)
+
+    def test_fp_add_packed_bad_width(self):
+        x, y = pyrtl.input_list('x/32 y/32')
+        with self.assertRaises(pyrtl.PyrtlError):
+            pe.fp_add_packed(x, y, pyrtl.Input(2, 'mode'))
+
+    def test_fp_long_accumulator(self):
+        x = pyrtl.Input(16, 'x')
+        valid, clear = pyrtl.input_list('valid/1 clear/1')
+        res = pyrtl.Output(16, 'res')
+        res <<= pe.fp_long_accumulator(x, valid, clear, precision='half')[0]
+        # Adding 1.0 to 2048.0 is lost in half precision, but not here
+        values = [2048.0, 1.0, 1.0, 1.0, 1.0, -2048.0, 0.5, 3.0, 2 ** -14, -2 ** -14, 0.0]
+        sim = pyrtl.Simulation()
+        sim.step_multiple({
+            'x': [_half(v) for v in values],
+            'valid': [1, 1, 1, 1, 1, 1, 0, 1, 1, 1, 0],
+            'clear': [1, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0],
+        })
+        self.assertEqual([pe.fp_to_float(r, 'half') for r in sim.tracer.trace['res']],
+                         [0.0, 2048.0, 2048.0, 2050.0, 2052.0, 2052.0, 4.0, 4.0, 3.0, 3.0, 3.0])
+
+    def test_fp_long_accumulator_random(self):
+        random.seed(32)
+        x = pyrtl.Input(16, 'x')
+        res = pyrtl.Output(16, 'res')
+        res <<= pe.fp_long_accumulator(x, 1, 0, precision='half')[0]
+        values = [_random_normal(5, 10) & 0xbfff for _ in range(200)]
+        sim = pyrtl.Simulation()
+        sim.step_multiple({'x': values})
+        total = Fraction(0)
+        for v, r in zip(values, sim.tracer.trace['res']):
+            self.assertEqual(r, _round_to_fp(total, 5, 10))
+            total += _fp_value(v, 5, 10)
+
+    def test_fp_long_accumulator_special(self):
+        x = pyrtl.Input(16, 'x')
+        clear = pyrtl.Input(1, 'clear')
+        res = pyrtl.Output(16, 'res')
+        res <<= pe.fp_long_accumulator(x, 1, clear, precision='half', carry_bits=1)[0]
+        inf, big = pe.float_to_fp(math.inf, 'half'), _half(65504.0)
+        sim = pyrtl.Simulation()
+        sim.step_multiple({
+            'x': [inf, _half(1.0), inf | 0x8000, big, big, big, big, _half(-1.0), 0],
+            'clear': [0, 0, 0, 1, 0, 0, 0, 1, 0],
+        })
+        r = sim.tracer.trace['res']
+        self.assertEqual(r[1:3], [inf, inf])
+        self.assertTrue(math.isnan(pe.fp_to_float(r[3], 'half')))
+        # 2 * 65504 overflows the format, but the register is still exact
+        self.assertEqual(r[4:6], [big, inf])
+        # The fourth add overflows the register itself
+        self.assertEqual(r[7:], [inf, _half(-1.0)])
+
     def test_fp_to_float_single_precision(self):
         self.assertEqual(
             pe.fp_to_float(0b01000011101001001011001000000000, precision='single'),
@@ -125,5 +645,63 @@ class TestFloatingPoint(unittest.TestCase):
         # )
 
 
+@unittest.skipIf(numpy is None, "fp_add_model requires NumPy")
+class TestFloatingPointModel(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+
+    def _check_fp_add_against_model(self, precision, bitwidth, nvectors, seed):
+        """ Drive fp_add with random bitpatterns and compare against the model in bulk """
+        rng = numpy.random.default_rng(seed)
+        xs = [int(v) for v in rng.integers(0, 2 ** min(bitwidth, 63), nvectors)]
+        ys = [int(v) for v in rng.integers(0, 2 ** min(bitwidth, 63), nvectors)]
+        if bitwidth > 63:
+            xs = [x | (random.getrandbits(bitwidth - 63) << 63) for x in xs]
+            ys = [y | (random.getrandbits(bitwidth - 63) << 63) for y in ys]
+        a, b = pyrtl.input_list('a/%d b/%d' % (bitwidth, bitwidth))
+        res = pyrtl.Output(bitwidth, 'res')
+        res <<= pe.fp_add(a, b, precision=precision)
+        sim = pyrtl.FastSimulation()
+        sim.step_multiple({'a': xs, 'b': ys})
+
+        expected = pe.fp_add_model(xs, ys, precision=precision)
+        actual = numpy.array(sim.tracer.trace['res'], dtype=expected.dtype)
+        mismatches = numpy.flatnonzero(actual != expected)
+        if len(mismatches):
+            i = mismatches[0]
+            self.fail("%d of %d vectors differ, first: fp_add(%s, %s) = %s, model says %s" % (
+                len(mismatches), nvectors, hex(xs[i]), hex(ys[i]), hex(actual[i]),
+                hex(expected[i])))
+
+    def test_fp_add_model_half(self):
+        self._check_fp_add_against_model('half', 16, 20000, 33)
+
+    def test_fp_add_model_single(self):
+        self._check_fp_add_against_model('single', 32, 20000, 330)
+
+    def test_fp_add_model_double(self):
+        self._check_fp_add_against_model('double', 64, 5000, 331)
+
+    def test_fp_add_model_quad(self):
+        random.seed(332)
+        self._check_fp_add_against_model('quad', 128, 1000, 332)
+
+    def test_fp_add_model_reduced_precision(self):
+        self._check_fp_add_against_model('fp8_e5m2', 8, 5000, 333)
+        pyrtl.reset_working_block()
+        self._check_fp_add_against_model('bfloat16', 16, 5000, 334)
+
+    def test_fp_add_model_scalar(self):
+        # 0.5 + 3.75 (see TestFloatingPoint.test_fp_add)
+        self.assertEqual(int(pe.fp_add_model(0x3800, 0x4700, precision='half')), 0x1000)
+
+    def test_fp_add_model_bulk(self):
+        # Millions of pairs run in well under a second; fp_add is symmetric in its operands
+        rng = numpy.random.default_rng(335)
+        xs = rng.integers(0, 2 ** 32, 2000000, dtype=numpy.uint64)
+        ys = rng.integers(0, 2 ** 32, 2000000, dtype=numpy.uint64)
+        numpy.testing.assert_array_equal(pe.fp_add_model(xs, ys), pe.fp_add_model(ys, xs))
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,49 @@
+import unittest
+import itertools
+import random
+
+from pyrtl_extras.sat import _CDCLSolver, _luby
+
+
+def _satisfiable(clauses, nvars):
+    return any(all(any((lit > 0) == bits[abs(lit) - 1] for lit in c) for c in clauses)
+               for bits in itertools.product((False, True), repeat=nvars))
+
+
+class TestCDCLSolver(unittest.TestCase):
+    def test_luby(self):
+        self.assertEqual([_luby(i) for i in range(15)],
+                         [1, 1, 2, 1, 1, 2, 4, 1, 1, 2, 1, 1, 2, 4, 8])
+
+    def test_random_3sat(self):
+        random.seed(48)
+        for _ in range(200):
+            nvars = random.randint(3, 9)
+            clauses = [[random.choice((-1, 1)) * random.randint(1, nvars) for _ in range(3)]
+                       for _ in range(random.randint(1, 5 * nvars))]
+            solver = _CDCLSolver()
+            for c in clauses:
+                solver.add_clause(c)
+            assumptions = [random.choice((-1, 1)) * random.randint(1, nvars)]
+            for assumed in (assumptions, []):
+                model = solver.solve(assumed)
+                all_clauses = clauses + [[lit] for lit in assumed]
+                self.assertEqual(model is not None, _satisfiable(all_clauses, nvars))
+                if model is not None:
+                    self.assertTrue(all(any(model[abs(lit)] == (lit > 0) for lit in c)
+                                        for c in all_clauses))
+
+    def test_pigeonhole(self):
+        # 5 pigeons don't fit in 4 holes
+        solver = _CDCLSolver()
+        var = {(p, h): 4 * p + h + 1 for p in range(5) for h in range(4)}
+        for p in range(5):
+            solver.add_clause([var[p, h] for h in range(4)])
+        for h in range(4):
+            for p, q in itertools.combinations(range(5), 2):
+                solver.add_clause([-var[p, h], -var[q, h]])
+        self.assertIsNone(solver.solve())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,6 +2,7 @@ import pyrtl
 import unittest
 import random
 import itertools
+import struct
 import pyrtl_extras as pe
 
 class TestBitonicSort(unittest.TestCase):
@@ -51,10 +52,11 @@ class TestBitonicSort(unittest.TestCase):
             pe.bitonic_sort()
         self.assertEqual(str(ex.exception), 'bitonic_sort requires at least one argument to sort')
 
-    def test_bitonic_sort_5_raises_exception(self):
-        with self.assertRaises(Exception) as ex:
-            self._run_test(5, 8)
-        self.assertEqual(str(ex.exception), 'number of arguments to bitonic_sort must be a power of 2')
+    def test_bitonic_sort_5_nargs_8_bw_unsigned(self):
+        self._run_test(5, 8)
+
+    def test_bitonic_sort_6_nargs_8_bw_signed(self):
+        self._run_test(6, 8, signed=True)
 
     def test_bitonic_sort_1_nargs_8_bw_signed(self):
         self._run_test(1, 8, signed=True)
@@ -71,5 +73,346 @@ class TestBitonicSort(unittest.TestCase):
     def test_bitonic_sort_16_nargs_8_bw_signed(self):
         self._run_test(16, 8, signed=True)
 
+    def test_bitonic_sort_fp_key(self):
+        ins = pyrtl.input_list([f'i{i}' for i in range(8)], 32)
+        outs = pe.bitonic_sort(*ins, key='fp')
+        for i, out in enumerate(outs):
+            pyrtl.probe(out, f'o{i}')
+
+        sim = pyrtl.Simulation()
+        floats = [1.5, -0.0, float('-inf'), -2.75, 0.0, 2.0 ** -100, float('inf'), -2.0 ** 100]
+        random.seed(35)
+        for _ in range(5):
+            random.shuffle(floats)
+            sim.step({f'i{i}': struct.unpack('>I', struct.pack('>f', f))[0]
+                      for i, f in enumerate(floats)})
+            result = [pe.fp_to_float(sim.inspect(f'o{i}')) for i in range(8)]
+            self.assertEqual(result, sorted(floats))
+            # -0 sorts below +0
+            self.assertEqual((sim.inspect('o3'), sim.inspect('o4')), (2 ** 31, 0))
+
+    def test_bitonic_sort_bad_key(self):
+        with self.assertRaises(pyrtl.PyrtlError):
+            pe.bitonic_sort(*pyrtl.input_list('a/8 b/8'), key='float')
+        with self.assertRaises(pyrtl.PyrtlError):
+            pe.bitonic_sort(*pyrtl.input_list('c/8 d/8'), key='fp', signed=True)
+
+
+class TestSort(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+
+    def _run_test(self, nargs, bitwidth, algorithm, signed=False, nvectors=20):
+        pyrtl.reset_working_block()
+        ins = pyrtl.input_list([f'i{i}' for i in range(nargs)], bitwidth)
+        outs = pe.sort(*ins, signed=signed, algorithm=algorithm)
+        for i, out in enumerate(outs):
+            pyrtl.probe(out, f'o{i}')
+
+        sim = pyrtl.FastSimulation()
+        lo, hi = (-2**(bitwidth - 1), 2**(bitwidth - 1)) if signed else (0, 2**bitwidth)
+        for _ in range(nvectors):
+            ivals = [random.randrange(lo, hi) for _ in range(nargs)]
+            sim.step({f'i{i}': pyrtl.infer_val_and_bitwidth(v, bitwidth, signed).value
+                      for i, v in enumerate(ivals)})
+            ovals = [sim.inspect(f'o{i}') for i in range(nargs)]
+            if signed:
+                ovals = [pyrtl.val_to_signed_integer(v, bitwidth) for v in ovals]
+            self.assertEqual(ovals, sorted(ivals))
+
+    def _count_comparators(self, nargs, algorithm):
+        pyrtl.reset_working_block()
+        pe.sort(*pyrtl.input_list([f'i{i}' for i in range(nargs)], 8), algorithm=algorithm)
+        return sum(1 for net in pyrtl.working_block().logic if net.op == '<')
+
+    def test_sort_odd_even_merge(self):
+        random.seed(36)
+        for nargs in (1, 2, 4, 8, 16):
+            self._run_test(nargs, 8, 'odd_even_merge')
+            self._run_test(nargs, 8, 'odd_even_merge', signed=True)
+
+    def test_sort_optimal(self):
+        random.seed(360)
+        for nargs in range(1, 17):
+            self._run_test(nargs, 4, 'optimal', nvectors=50)
+        self._run_test(8, 8, 'optimal', signed=True)
+
+    def test_sort_bitonic(self):
+        random.seed(361)
+        self._run_test(8, 8, 'bitonic', signed=True)
+
+    def test_sort_not_power_of_2(self):
+        random.seed(37)
+        for algorithm in ('bitonic', 'odd_even_merge'):
+            for nargs in (3, 5, 6, 7, 12, 24):
+                self._run_test(nargs, 8, algorithm)
+            self._run_test(7, 8, algorithm, signed=True)
+
+    def test_sort_not_power_of_2_comparator_counts(self):
+        self.assertEqual(self._count_comparators(24, 'odd_even_merge'), 132)
+        self.assertEqual(self._count_comparators(32, 'odd_even_merge'), 191)
+        self.assertEqual(self._count_comparators(24, 'bitonic'), 168)
+        self.assertEqual(self._count_comparators(32, 'bitonic'), 240)
+
+    def test_sort_comparator_counts(self):
+        self.assertEqual([self._count_comparators(16, algorithm)
+                          for algorithm in ('bitonic', 'odd_even_merge', 'optimal')],
+                         [80, 63, 60])
+
+    def test_sorting_network(self):
+        self.assertEqual(pe.sorting_network(4, 'optimal'),
+                         ((0, 1, True), (2, 3, True), (0, 2, True), (1, 3, True), (1, 2, True)))
+        # Large schedules are built quickly, and only once
+        self.assertEqual(len(pe.sorting_network(1024, 'bitonic')), 256 * 10 * 11)
+        self.assertEqual(len(pe.sorting_network(1024)), (10 ** 2 - 10 + 4) * 2 ** 8 - 1)
+        self.assertIs(pe.sorting_network(4096, 'bitonic'), pe.sorting_network(4096, 'bitonic'))
+
+        random.seed(42)
+        for n, algorithm in ((1024, 'bitonic'), (1000, 'odd_even_merge'), (13, 'optimal')):
+            values = [random.randrange(1000) for _ in range(n)]
+            lanes = list(values)
+            for i, j, ascending in pe.sorting_network(n, algorithm):
+                lo, hi = min(lanes[i], lanes[j]), max(lanes[i], lanes[j])
+                lanes[i], lanes[j] = (lo, hi) if ascending else (hi, lo)
+            self.assertEqual(lanes, sorted(values))
+        with self.assertRaises(pyrtl.PyrtlError):
+            pe.sorting_network(17, 'optimal')
+
+    def test_verify_sorting_network(self):
+        random.seed(43)
+        for n in range(1, 17):
+            for algorithm in ('bitonic', 'odd_even_merge', 'optimal'):
+                self.assertIsNone(pe.verify_sorting_network(n, algorithm, netlist_samples=16))
+        for algorithm in ('bitonic', 'odd_even_merge'):
+            self.assertIsNone(pe.verify_sorting_network(24, algorithm))
+
+    def test_verify_sorting_network_fails(self):
+        schedule = pe.sorting_network(10, 'optimal')
+        for drop in (0, 10, len(schedule) - 1):
+            broken = schedule[:drop] + schedule[drop + 1:]
+            bits = pe.verify_sorting_network(10, schedule=broken)
+            for i, j, _ in broken:
+                bits[i], bits[j] = min(bits[i], bits[j]), max(bits[i], bits[j])
+            self.assertNotEqual(bits, sorted(bits))
+        self.assertEqual(pe.verify_sorting_network(2, schedule=[(0, 1, False)]), [1, 0])
+        with self.assertRaises(pyrtl.PyrtlError):
+            pe.verify_sorting_network(2, schedule=[(0, 2, True)])
+
+    def test_sort_payloads(self):
+        random.seed(41)
+        keys = pyrtl.input_list([f'k{i}' for i in range(12)], 4)
+        payloads = pyrtl.input_list([f'p{i}' for i in range(12)], 64)
+        sorted_keys, sorted_payloads = pe.sort(*keys, payloads=payloads)
+        for i in range(12):
+            pyrtl.probe(sorted_keys[i], f'ok{i}')
+            pyrtl.probe(sorted_payloads[i], f'op{i}')
+        # Only the keys are compared
+        self.assertTrue(all(len(net.args[0]) == 4 for net in pyrtl.working_block().logic
+                            if net.op == '<'))
+
+        sim = pyrtl.FastSimulation()
+        for _ in range(20):
+            records = [(random.randrange(16), random.getrandbits(64)) for _ in range(12)]
+            inputs = {f'k{i}': k for i, (k, _) in enumerate(records)}
+            inputs.update({f'p{i}': p for i, (_, p) in enumerate(records)})
+            sim.step(inputs)
+            out = [(sim.inspect(f'ok{i}'), sim.inspect(f'op{i}')) for i in range(12)]
+            self.assertEqual(sorted(out), sorted(records))
+            self.assertEqual([k for k, _ in out], sorted(k for k, _ in records))
+
+    def test_argsort(self):
+        random.seed(410)
+        for nargs, algorithm in ((5, 'optimal'), (8, 'bitonic'), (16, 'odd_even_merge')):
+            pyrtl.reset_working_block()
+            ins = pyrtl.input_list([f'i{i}' for i in range(nargs)], 8)
+            for i, index in enumerate(pe.argsort(*ins, signed=True, algorithm=algorithm)):
+                pyrtl.probe(index, f'o{i}')
+            sim = pyrtl.FastSimulation()
+            for _ in range(20):
+                ivals = [random.randrange(-128, 128) for _ in range(nargs)]
+                sim.step({f'i{i}': v & 0xff for i, v in enumerate(ivals)})
+                perm = [sim.inspect(f'o{i}') for i in range(nargs)]
+                self.assertEqual(sorted(perm), list(range(nargs)))
+                self.assertEqual([ivals[i] for i in perm], sorted(ivals))
+
+    def test_sort_invalid(self):
+        with self.assertRaises(pyrtl.PyrtlError):
+            pe.sort(*pyrtl.input_list('a/8 b/8'), algorithm='quick')
+        with self.assertRaises(pyrtl.PyrtlError):
+            pe.sort(*pyrtl.input_list([f'f{i}' for i in range(17)], 8), algorithm='optimal')
+        with self.assertRaises(pyrtl.PyrtlError):
+            pe.sort(*pyrtl.input_list('g/8 h/8'), payloads=pyrtl.input_list('p/8'))
+
+
+class TestSelection(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+
+    def _run_test(self, nargs, select, expected, signed=False, nvectors=30):
+        pyrtl.reset_working_block()
+        ins = pyrtl.input_list([f'i{i}' for i in range(nargs)], 8)
+        outs = select(ins)
+        for i, out in enumerate(outs):
+            pyrtl.probe(out, f'o{i}')
+
+        sim = pyrtl.FastSimulation()
+        lo, hi = (-128, 128) if signed else (0, 256)
+        for _ in range(nvectors):
+            # Small range, for plenty of ties
+            ivals = [random.randrange(lo, hi) // 32 * 32 for _ in range(nargs)]
+            sim.step({f'i{i}': v & 0xff for i, v in enumerate(ivals)})
+            ovals = [sim.inspect(f'o{i}') for i in range(len(outs))]
+            if signed:
+                ovals = [pyrtl.val_to_signed_integer(v, 8) for v in ovals]
+            self.assertEqual(ovals, expected(ivals))
+
+    def test_top_k(self):
+        random.seed(40)
+        for nargs in (1, 2, 5, 8, 13, 16, 24):
+            for k in sorted({1, 2, 3, nargs // 2 or 1, nargs}):
+                if k <= nargs:
+                    self._run_test(nargs, lambda ins: pe.top_k(*ins, k=k),
+                                   lambda ivals: sorted(ivals)[:k])
+
+    def test_top_k_largest_signed(self):
+        random.seed(400)
+        self._run_test(10, lambda ins: pe.top_k(*ins, k=3, signed=True, largest=True),
+                       lambda ivals: sorted(ivals, reverse=True)[:3], signed=True)
+
+    def test_median(self):
+        random.seed(401)
+        for nargs in (1, 2, 3, 4, 5, 9, 16, 25):
+            self._run_test(nargs, lambda ins: [pe.median(*ins)],
+                           lambda ivals: [sorted(ivals)[(len(ivals) - 1) // 2]])
+        self._run_test(7, lambda ins: [pe.median(*ins, signed=True)],
+                       lambda ivals: [sorted(ivals)[3]], signed=True)
+
+    def test_selection_comparator_counts(self):
+        def count(select):
+            pyrtl.reset_working_block()
+            select(pyrtl.input_list([f'i{i}' for i in range(16)], 8))
+            return sum(1 for net in pyrtl.working_block().logic if net.op == '<')
+        self.assertEqual(count(lambda ins: pe.top_k(*ins, k=1)), 15)
+        self.assertLess(count(lambda ins: pe.top_k(*ins, k=4)), 60)
+        self.assertLess(count(lambda ins: pe.median(*ins)), 60)
+
+    def test_top_k_bad_k(self):
+        with self.assertRaises(pyrtl.PyrtlError):
+            pe.top_k(*pyrtl.input_list('a/8 b/8'), k=3)
+
+
+class TestPipelinedSort(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+
+    def _run_test(self, nargs, vectors, ready, **kwargs):
+        """ Offer vectors (None for idle cycles) with the given ready_out pattern,
+        returning what comes out and the latency """
+        ins = pyrtl.input_list([f'i{i}' for i in range(nargs)], 8)
+        valid_in, ready_out = pyrtl.input_list('valid_in/1 ready_out/1')
+        res = pe.pipelined_sort(*ins, valid_in=valid_in, ready_out=ready_out, **kwargs)
+        for i, out in enumerate(res.outputs):
+            pyrtl.probe(out, f'o{i}')
+        pyrtl.probe(res.valid_out, 'valid_out')
+        pyrtl.probe(res.ready_in, 'ready_in')
+
+        sim = pyrtl.Simulation()
+        pending, outputs = list(vectors), []
+        for r in ready:
+            vector = pending[0] if pending else None
+            inputs = {f'i{i}': 0 if vector is None else vector[i] for i in range(nargs)}
+            inputs.update(valid_in=vector is not None, ready_out=r)
+            sim.step(inputs)
+            if sim.inspect('valid_out') and r:
+                outputs.append([sim.inspect(f'o{i}') for i in range(nargs)])
+            if sim.inspect('ready_in') and pending:
+                pending.pop(0)
+        return outputs, res.latency
+
+    def test_pipelined_sort_one_per_cycle(self):
+        random.seed(38)
+        vectors = [[random.randrange(256) for _ in range(8)] for _ in range(20)]
+        outputs, latency = self._run_test(8, vectors, [1] * 26)
+        self.assertEqual(latency, 6)
+        self.assertEqual(outputs, [sorted(v) for v in vectors])
+
+    def test_pipelined_sort_latency(self):
+        random.seed(380)
+        vectors = [[random.randrange(256) for _ in range(16)] for _ in range(3)]
+        outputs, latency = self._run_test(16, vectors, [1] * 8, layers_per_stage=2)
+        self.assertEqual(latency, 5)
+        self.assertEqual(outputs, [sorted(v) for v in vectors])
+
+    def test_pipelined_sort_backpressure(self):
+        random.seed(381)
+        vectors = [[random.randrange(256) for _ in range(6)] for _ in range(12)]
+        ready = [random.randrange(2) for _ in range(60)]
+        outputs, latency = self._run_test(6, vectors, ready, algorithm='odd_even_merge')
+        self.assertEqual(outputs, [sorted(v) for v in vectors])
+
+    def test_pipelined_sort_one_input(self):
+        outputs, latency = self._run_test(1, [[3], [1]], [0, 1, 1])
+        self.assertEqual((outputs, latency), ([[3], [1]], 0))
+
+
+class TestStreamSort(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+
+    def _run_test(self, w, length, nseqs, signed=False, p_ready=1.0):
+        """ Stream nseqs random sequences through, returning the number of cycles taken """
+        ins = pyrtl.input_list([f'i{i}' for i in range(w)], 8)
+        valid_in, ready_out = pyrtl.input_list('valid_in/1 ready_out/1')
+        res = pe.stream_sort(ins, valid_in, ready_out, length, signed=signed)
+        for name in res._fields:
+            pyrtl.probe(getattr(res, name), name)
+
+        sim = pyrtl.FastSimulation()
+        lo, hi = (-128, 128) if signed else (0, 256)
+        seqs = [[random.randrange(lo, hi) for _ in range(length)] for _ in range(nseqs)]
+        blocks = [seq[i:i + w] for seq in seqs for i in range(0, length, w)]
+        outputs, current, cycles = [], [], 0
+        while len(outputs) < nseqs:
+            block = blocks[0] if blocks else [0] * w
+            ready = int(random.random() < p_ready)
+            inputs = {f'i{i}': v & 0xff for i, v in enumerate(block)}
+            inputs.update(valid_in=int(bool(blocks)), ready_out=ready)
+            sim.step(inputs)
+            cycles += 1
+            if sim.inspect('ready_in') and blocks:
+                blocks.pop(0)
+            if sim.inspect('valid_out') and ready:
+                v = sim.inspect('out')
+                current.append(pyrtl.val_to_signed_integer(v, 8) if signed else v)
+                if sim.inspect('last_out'):
+                    outputs.append(current)
+                    current = []
+            self.assertLess(cycles, 10000)
+        self.assertEqual(outputs, [sorted(seq) for seq in seqs])
+        return cycles
+
+    def test_stream_sort(self):
+        random.seed(39)
+        # Per sequence: 8 cycles to load, and 3 passes over 32 elements
+        self.assertEqual(self._run_test(4, 32, 3), 3 * (8 + 3 * 32))
+
+    def test_stream_sort_backpressure(self):
+        random.seed(390)
+        self._run_test(8, 64, 2, p_ready=0.5)
+        pyrtl.reset_working_block()
+        self._run_test(4, 8, 3, signed=True, p_ready=0.3)
+
+    def test_stream_sort_one_block(self):
+        random.seed(391)
+        self._run_test(4, 4, 3)
+
+    def test_stream_sort_bad_length(self):
+        ins = pyrtl.input_list('a/8 b/8 c/8 d/8')
+        with self.assertRaises(pyrtl.PyrtlError):
+            pe.stream_sort(ins, 1, 1, 24)
+        with self.assertRaises(pyrtl.PyrtlError):
+            pe.stream_sort(ins[:3], 1, 1, 12)
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -1,5 +1,6 @@
 import unittest
 import pyrtl
+from pyrtl.rtllib import adders, multipliers
 
 import pyrtl_extras as pe
 
@@ -15,7 +16,355 @@ class TestVerificationViaSimulation(unittest.TestCase):
         def f2(x, y):
             return ~(x & y)
         
-        pe.equivalent_comb_via_sim(f1, f2, [4, 4])
+        res = pe.equivalent_comb_via_sim(f1, f2, [4, 4])
+        self.assertTrue(res)
+        self.assertEqual((res.counterexamples, res.mismatches, res.vectors_checked), ([], 0, 256))
+
+    def test_not_equivalent_comb(self):
+        # Differ only when x is 0 or 5
+        def f1(x, y):
+            return x + y
+
+        def f2(x, y):
+            return pyrtl.select((x == 0) | (x == 5), x, x + y)
+
+        res = pe.equivalent_comb_via_sim(f1, f2, [3, 2], chunk_size=5, max_counterexamples=3)
+        self.assertFalse(res)
+        self.assertIsInstance(res, pe.EquivalenceResult)
+        self.assertEqual((res.mismatches, res.vectors_checked), (6, 32))
+        self.assertEqual([c.inputs for c in res.counterexamples], [(0, 1), (0, 2), (0, 3)])
+        self.assertEqual(res.counterexamples[1].outputs1, (2,))
+        self.assertEqual(res.counterexamples[1].outputs2, (0,))
+        self.assertGreater(res.throughput, 0)
+
+    def test_not_equivalent_comb_stop_on_first(self):
+        def f1(x, y):
+            return x & y
+
+        def f2(x, y):
+            return pyrtl.select(x == 3, y + 1, x & y)
+
+        res = pe.equivalent_comb_via_sim(f1, f2, [2, 2], stop_on_first=True)
+        self.assertFalse(res.equivalent)
+        self.assertEqual((res.mismatches, res.vectors_checked), (1, 13))
+        self.assertEqual(res.counterexamples, [((3, 0), (0,), (1,))])
+
+    def test_equivalent_comb_simulations(self):
+        def f1(x, y):
+            return x * y, x - y
+
+        def f2(x, y):
+            return y * x, pyrtl.select(y == 7, x, x - y)
+
+        for simulation in (pyrtl.Simulation, pyrtl.FastSimulation, pyrtl.CompiledSimulation,
+                           pe.BitslicedSimulation):
+            pyrtl.reset_working_block()
+            res = pe.equivalent_comb_via_sim(f1, f2, [4, 3], chunk_size=50,
+                                             simulation=simulation)
+            self.assertEqual((res.equivalent, res.mismatches, res.vectors_checked),
+                             (False, 16, 128), simulation.__name__)
+            self.assertEqual(res.counterexamples[0], ((0, 7), (0, 25), (0, 0)))
+
+    def test_equivalent_comb_workers(self):
+        offset = 3
+
+        def f1(x, y):
+            return x + y + offset
+
+        def f2(x, y):
+            return pyrtl.select((x == 9) & y[0], x, x + y + offset)
+
+        seen = []
+        res = pe.equivalent_comb_via_sim(f1, f2, [4, 6], chunk_size=16, workers=3,
+                                         max_counterexamples=40,
+                                         progress=lambda done, total: seen.append((done, total)))
+        pyrtl.reset_working_block()
+        expected = pe.equivalent_comb_via_sim(f1, f2, [4, 6], max_counterexamples=40)
+        self.assertEqual(res[:4], expected[:4])
+        self.assertEqual((res.mismatches, res.vectors_checked), (32, 1024))
+        self.assertEqual(seen[-1], (1024, 1024))
+        self.assertEqual(len(res.counterexamples), 32)
+
+        pyrtl.reset_working_block()
+        res = pe.equivalent_comb_via_sim(f1, f2, [4, 6], chunk_size=16, workers=4,
+                                         stop_on_first=True)
+        self.assertEqual(res.counterexamples, [((9, 1), (13,), (9,))])
+
+        for workers in (1, 3):
+            pyrtl.reset_working_block()
+            res = pe.equivalent_comb_via_sim(f1, f2, [4, 6], chunk_size=16, workers=workers,
+                                             max_counterexamples=40,
+                                             simulation=pe.BitslicedSimulation)
+            self.assertEqual(res[:4], expected[:4])
+            pyrtl.reset_working_block()
+            res = pe.equivalent_comb_via_sim(f1, f2, [4, 6], chunk_size=16, workers=workers,
+                                             stop_on_first=True, simulation=pe.BitslicedSimulation)
+            self.assertEqual((res.counterexamples, res.mismatches, res.vectors_checked),
+                             ([((9, 1), (13,), (9,))], 1, 9 * 64 + 2))
+
+    def test_equivalent_comb_bitsliced_wide(self):
+        def f1(x, y):
+            return x * y, x < y
+
+        def f2(x, y):
+            return y * x, pyrtl.select(x == 1000, 0, y > x)
+
+        res = pe.equivalent_comb_via_sim(f1, f2, [10, 10], max_counterexamples=1,
+                                         simulation=pe.BitslicedSimulation)
+        self.assertEqual((res.mismatches, res.vectors_checked), (23, 2 ** 20))
+        self.assertEqual(res.counterexamples, [((1000, 1001), (1001000, 1), (1001000, 0))])
+
+
+class TestVerificationViaSat(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+
+    def test_equivalent_adders(self):
+        res = pe.equivalent_comb_via_sat(lambda x, y: x + y,
+                                         lambda x, y: adders.kogge_stone(x, y), [32, 32],
+                                         solver='cdcl')
+        self.assertTrue(res)
+        self.assertIsNone(res.counterexample)
+
+    def test_equivalent_checked_add(self):
+        def reference(a, b):
+            res = pyrtl.signed_add(a, b).truncate(16)
+            cond1 = pyrtl.signed_ge(a, 0) & pyrtl.signed_ge(b, 0) & pyrtl.signed_lt(res, 0)
+            cond2 = pyrtl.signed_lt(a, 0) & pyrtl.signed_lt(b, 0) & pyrtl.signed_ge(res, 0)
+            return res, cond1 | cond2
+
+        self.assertTrue(pe.equivalent_comb_via_sat(
+            lambda a, b: tuple(pe.checked_add(a, b, 16)), reference, [16, 16], solver='cdcl'))
+
+    def test_equivalent_multipliers(self):
+        self.assertTrue(pe.equivalent_comb_via_sat(
+            lambda x, y: x * y, lambda x, y: multipliers.tree_multiplier(x, y), [4, 4],
+            solver='cdcl'))
+
+    def test_not_equivalent(self):
+        def f1(x, y):
+            return x + y, x < y
+
+        def f2(x, y):
+            return pyrtl.select(x == 123456, y, x + y), x < y
+
+        res = pe.equivalent_comb_via_sat(f1, f2, [32, 32], solver='cdcl')
+        self.assertFalse(res)
+        (x, y), out1, out2 = res.counterexample
+        self.assertEqual(x, 123456)
+        self.assertEqual(out1, (x + y, int(x < y)))
+        self.assertEqual(out2, (y, int(x < y)))
+
+    def test_invalid(self):
+        with self.assertRaises(pyrtl.PyrtlError):
+            pe.equivalent_comb_via_sat(lambda x: x, lambda x: x, [4], solver='minisat')
+
+        def f(x):
+            r = pyrtl.Register(len(x))
+            r.next <<= x
+            return r
+
+        pyrtl.reset_working_block()
+        with self.assertRaises(pyrtl.PyrtlError):
+            pe.equivalent_comb_via_sat(f, f, [4])
+
+
+class TestVerificationViaBmc(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+
+    def test_equivalent_seq(self):
+        def f1(x, y):
+            r1 = pyrtl.Register(len(x))
+            r2 = pyrtl.Register(len(y))
+            r1.next <<= x
+            r2.next <<= y
+            return r1 + r2
+
+        def f2(x, y):
+            w = x + y
+            r = pyrtl.Register(len(w))
+            r.next <<= w
+            return r
+
+        res = pe.equivalent_seq_via_bmc(f1, f2, [4, 4], solver='cdcl')
+        self.assertTrue(res)
+        self.assertEqual(res.depth, 2)
+
+    def test_equivalent_seq_deeper_induction(self):
+        def f1(x):
+            a, b = pyrtl.Register(8), pyrtl.Register(8)
+            a.next <<= x
+            b.next <<= a
+            return b
+
+        def f2(x):
+            a, b = pyrtl.Register(8, reset_value=1), pyrtl.Register(8)
+            a.next <<= (x + 1).truncate(8)
+            b.next <<= (a - 1).truncate(8)
+            return b
+
+        res = pe.equivalent_seq_via_bmc(f1, f2, [8], solver='cdcl')
+        self.assertTrue(res)
+        self.assertEqual(res.depth, 3)
+
+        pyrtl.reset_working_block()
+        res = pe.equivalent_seq_via_bmc(f1, f2, [8], depth=5, induction=False, solver='cdcl')
+        self.assertIsNone(res.equivalent)
+        self.assertFalse(res)
+
+    def test_not_equivalent_seq(self):
+        def f1(en):
+            count = pyrtl.Register(4)
+            count.next <<= count + en
+            return count == 15
+
+        def f2(en):
+            return pyrtl.Const(0)
+
+        res = pe.equivalent_seq_via_bmc(f1, f2, [1], depth=10, solver='cdcl')
+        self.assertEqual((res.equivalent, res.depth), (None, 10))
+
+        pyrtl.reset_working_block()
+        res = pe.equivalent_seq_via_bmc(f1, f2, [1], depth=20, solver='cdcl')
+        self.assertFalse(res.equivalent)
+        self.assertEqual(len(res.counterexample), 16)
+        self.assertEqual([c.inputs for c in res.counterexample[:-1]], [(1,)] * 15)
+        self.assertEqual(res.counterexample[-1][1:], ((1,), (0,)))
+
+        # Replaying the inputs in simulation gives the same outputs
+        sim = pyrtl.FastSimulation()
+        sim.step_multiple({'arg0': [c.inputs[0] for c in res.counterexample]})
+        self.assertEqual(sim.tracer.trace['f1_out0'], [c.outputs1[0] for c in res.counterexample])
+
+    def test_not_equivalent_seq_state_repeats(self):
+        # The saturated counter's next state is the same as its current one, which
+        # induction mustn't rule out
+        def f1(x):
+            c = pyrtl.Register(2)
+            c.next <<= pyrtl.select(c == 3, c, c + 1)
+            return (c == 3) & x
+
+        def f2(x):
+            return pyrtl.Const(0) & x
+
+        res = pe.equivalent_seq_via_bmc(f1, f2, [1], solver='cdcl')
+        self.assertFalse(res.equivalent)
+        self.assertEqual(len(res.counterexample), 4)
+
+
+class TestVerificationViaLockstepSimulation(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+
+    @staticmethod
+    def acc(x):
+        r = pyrtl.Register(8)
+        r.next <<= r + x
+        return r
+
+    @staticmethod
+    def acc_offset(x):
+        r = pyrtl.Register(8, reset_value=1)
+        r.next <<= r + x
+        return (r - 1).truncate(8)
+
+    @staticmethod
+    def acc_bug(x):
+        r = pyrtl.Register(8)
+        r.next <<= r + x + (r == 200)
+        return r
+
+    def test_equivalent_seq(self):
+        res = pe.equivalent_seq_via_simulation(self.acc, self.acc_offset, [8], 50, runs=10,
+                                               seed=0)
+        self.assertTrue(res)
+        self.assertIsNone(res.counterexample)
+        self.assertIsNone(res.cycle)
+        self.assertEqual(res.cycles_checked, 500)
+
+    def test_not_equivalent_seq(self):
+        stimulus = [[(1,)] * 10, [(100,), (100,), (0,), (0,)], [(200,), (0,), (0,)]]
+        res = pe.equivalent_seq_via_simulation(self.acc, self.acc_bug, [8], stimulus=stimulus)
+        self.assertFalse(res)
+        # The earliest difference is reported
+        self.assertEqual((res.run, res.cycle), (2, 2))
+        self.assertEqual(res.counterexample, (
+            pe.verification.Counterexample((200,), (0,), (0,)),
+            pe.verification.Counterexample((0,), (200,), (200,)),
+            pe.verification.Counterexample((0,), (200,), (201,)),
+        ))
+
+    def test_random_stimulus(self):
+        results = []
+        for sim in (pyrtl.Simulation, pyrtl.FastSimulation, pe.BitslicedSimulation):
+            for workers in (1, 2):
+                pyrtl.reset_working_block()
+                res = pe.equivalent_seq_via_simulation(self.acc, self.acc_bug, [8], runs=64,
+                                                       seed=1, simulation=sim, workers=workers)
+                self.assertFalse(res)
+                results.append((res.run, res.counterexample))
+        # Same stimulus on every backend, so the same run is found
+        self.assertEqual(len(set(results)), 1)
+
+    def test_constrained_stimulus(self):
+        def small(rng):
+            while True:
+                yield (rng.randrange(2),)
+
+        res = pe.equivalent_seq_via_simulation(self.acc, self.acc_bug, [8], 150, runs=8,
+                                               stimulus=small, seed=0)
+        self.assertTrue(res)
+        self.assertEqual(res.cycles_checked, 8 * 150)
+
+    def test_memories(self):
+        def m1(we, addr, data):
+            mem = pyrtl.MemBlock(4, 2)
+            mem[addr] <<= pyrtl.MemBlock.EnabledWrite(data, we)
+            return mem[addr]
+
+        def m2(we, addr, data):
+            mem = pyrtl.MemBlock(4, 2)
+            mem[addr] <<= pyrtl.MemBlock.EnabledWrite(data, we & (addr != 3))
+            return mem[addr]
+
+        res = pe.equivalent_seq_via_simulation(m1, m1, [1, 2, 4], 20, runs=10, seed=0)
+        self.assertTrue(res)
+        pyrtl.reset_working_block()
+        res = pe.equivalent_seq_via_simulation(m1, m2, [1, 2, 4], 20, runs=10, seed=0)
+        self.assertFalse(res)
+        self.assertEqual(res.counterexample[-1].inputs[1], 3)
+
+    def test_design_unchanged(self):
+        res = pe.equivalent_seq_via_simulation(self.acc, self.acc_offset, [8], 10, runs=2)
+        self.assertTrue(res)
+        block = pyrtl.working_block()
+        self.assertEqual([w.name for w in block.wirevector_subset(pyrtl.Input)], ['arg0'])
+        # No reset muxes in front of the registers
+        self.assertEqual(block.logic_subset('x'), set())
+
+    def test_seed(self):
+        results = []
+        for seed in ('abc', 'abc', 7):
+            pyrtl.reset_working_block()
+            res = pe.equivalent_seq_via_simulation(self.acc, self.acc_bug, [8], seed=seed)
+            self.assertEqual(res.seed, seed)
+            results.append((res.run, res.counterexample))
+        self.assertEqual(results[0], results[1])
+        self.assertNotEqual(results[0], results[2])
+
+    def test_invalid_stimulus(self):
+        with self.assertRaises(pyrtl.PyrtlError):
+            pe.equivalent_seq_via_simulation(self.acc, self.acc_bug, [8], stimulus=[[(256,)]])
+
+    def test_runs_with_stimulus_list(self):
+        with self.assertRaises(pyrtl.PyrtlError):
+            pe.equivalent_seq_via_simulation(self.acc, self.acc_bug, [8], runs=100,
+                                             stimulus=[[(1,)], [(2,)], [(3,)]])
+        res = pe.equivalent_seq_via_simulation(self.acc, self.acc_bug, [8], runs=3,
+                                               stimulus=[[(1,)], [(2,)], [(3,)]])
+        self.assertEqual(res.cycles_checked, 3)
+
 
 class TestVerificationViaModelChecking(unittest.TestCase):
     def setUp(self):